@@ -5,12 +5,15 @@ import os
 import json
 import platform
 import subprocess
-import time
+import threading
 
 from aws_client import AWSClient
 from ssh_runner import SSHRunner
-from deployment_manager import DeploymentManager
+from deployment_manager import DeploymentManager, setup_in_progress
 from storage import Storage
+from jobs import JobManager, JobConflict
+from log_broadcast import get_log_channel, release_log_channel
+import metrics
 
 load_dotenv()
 
@@ -20,17 +23,88 @@ CORS(app)
 # Initialize components
 aws_client = AWSClient()
 storage = Storage()
+jobs = JobManager(storage)
+
+def submit_job(kind, deployment_id, fn, params=None, deployment_ids=None):
+    """
+    Run fn(job) as a background job and answer 202 with the job record
+    (the already active one if it's the same operation), or 409 if another
+    operation is in progress on the deployment, including a launch (which
+    doesn't run as a job).
+    """
+    claims = deployment_ids or [deployment_id]
+    launching = [dep_id for dep_id in claims if setup_in_progress(dep_id) and not jobs.active(dep_id)]
+    if launching:
+        return jsonify({'error': f"Setup is still in progress for {', '.join(launching)}"}), 409
+    try:
+        job, created = jobs.submit(kind, deployment_id, fn, params, deployment_ids)
+    except JobConflict as e:
+        return jsonify({'error': str(e), 'job': e.job}), 409
+    return jsonify({'success': True, 'job_id': job['id'], 'job': job, 'deduplicated': not created}), 202
 
 @app.route('/api/keys', methods=['GET'])
 def get_keys():
-    """Get list of available SSH keys"""
-    keys = aws_client.get_key_pairs()
+    """Get list of available SSH keys (?refresh=1 bypasses the cache)"""
+    keys = aws_client.get_key_pairs(refresh=request.args.get('refresh') == '1')
     return jsonify({
         'keys': [{'name': k['KeyName'], 'fingerprint': k['KeyFingerprint']} 
                  for k in keys],
         'default': os.getenv('DEFAULT_KEY_NAME')
     })
 
+@app.route('/api/aws/cache', methods=['GET'])
+def get_aws_cache_stats():
+    """Hit/miss counters of the EC2 metadata cache"""
+    return jsonify(aws_client.cache_stats())
+
+@app.route('/api/aws/cache', methods=['DELETE'])
+def clear_aws_cache():
+    """Drop all cached EC2 metadata"""
+    aws_client.invalidate_cache()
+    return jsonify({'success': True})
+
+@app.route('/api/images', methods=['GET'])
+def get_images():
+    """The baked image record, the current setup hash and any bakes in progress"""
+    manager = DeploymentManager(aws_client, None, storage)
+    setup_hash = manager.setup_hash()
+    record = manager.baker.record()
+    return jsonify({
+        'setup_hash': setup_hash,
+        'image': record,
+        'up_to_date': bool(record and record.get('setup_hash') == setup_hash),
+        'baking': manager.baker.baking()
+    })
+
+@app.route('/api/images/bake', methods=['POST'])
+def bake_image():
+    """Bake an image for the current setup commands in the background"""
+    data = request.json or {}
+    key_name = data.get('key_name')
+    if not key_name:
+        return jsonify({'error': 'key_name is required'}), 400
+    
+    key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
+    key_path = os.path.expanduser(key_path)
+    
+    manager = DeploymentManager(aws_client, SSHRunner(key_path, 'ubuntu'), storage)
+    setup_hash = manager.setup_hash()
+    started = manager.bake_image(key_name, setup_hash)
+    return jsonify({
+        'setup_hash': setup_hash,
+        'started': started,
+        'log_file': manager.bake_log_path(setup_hash)
+    }), 202
+
+@app.route('/api/warm-pool', methods=['GET'])
+def get_warm_pool():
+    """Configured warm-pool size and member counts per pool and state"""
+    manager = DeploymentManager(aws_client, None, storage)
+    return jsonify({
+        'size': manager.pool.size,
+        'pools': manager.pool.status()
+    })
+
 @app.route('/api/launch', methods=['POST'])
 def launch_deployment():
     """Launch a new deployment"""
@@ -38,6 +112,7 @@ def launch_deployment():
     count = data['count']
     key_name = data['key_name']
     name = data.get('name')
+    min_count = data.get('min_count')
     
     # Get SSH key path from env
     key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
@@ -47,76 +122,190 @@ def launch_deployment():
     ssh_runner = SSHRunner(key_path, 'ubuntu')
     manager = DeploymentManager(aws_client, ssh_runner, storage)
     
-    deployment_id = manager.launch_deployment(count, key_name, name)
+    deployment_id = manager.launch_deployment(count, key_name, name, min_count=min_count)
     
     return jsonify({
         'deployment_id': deployment_id,
         'status': 'launching'
     })
 
+def summarize_deployment(dep):
+    """The list-view fields of a deployment, as shown in the dashboard table"""
+    return {
+        'id': dep['id'],
+        'name': dep['name'],
+        'created_at': dep['created_at'],
+        'status': dep['status'],
+        'head_ip': dep['head']['ip'] if dep.get('head') else None,
+        'worker_count': len(dep.get('workers', []))
+    }
+
+# Sorted summaries of all deployments, rebuilt only when the storage version changes
+_summaries = {'version': None, 'items': []}
+_summaries_lock = threading.Lock()
+
+def sorted_summaries(version):
+    with _summaries_lock:
+        if _summaries['version'] != version:
+            items = [summarize_deployment(dep) for dep in storage.get_all_deployments().values()]
+            # Sort by created_at descending
+            items.sort(key=lambda x: x['created_at'], reverse=True)
+            _summaries['version'] = version
+            _summaries['items'] = items
+        return _summaries['items']
+
+def not_modified(etag):
+    """True if the client's If-None-Match already has this ETag"""
+    return request.if_none_match.contains(etag)
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
 @app.route('/api/deployments', methods=['GET'])
 def get_deployments():
-    """Get all deployments"""
-    deployments = storage.get_all_deployments()
-    
-    # Transform to list format for frontend
-    result = []
-    for dep_id, dep in deployments.items():
-        result.append({
-            'id': dep['id'],
-            'name': dep['name'],
-            'created_at': dep['created_at'],
-            'status': dep['status'],
-            'head_ip': dep['head']['ip'] if dep.get('head') else None,
-            'worker_count': len(dep.get('workers', []))
-        })
-    
-    # Sort by created_at descending
-    result.sort(key=lambda x: x['created_at'], reverse=True)
-    
-    return jsonify({'deployments': result})
+    """
+    Get all deployments.
+    Query params:
+      status=running,failed   only these statuses
+      limit=N&offset=M        one page of the (created_at descending) list
+      since=VERSION           only entries changed/removed after VERSION
+    Responses carry an ETag; If-None-Match with the current one gets a 304.
+    """
+    version = storage.version
+    etag = f"v{version}"
+    if not_modified(etag):
+        return with_etag(Response(status=304), etag)
+    
+    statuses = [s for s in request.args.get('status', '').split(',') if s]
+    
+    def wanted(dep):
+        return not statuses or dep['status'] in statuses
+    
+    since = request.args.get('since', type=int)
+    if since is not None:
+        changes = storage.get_changes_since(since)
+        changed = list(changes['created'].values()) + list(changes['updated'].values())
+        # Entries that moved out of the status filter are gone from this view
+        removed = changes['removed'] + [dep['id'] for dep in changed if not wanted(dep)]
+        return with_etag(jsonify({
+            'version': changes['version'],
+            'changed': [summarize_deployment(dep) for dep in changed if wanted(dep)],
+            'removed': removed
+        }), etag)
+    
+    result = [dep for dep in sorted_summaries(version) if wanted(dep)]
+    total = len(result)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', type=int)
+    result = result[offset:offset + limit] if limit is not None else result[offset:]
+    
+    return with_etag(jsonify({
+        'deployments': result,
+        'total': total,
+        'offset': offset,
+        'version': version
+    }), etag)
+
+@app.route('/api/deployments/events', methods=['GET'])
+def deployment_events():
+    """
+    Push deployment changes via SSE.
+    The first event is a full snapshot ({'type': 'snapshot', 'deployments': [...]}),
+    then one {'type': 'diff', 'created': [...], 'updated': [...], 'removed': [ids]}
+    event per change. Event ids are storage versions: reconnecting with
+    Last-Event-ID gets just the changes missed in between.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        since = None
+    
+    def event(version, payload):
+        return f"id: {version}\ndata: {json.dumps(payload)}\n\n"
+    
+    def generate():
+        version = since
+        if version is None or version > storage.version:
+            version = storage.version
+            deployments = [summarize_deployment(dep) for dep in storage.get_all_deployments().values()]
+            deployments.sort(key=lambda x: x['created_at'], reverse=True)
+            yield event(version, {'type': 'snapshot', 'version': version, 'deployments': deployments})
+        
+        while True:
+            current = storage.wait_for_change(version, timeout=15)
+            if current <= version:
+                yield ": keepalive\n\n"
+                continue
+            changes = storage.get_changes_since(version)
+            version = changes['version']
+            yield event(version, {
+                'type': 'diff',
+                'version': version,
+                'created': [summarize_deployment(dep) for dep in changes['created'].values()],
+                'updated': [summarize_deployment(dep) for dep in changes['updated'].values()],
+                'removed': changes['removed']
+            })
+    
+    return Response(generate(), mimetype='text/event-stream')
 
 @app.route('/api/deployments/<deployment_id>', methods=['GET'])
 def get_deployment(deployment_id):
-    """Get detailed deployment info"""
+    """Get detailed deployment info (with an ETag for conditional requests)"""
+    version = storage.get_deployment_version(deployment_id)
+    if version is None:
+        return jsonify({'error': 'Deployment not found'}), 404
+    etag = f"v{version}"
+    if not_modified(etag):
+        return with_etag(Response(status=304), etag)
     deployment = storage.get_deployment(deployment_id)
     if not deployment:
         return jsonify({'error': 'Deployment not found'}), 404
-    return jsonify(deployment)
+    return with_etag(jsonify(deployment), etag)
 
 @app.route('/api/deployments/<deployment_id>', methods=['DELETE'])
 def delete_deployment(deployment_id):
-    """Delete a deployment"""
+    """Delete a deployment (terminates its instances in a background job)"""
     deployment = storage.get_deployment(deployment_id)
     if not deployment:
         return jsonify({'error': 'Deployment not found'}), 404
     
-    key_name = deployment['key_name']
-    key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
-    key_path = os.path.expanduser(key_path)
+    # Terminating needs no SSH (nor the key file)
+    manager = DeploymentManager(aws_client, None, storage)
     
-    ssh_runner = SSHRunner(key_path)
-    manager = DeploymentManager(aws_client, ssh_runner, storage)
+    def run(job):
+        return {'terminated_instances': manager.delete_deployment(deployment_id)}
     
-    terminated = manager.delete_deployment(deployment_id)
+    return submit_job('delete', deployment_id, run)
     
-    return jsonify({
-        'success': True,
-        'terminated_instances': terminated
-    })
+@app.route('/api/deployments/bulk-delete', methods=['POST'])
+def bulk_delete_deployments():
+    """
+    Terminate many deployments in one background job ({"deployment_ids": [...]}),
+    with batched EC2 calls and storage writes
+    """
+    data = request.get_json(silent=True) or {}
+    deployment_ids = data.get('deployment_ids')
+    if not isinstance(deployment_ids, list) or not deployment_ids:
+        return jsonify({'error': 'deployment_ids must be a non-empty list'}), 400
+    deployment_ids = sorted(set(deployment_ids))
+    unknown = [dep_id for dep_id in deployment_ids if not storage.get_deployment(dep_id)]
+    if unknown:
+        return jsonify({'error': f"Deployments not found: {', '.join(unknown)}"}), 404
     
-@app.route('/api/deployments/clear-terminated', methods=['POST'])
-def clear_terminated():
-    """Remove all terminated deployments from storage"""
-    deployments = storage.get_all_deployments()
+    manager = DeploymentManager(aws_client, None, storage)
     
-    terminated_ids = [
-        dep_id for dep_id, dep in deployments.items() 
-        if dep.get('status') == 'terminated'
-    ]
+    def run(job):
+        terminated, errors = manager.delete_deployments(deployment_ids)
+        return {'terminated_instances': terminated, 'errors': errors}
     
-    for dep_id in terminated_ids:
-        storage.delete_deployment(dep_id)
+    return submit_job('bulk_delete', None, run, {'deployment_ids': deployment_ids}, deployment_ids)
+
+@app.route('/api/deployments/clear-terminated', methods=['POST'])
+def clear_terminated():
+    """Remove all terminated deployments from storage (in one write)"""
+    terminated_ids = list(storage.get_deployments_by_status(['terminated']))
+    storage.delete_deployments(terminated_ids)
     
     return jsonify({
         'success': True,
@@ -125,50 +314,57 @@ def clear_terminated():
 
 @app.route('/api/deployments/<deployment_id>/logs/stream', methods=['GET'])
 def stream_logs(deployment_id):
-    """Stream deployment logs via SSE"""
+    """
+    Stream deployment logs via SSE.
+    Each event carries a batch of lines ({'type': 'logs', 'messages': [...]}) and
+    its id is the last line number, so reconnecting with Last-Event-ID resumes.
+    """
     deployment = storage.get_deployment(deployment_id)
     if not deployment:
         return jsonify({'error': 'Deployment not found'}), 404
     
-    log_file = os.path.expanduser(deployment['log_file'])
+    log_file = deployment['log_file']
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        start_seq = max(0, int(last_event_id))
+    except (TypeError, ValueError):
+        start_seq = 0
+    
+    def frame(lines):
+        messages = [line.strip() for _, line in lines]
+        return f"id: {lines[-1][0]}\ndata: {json.dumps({'type': 'logs', 'messages': messages})}\n\n"
     
     def generate():
-        # First, send existing logs
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                for line in f:
-                    yield f"data: {json.dumps({'type': 'log', 'message': line.strip()})}\n\n"
-        
-        # Then tail the file for new lines
-        last_position = os.path.getsize(log_file) if os.path.exists(log_file) else 0
-        
+        channel = get_log_channel(log_file)
+        try:
+            yield from stream(channel)
+        finally:
+            release_log_channel(channel)
+    
+    def stream(channel):
+        seq = start_seq
         while True:
-            # Check if deployment is complete first
+            # Wakes as soon as the log writer publishes new lines
+            lines = channel.read_since(seq, timeout=1.0)
+            if lines:
+                seq = lines[-1][0]
+                yield frame(lines)
+                continue
+            
+            # Check if deployment is complete
             current_deployment = storage.get_deployment(deployment_id)
-            if current_deployment['status'] in ['running', 'failed', 'terminated']:
-                # Send any remaining logs
-                if os.path.exists(log_file):
-                    current_size = os.path.getsize(log_file)
-                    if current_size > last_position:
-                        with open(log_file, 'r') as f:
-                            f.seek(last_position)
-                            for line in f:
-                                yield f"data: {json.dumps({'type': 'log', 'message': line.strip()})}\n\n"
+            if not current_deployment or current_deployment['status'] in ['running', 'failed', 'terminated']:
+                # Send any remaining logs (the final lines may still be in the writer's batch)
+                while True:
+                    lines = channel.read_since(seq, timeout=0.5)
+                    if not lines:
+                        break
+                    seq = lines[-1][0]
+                    yield frame(lines)
                 
-                yield f"data: {json.dumps({'type': 'complete', 'status': current_deployment['status']})}\n\n"
+                status = current_deployment['status'] if current_deployment else 'deleted'
+                yield f"data: {json.dumps({'type': 'complete', 'status': status})}\n\n"
                 break
-            
-            # Stream new log lines
-            if os.path.exists(log_file):
-                current_size = os.path.getsize(log_file)
-                if current_size > last_position:
-                    with open(log_file, 'r') as f:
-                        f.seek(last_position)
-                        for line in f:
-                            yield f"data: {json.dumps({'type': 'log', 'message': line.strip()})}\n\n"
-                    last_position = current_size
-            
-            time.sleep(1)
     
     return Response(generate(), mimetype='text/event-stream')
 
@@ -241,24 +437,134 @@ def open_log_file(deployment_id):
 
 @app.route('/api/deployments/<deployment_id>/restart', methods=['POST'])
 def restart_deployment(deployment_id):
-    """Restart all servers in a deployment (workers and head)."""
+    """
+    Restart all servers in a deployment (workers and head) in a background job.
+    Optional JSON body: {"mode": "all" | "rolling", "batch_size": N}
+    """
     deployment = storage.get_deployment(deployment_id)
     if not deployment:
         return jsonify({'error': 'Deployment not found'}), 404
 
+    data = request.get_json(silent=True) or {}
+    mode = data.get('mode', 'all')
+    if mode not in ('all', 'rolling'):
+        return jsonify({'error': f'Unknown restart mode: {mode}'}), 400
+    batch_size = data.get('batch_size')
+    if batch_size is not None:
+        try:
+            batch_size = int(batch_size)
+        except (TypeError, ValueError):
+            batch_size = 0
+        if batch_size < 1:
+            return jsonify({'error': 'batch_size must be a positive number'}), 400
+    if not deployment.get('head'):
+        return jsonify({'error': 'Head IP not found for deployment'}), 400
+
     key_name = deployment['key_name']
     key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
     key_path = os.path.expanduser(key_path)
     username = os.getenv('SSH_USERNAME', 'ubuntu')
 
     ssh_runner = SSHRunner(key_path, username)
-    manager = DeploymentManager(AWSClient(), ssh_runner, storage)
+    manager = DeploymentManager(aws_client, ssh_runner, storage)
+
+    def run(job):
+        manager.restart_servers(deployment_id, mode=mode, batch_size=batch_size,
+                                cancel_event=job.cancel_event, progress=job.progress)
+
+    return submit_job('restart', deployment_id, run, {'mode': mode, 'batch_size': batch_size})
+
+@app.route('/api/deployments/<deployment_id>/resume', methods=['POST'])
+def resume_deployment(deployment_id):
+    """Continue a failed deployment from its last good step (in a background job)."""
+    deployment = storage.get_deployment(deployment_id)
+    if not deployment:
+        return jsonify({'error': 'Deployment not found'}), 404
+
+    key_name = deployment['key_name']
+    key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
+    key_path = os.path.expanduser(key_path)
+    username = os.getenv('SSH_USERNAME', 'ubuntu')
+
+    ssh_runner = SSHRunner(key_path, username)
+    manager = DeploymentManager(aws_client, ssh_runner, storage)
+
+    def run(job):
+        manager.resume_deployment(deployment_id, wait=True)
+
+    return submit_job('resume', deployment_id, run)
 
+@app.route('/api/deployments/<deployment_id>/scale', methods=['POST'])
+def scale_deployment(deployment_id):
+    """
+    Add workers ({"add": N}) or drain and remove workers
+    ({"remove": [instance IDs or IPs]}), in a background job.
+    """
+    deployment = storage.get_deployment(deployment_id)
+    if not deployment:
+        return jsonify({'error': 'Deployment not found'}), 404
+
+    data = request.json or {}
     try:
-        manager.restart_servers(deployment_id)
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        add = int(data.get('add', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'add must be a number'}), 400
+    remove = data.get('remove') or []
+    if (not isinstance(remove, list) or not all(isinstance(ref, str) for ref in remove)
+            or add < 0 or bool(add) == bool(remove)):
+        return jsonify({'error': 'Give either a positive number of workers to add or the workers to remove'}), 400
+
+    key_name = deployment['key_name']
+    key_path = os.getenv("PATH_TO_AWS_PRIVATE_KEY") or f"~/.ssh/{key_name}.pem"
+    key_path = os.path.expanduser(key_path)
+    username = os.getenv('SSH_USERNAME', 'ubuntu')
+
+    ssh_runner = SSHRunner(key_path, username)
+    manager = DeploymentManager(aws_client, ssh_runner, storage)
+
+    def run(job):
+        manager.scale_deployment(deployment_id, add=add, remove=remove, wait=True)
+
+    return submit_job('scale', deployment_id, run, {'add': add, 'remove': sorted(remove)})
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Recent jobs, newest first (?deployment_id=..., ?active=1 for queued/running only)"""
+    return jsonify({'jobs': jobs.list(
+        deployment_id=request.args.get('deployment_id'),
+        active_only=request.args.get('active') == '1',
+        limit=request.args.get('limit', 100, type=int)
+    )})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress, result or error of a job"""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued job, or ask a running one to stop at its next safe point"""
+    job = jobs.cancel(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/deployments/<deployment_id>/timings', methods=['GET'])
+def get_deployment_timings(deployment_id):
+    """Timing spans of a deployment, with a per-phase summary (slowest phase / node)"""
+    deployment = storage.get_deployment(deployment_id)
+    if not deployment:
+        return jsonify({'error': 'Deployment not found'}), 404
+    spans = storage.get_timings(deployment_id)
+    return jsonify({'spans': spans, 'phases': metrics.summarize(spans)})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics: phase, EC2 API and SSH timings"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
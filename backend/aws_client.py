@@ -1,75 +1,298 @@
 import boto3
-from typing import List, Dict
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Optional, Tuple
 import os
+from ttl_cache import TTLCache
+from launch_planner import LaunchPlanner
+from metrics import instrument_boto_client
+
+# Seconds each kind of EC2 metadata is cached for
+KEY_PAIRS_TTL = 300
+DEFAULT_VPC_TTL = 3600
+SUBNETS_TTL = 600
+TEMPLATE_VERSION_TTL = 300
+# EC2 API limits: values per describe filter, instance IDs per TerminateInstances call
+FILTER_VALUES_LIMIT = 200
+TERMINATE_BATCH_SIZE = 1000
+# Instance IDs per call for everything else (DescribeInstanceStatus allows at most 100)
+INSTANCE_ID_BATCH_SIZE = 100
+# Chunks of one fleet-wide call sent at once
+AWS_API_CONCURRENCY = int(os.getenv('AWS_API_CONCURRENCY', '4'))
+# botocore's adaptive retries: exponential backoff on throttling (RequestLimitExceeded)
+# plus a client-side rate limiter that slows down while EC2 keeps throttling
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '10'))
+
+
+def chunked(items: List, size: int) -> List[List]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 class AWSClient:
     def __init__(self):
         region = os.getenv('AWS_REGION', 'us-east-1')
-        self.ec2 = boto3.client('ec2', region_name=region)
+        self.ec2 = boto3.client('ec2', region_name=region, config=Config(
+            retries={'mode': 'adaptive', 'total_max_attempts': AWS_MAX_ATTEMPTS}
+        ))
+        instrument_boto_client(self.ec2)
+        self.cache = TTLCache()
         print(f"Using region: {region}")  # Debug
     
-    def get_key_pairs(self) -> List[Dict]:
-        """Fetch all SSH key pairs from AWS"""
+    def get_key_pairs(self, refresh: bool = False) -> List[Dict]:
+        """Fetch all SSH key pairs from AWS (cached; refresh=True forces a reload)"""
+        if refresh:
+            self.cache.invalidate('key_pairs')
+        return self.cache.get('key_pairs', self._describe_key_pairs, KEY_PAIRS_TTL, refresh=True)
+    
+    def _describe_key_pairs(self) -> List[Dict]:
         response = self.ec2.describe_key_pairs()
         print(f"Found {len(response['KeyPairs'])} key pairs")  # Debug line
         return response['KeyPairs']
     
+    def get_default_vpc_id(self) -> Optional[str]:
+        """ID of the region's default VPC, or None (cached)"""
+        def load():
+            vpcs = self.ec2.describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['true']}])
+            return vpcs['Vpcs'][0]['VpcId'] if vpcs['Vpcs'] else None
+        return self.cache.get('default_vpc', load, DEFAULT_VPC_TTL)
+    
+    def get_subnets(self, vpc_id: str) -> List[Dict]:
+        """Subnets of a VPC as {'SubnetId', 'AvailabilityZone', 'AvailableIpAddressCount'} (cached)"""
+        def load():
+            subnets = self.ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+            return [{
+                'SubnetId': s['SubnetId'],
+                'AvailabilityZone': s.get('AvailabilityZone'),
+                'AvailableIpAddressCount': s.get('AvailableIpAddressCount', 0),
+            } for s in subnets['Subnets']]
+        return self.cache.get(f'subnets:{vpc_id}', load, SUBNETS_TTL, refresh=True)
+    
+    def get_subnet_ids(self, vpc_id: str) -> List[str]:
+        """Subnet IDs of a VPC (cached)"""
+        return [s['SubnetId'] for s in self.get_subnets(vpc_id)]
+    
+    def get_launch_subnets(self) -> List[Dict]:
+        """One subnet per availability zone of the default VPC (the one with most free IPs)"""
+        vpc_id = self.get_default_vpc_id()
+        if not vpc_id:
+            return []
+        by_az = {}
+        for subnet in self.get_subnets(vpc_id):
+            best = by_az.get(subnet['AvailabilityZone'])
+            if best is None or subnet['AvailableIpAddressCount'] > best['AvailableIpAddressCount']:
+                by_az[subnet['AvailabilityZone']] = subnet
+        return sorted(by_az.values(), key=lambda s: s['AvailabilityZone'] or '')
+    
+    def get_launch_template_version(self, template_id: str) -> str:
+        """
+        The template version to launch, from LAUNCH_TEMPLATE_VERSION (default '13').
+        '$Latest' / '$Default' are resolved to a concrete version number (cached),
+        so every instance of one launch uses the same version.
+        """
+        version = os.getenv('LAUNCH_TEMPLATE_VERSION', '13')
+        if version not in ('$Latest', '$Default'):
+            return version
+        def load():
+            response = self.ec2.describe_launch_templates(LaunchTemplateIds=[template_id])
+            template = response['LaunchTemplates'][0]
+            field = 'LatestVersionNumber' if version == '$Latest' else 'DefaultVersionNumber'
+            return str(template[field])
+        return self.cache.get(f'template_version:{template_id}:{version}', load, TEMPLATE_VERSION_TTL, refresh=True)
+    
+    def invalidate_cache(self, key: Optional[str] = None):
+        """Forget cached metadata (one key, or everything)"""
+        self.cache.invalidate(key)
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit/miss counters of the metadata cache"""
+        return self.cache.stats()
+    
     def launch_instances(self, template_id: str, count: int, 
-                        key_name: str, deployment_id: str) -> List[str]:
+                        key_name: str, deployment_id: str,
+                        min_count: Optional[int] = None,
+                        log_callback=None,
+                        image_id: Optional[str] = None,
+                        extra_tags: Optional[Dict[str, str]] = None) -> List[str]:
         """
-        Launch instances from template.
+        Launch instances from template, spread over the default VPC's AZs.
         Tags all instances with DeploymentId.
+        Accepts partial fulfilment down to min_count (default: all of them);
+        below that, whatever was launched is terminated and an exception raised.
+        image_id overrides the template's AMI (e.g. a baked image).
+        extra_tags are added to the DeploymentId/Name tags.
         Returns list of instance IDs.
         """
-        # Get subnets from default VPC (AWS will pick one with capacity)
-        vpcs = self.ec2.describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['true']}])
-        if vpcs['Vpcs']:
-            vpc_id = vpcs['Vpcs'][0]['VpcId']
-            subnets = self.ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-            subnet_ids = [s['SubnetId'] for s in subnets['Subnets']]
-        else:
-            subnet_ids = []
+        min_count = count if min_count is None else max(1, min(min_count, count))
+        version = self.get_launch_template_version(template_id)
         
-        launch_params = {
-            'LaunchTemplate': {
-                'LaunchTemplateId': template_id,
-                'Version': '13'
-            },
-            'KeyName': key_name,
-            'MinCount': count,
-            'MaxCount': count,
-            'TagSpecifications': [{
-                'ResourceType': 'instance',
-                'Tags': [
-                    {'Key': 'DeploymentId', 'Value': deployment_id},
-                    {'Key': 'Name', 'Value': f'deployment-{deployment_id}'}
-                ]
-            }]
-        }
+        def run(subnet_id: Optional[str], max_count: int) -> List[str]:
+            launch_params = {
+                'LaunchTemplate': {
+                    'LaunchTemplateId': template_id,
+                    'Version': version
+                },
+                'KeyName': key_name,
+                'MinCount': 1,
+                'MaxCount': max_count,
+                'TagSpecifications': [{
+                    'ResourceType': 'instance',
+                    'Tags': [
+                        {'Key': 'DeploymentId', 'Value': deployment_id},
+                        {'Key': 'Name', 'Value': f'deployment-{deployment_id}'}
+                    ] + [{'Key': k, 'Value': v} for k, v in (extra_tags or {}).items()]
+                }]
+            }
+            if subnet_id:
+                launch_params['SubnetId'] = subnet_id
+            if image_id:
+                launch_params['ImageId'] = image_id
+            response = self.ec2.run_instances(**launch_params)
+            return [inst['InstanceId'] for inst in response['Instances']]
         
-        # If we found subnets, let AWS pick one by providing all options
-        if subnet_ids:
-            # Just pick the first available subnet - AWS will use it if it has capacity
-            launch_params['SubnetId'] = subnet_ids[0]
+        planner = LaunchPlanner(run, self.get_launch_subnets())
+        try:
+            instance_ids = planner.run(count, log_callback)
+        except Exception as e:
+            # Cached network/template metadata may be stale (e.g. deleted subnet)
+            if isinstance(e, ClientError) and e.response['Error']['Code'].startswith(
+                    ('InvalidSubnet', 'InvalidLaunchTemplate')):
+                self.cache.invalidate(prefix='subnets:')
+                self.cache.invalidate(prefix='template_version:')
+                self.cache.invalidate('default_vpc')
+            # Whatever failed (throttling, a network error, a bug), don't leave
+            # the instances launched so far running untracked
+            self.terminate_instances(planner.launched)
+            raise
         
-        response = self.ec2.run_instances(**launch_params)
-        return [inst['InstanceId'] for inst in response['Instances']]
+        if len(instance_ids) < min_count:
+            self.terminate_instances(instance_ids)
+            raise Exception(
+                f"Only {len(instance_ids)} of {count} instances could be launched "
+                f"(minimum {min_count}): " + "; ".join(planner.errors())
+            )
+        if len(instance_ids) < count and log_callback:
+            log_callback(f"Launched {len(instance_ids)} of {count} instances ({'; '.join(planner.errors())})")
+        return instance_ids
+    
+    def _map_chunks(self, fn: Callable[[List], object], items: List, size: int = INSTANCE_ID_BATCH_SIZE) -> List:
+        """
+        fn(chunk) for each chunk of at most size items, AWS_API_CONCURRENCY
+        chunks at a time; returns their results in order (and raises the
+        first error). boto3 clients are thread-safe.
+        """
+        chunks = chunked(items, size)
+        if len(chunks) <= 1:
+            return [fn(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=min(AWS_API_CONCURRENCY, len(chunks))) as pool:
+            return list(pool.map(fn, chunks))
+
+    def terminate_instances(self, instance_ids: List[str]) -> None:
+        """Best-effort termination of specific instances (e.g. from a launch that was given up on)"""
+        def terminate(chunk):
+            try:
+                self.ec2.terminate_instances(InstanceIds=chunk)
+            except ClientError as e:
+                print(f"Failed to terminate {len(chunk)} instances: {e}")
+        self._map_chunks(terminate, instance_ids, TERMINATE_BATCH_SIZE)
+    
+    def create_image(self, instance_id: str, name: str, tags: Dict[str, str]) -> str:
+        """Snapshot an instance into a new AMI with the given tags; returns the image ID"""
+        response = self.ec2.create_image(
+            InstanceId=instance_id,
+            Name=name,
+            TagSpecifications=[{
+                'ResourceType': 'image',
+                'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]
+            }]
+        )
+        return response['ImageId']
+    
+    def wait_for_image(self, image_id: str) -> None:
+        """Wait for an AMI to become available"""
+        waiter = self.ec2.get_waiter('image_available')
+        waiter.wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 120})
+    
+    def deregister_image(self, image_id: str) -> None:
+        """Deregister an AMI and delete the EBS snapshots behind it"""
+        images = self.ec2.describe_images(ImageIds=[image_id])['Images']
+        snapshot_ids = [
+            mapping['Ebs']['SnapshotId']
+            for image in images for mapping in image.get('BlockDeviceMappings', [])
+            if mapping.get('Ebs', {}).get('SnapshotId')
+        ]
+        self.ec2.deregister_image(ImageId=image_id)
+        for snapshot_id in snapshot_ids:
+            self.ec2.delete_snapshot(SnapshotId=snapshot_id)
+    
+    def find_images(self, tags: Dict[str, str]) -> List[Dict]:
+        """Available AMIs owned by this account with all the given tags, newest first"""
+        filters = [{'Name': f'tag:{k}', 'Values': [v]} for k, v in tags.items()]
+        filters.append({'Name': 'state', 'Values': ['available']})
+        images = []
+        for page in self.ec2.get_paginator('describe_images').paginate(Owners=['self'], Filters=filters):
+            images += page['Images']
+        return sorted(images, key=lambda i: i.get('CreationDate', ''), reverse=True)
+    
+    def find_instances(self, tags: Dict[str, str], states: List[str]) -> List[Dict]:
+        """Instances with all the given tags in one of the given states, as {'InstanceId', 'State', 'Tags'}"""
+        filters = [{'Name': f'tag:{k}', 'Values': [v]} for k, v in tags.items()]
+        filters.append({'Name': 'instance-state-name', 'Values': states})
+        result = []
+        paginator = self.ec2.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    result.append({
+                        'InstanceId': instance['InstanceId'],
+                        'State': instance['State']['Name'],
+                        'Tags': {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                    })
+        return result
+    
+    def tag_instances(self, instance_ids: List[str], tags: Dict[str, str]) -> None:
+        """Set (overwrite) tags on instances"""
+        tag_list = [{'Key': k, 'Value': v} for k, v in tags.items()]
+        self._map_chunks(lambda chunk: self.ec2.create_tags(Resources=chunk, Tags=tag_list), instance_ids)
+    
+    def untag_instances(self, instance_ids: List[str], keys: List[str]) -> None:
+        """Remove tags (whatever their value) from instances"""
+        tag_list = [{'Key': k} for k in keys]
+        self._map_chunks(lambda chunk: self.ec2.delete_tags(Resources=chunk, Tags=tag_list), instance_ids)
+    
+    def start_instances(self, instance_ids: List[str]) -> None:
+        self._map_chunks(lambda chunk: self.ec2.start_instances(InstanceIds=chunk), instance_ids)
+    
+    def stop_instances(self, instance_ids: List[str], wait: bool = False) -> None:
+        """Stop instances, optionally waiting until they are stopped"""
+        self._map_chunks(lambda chunk: self.ec2.stop_instances(InstanceIds=chunk), instance_ids)
+        if wait:
+            self._wait(instance_ids, 'instance_stopped')
     
     def wait_for_running(self, instance_ids: List[str]) -> None:
         """Wait for all instances to reach running state"""
-        waiter = self.ec2.get_waiter('instance_running')
-        waiter.wait(InstanceIds=instance_ids)
+        self._wait(instance_ids, 'instance_running')
+    
+    def _wait(self, instance_ids: List[str], waiter_name: str) -> None:
+        """Run an instance waiter on bounded chunks of instance_ids, side by side"""
+        self._map_chunks(lambda chunk: self.ec2.get_waiter(waiter_name).wait(InstanceIds=chunk), instance_ids)
     
     def get_instance_ips(self, instance_ids: List[str]) -> Dict[str, str]:
         """
         Get public IPs for instances.
-        Returns dict of {instance_id: public_ip}
+        Returns dict of {instance_id: public_ip}; instances without a
+        public IP (yet) are left out.
         """
-        response = self.ec2.describe_instances(InstanceIds=instance_ids)
+        def describe(chunk):
+            ips = {}
+            response = self.ec2.describe_instances(InstanceIds=chunk)
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    if instance.get('PublicIpAddress'):
+                        ips[instance['InstanceId']] = instance['PublicIpAddress']
+            return ips
         result = {}
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                result[instance['InstanceId']] = instance['PublicIpAddress']
+        for ips in self._map_chunks(describe, instance_ids):
+            result.update(ips)
         return result
     
     def terminate_deployment(self, deployment_id: str) -> List[str]:
@@ -77,37 +300,86 @@ class AWSClient:
         Find all instances with DeploymentId tag and terminate them.
         Returns list of terminated instance IDs.
         """
-        response = self.ec2.describe_instances(
-            Filters=[{
-                'Name': 'tag:DeploymentId',
-                'Values': [deployment_id]
-            }, {
-                'Name': 'instance-state-name',
-                'Values': ['pending', 'running', 'stopping', 'stopped']
-            }]
-        )
-        
-        instance_ids = []
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instance_ids.append(instance['InstanceId'])
-        
-        if instance_ids:
-            # Actually terminate
-            terminate_response = self.ec2.terminate_instances(InstanceIds=instance_ids)
-            
-            # Verify the termination request was accepted
-            successfully_terminated = [
-                inst['InstanceId'] 
-                for inst in terminate_response['TerminatingInstances']
-                if inst['CurrentState']['Name'] in ['shutting-down', 'terminated']
+        terminated, errors = self.terminate_deployments([deployment_id])
+        if deployment_id in errors:
+            raise Exception(errors[deployment_id])
+        return terminated[deployment_id]
+
+    def terminate_deployments(self, deployment_ids: List[str]) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+        """
+        Terminate the instances of many deployments at once: one paginated,
+        filtered describe (per FILTER_VALUES_LIMIT deployments) finds them
+        all, and they are terminated TERMINATE_BATCH_SIZE at a time (chunks
+        run concurrently).
+        Returns ({deployment_id: terminated instance IDs}, {deployment_id: error})
+        for the deployments some of whose instances could not be terminated.
+        """
+        def describe(chunk):
+            owned = {}  # instance_id -> deployment_id
+            filters = [
+                {'Name': 'tag:DeploymentId', 'Values': chunk},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
             ]
-            
-            return successfully_terminated
-        
-        return []
+            for page in self.ec2.get_paginator('describe_instances').paginate(Filters=filters):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                        owned[instance['InstanceId']] = tags.get('DeploymentId')
+            return owned
+
+        owners: Dict[str, str] = {}
+        for owned in self._map_chunks(describe, deployment_ids, FILTER_VALUES_LIMIT):
+            owners.update(owned)
+
+        def terminate(chunk):
+            try:
+                return self.ec2.terminate_instances(InstanceIds=chunk)['TerminatingInstances'], None
+            except ClientError as e:
+                # A failed call terminates none of its instances
+                print(f"Failed to terminate {len(chunk)} instances: {e}")
+                return [], str(e)
+
+        terminated: Dict[str, List[str]] = {dep_id: [] for dep_id in deployment_ids}
+        errors: Dict[str, str] = {}
+        instance_ids = list(owners)
+        for chunk, (terminating, error) in zip(chunked(instance_ids, TERMINATE_BATCH_SIZE),
+                                               self._map_chunks(terminate, instance_ids, TERMINATE_BATCH_SIZE)):
+            for instance_id in chunk if error else []:
+                errors[owners[instance_id]] = error
+            # Verify the termination request was accepted
+            for inst in terminating:
+                if inst['CurrentState']['Name'] in ['shutting-down', 'terminated']:
+                    terminated[owners[inst['InstanceId']]].append(inst['InstanceId'])
+        return terminated, errors
+    
+    def get_instance_status(self, instance_ids: List[str]) -> Dict[str, Dict]:
+        """
+        State and status checks for many instances, in concurrent batched calls.
+        Returns {instance_id: {'state': 'pending'|'running'|..., 'status_ok': bool}};
+        instances EC2 doesn't know about yet (right after launch) are left out.
+        """
+        def describe(chunk):
+            try:
+                response = self.ec2.describe_instance_status(InstanceIds=chunk, IncludeAllInstances=True)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                # Eventual consistency just after run_instances: ask again next round
+                return {}
+            return {
+                status['InstanceId']: {
+                    'state': status['InstanceState']['Name'],
+                    'status_ok': (
+                        status.get('InstanceStatus', {}).get('Status') == 'ok'
+                        and status.get('SystemStatus', {}).get('Status') == 'ok'
+                    )
+                } for status in response['InstanceStatuses']
+            }
+        result = {}
+        for statuses in self._map_chunks(describe, instance_ids):
+            result.update(statuses)
+        return result
     
     def wait_for_status_ok(self, instance_ids: List[str]) -> None:
         """Wait for all instances to pass status checks (2/2 checks)"""
-        waiter = self.ec2.get_waiter('instance_status_ok')
-        waiter.wait(InstanceIds=instance_ids)
\ No newline at end of file
+        self._wait(instance_ids, 'instance_status_ok')
\ No newline at end of file
@@ -1,25 +1,99 @@
+import math
 import random
 import time
 import os
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import threading
+from log_writer import LogWriter, close_log_writer, get_log_writer
+from metrics import Timings, PHASE_SECONDS, retries_so_far
+from fanout import FanOut, HostResult, describe_failures, DEFAULT_MAX_CONCURRENCY
 from ssh_runner import SSHRunner
 from aws_client import AWSClient
+from readiness import InstanceReadinessTracker, FAILED_STATES
+from ssh_probe import SSHProbe
+from image_baker import ImageBaker
+from warm_pool import WarmPoolManager
+from wheelhouse import Wheelhouse, PACKAGE_REPO, PACKAGE_REF, resolve_commit
+from ssh_mux import CommandCancelled
+from botocore.exceptions import ClientError
 from storage import Storage
 
+WORKER_SETUP_CONCURRENCY = int(os.getenv('WORKER_SETUP_CONCURRENCY', str(DEFAULT_MAX_CONCURRENCY)))
+WORKER_SETUP_TIMEOUT = float(os.getenv('WORKER_SETUP_TIMEOUT', '1800'))
+# 'ssh': set a node up once it answers on port 22; 'status_ok': wait for EC2's 2/2 checks
+READINESS_MODE = os.getenv('READINESS_MODE', 'ssh')
+SSH_PROBE_DEADLINE = float(os.getenv('SSH_PROBE_DEADLINE', '600'))
+# Share of the requested instances that must launch for a deployment to go ahead
+LAUNCH_MIN_FRACTION = float(os.getenv('LAUNCH_MIN_FRACTION', '1.0'))
+# 'auto': boot from a baked image and re-bake when the setup commands (or the
+# package commit) change, deregistering the old image; 'use': boot from a
+# matching image but never bake one; 'off' (default): always install
+GOLDEN_IMAGE = os.getenv('GOLDEN_IMAGE', 'off')
+# Installed, stopped instances kept ready per template/key/setup (0 disables the pool)
+WARM_POOL_SIZE = int(os.getenv('WARM_POOL_SIZE', '0'))
+WARM_POOL_LOG = "~/.aws-deployment-manager/logs/warm-pool.log"
+# Build scalable_docker's wheels once per commit and install them offline on every node
+WHEELHOUSE = os.getenv('WHEELHOUSE', '1') == '1'
+# Seconds a worker being scaled in (or restarted in a rolling restart) gets to
+# finish its running containers
+WORKER_DRAIN_TIMEOUT = float(os.getenv('WORKER_DRAIN_TIMEOUT', '300'))
+# Workers per batch for rolling restarts (0: a quarter of the workers)
+RESTART_BATCH_SIZE = int(os.getenv('RESTART_BATCH_SIZE', '0'))
+# Compose projects torn down at once on each worker during a restart
+COMPOSE_TEARDOWN_PARALLELISM = int(os.getenv('COMPOSE_TEARDOWN_PARALLELISM', '8'))
+# Which scalable_docker commit a node has installed (read by the setup probes)
+COMMIT_MARKER = "~/.scalable_docker_commit"
+
+# Timing phase recorded for each per-node setup step
+STEP_PHASES = {
+    'deps_installed': 'install',
+    'worker_started': 'start',
+    'healthy': 'health',
+    'head_installed': 'head_install',
+}
+# Most timing spans kept per deployment (the oldest are dropped)
+MAX_TIMING_SPANS = 5000
+
+# Deployments whose setup, resume or scaling is running in this process
+_active_setups = set()
+_active_lock = threading.Lock()
+
+def setup_in_progress(deployment_id: str) -> bool:
+    """True while the deployment is being launched, resumed or scaled by this process"""
+    with _active_lock:
+        return deployment_id in _active_setups
+
+def _end_setup(deployment_id: str):
+    with _active_lock:
+        _active_setups.discard(deployment_id)
+
+class HeadStartError(Exception):
+    """Restarting the head server failed, so it may be down"""
+
+# Per-deployment timing spans, shared by every manager in the process
+_timings: Dict[str, Timings] = {}
+_timings_lock = threading.Lock()
+
 class DeploymentManager:
     def __init__(self, aws_client: AWSClient, ssh_runner: SSHRunner, storage: Storage):
         self.aws = aws_client
         self.ssh = ssh_runner
         self.storage = storage
+        self.baker = ImageBaker(aws_client, storage)
+        self.pool = WarmPoolManager(aws_client, WARM_POOL_SIZE)
     
     def launch_deployment(self, count: int, key_name: str, 
-                         name: str = None) -> str:
+                         name: str = None, min_count: int = None) -> str:
         """
         Launch a new deployment asynchronously.
+        It goes ahead with as few as min_count instances if EC2 runs out of
+        capacity (default: LAUNCH_MIN_FRACTION of count).
         Returns deployment ID immediately.
         """
+        if min_count is None:
+            min_count = math.ceil(count * LAUNCH_MIN_FRACTION)
+        min_count = max(1, min(min_count, count))
         deployment_id = f"dep-{int(time.time())}"
         
         deployment = {
@@ -30,150 +104,762 @@ class DeploymentManager:
             'key_name': key_name,
             'head': None,
             'workers': [],
-            'log_file': f"~/.aws-deployment-manager/logs/{deployment_id}.log"
+            'requested_count': count,
+            'log_file': self.log_path(deployment_id)
         }
         
         self.storage.save_deployment(deployment)
+        with _active_lock:
+            _active_setups.add(deployment_id)
         
         # Run setup in background
         thread = threading.Thread(
             target=self._setup_deployment,
-            args=(deployment_id, count, key_name)
+            args=(deployment_id, count, key_name, min_count)
         )
         thread.daemon = True
         thread.start()
         
         return deployment_id
     
-    def _setup_deployment(self, deployment_id: str, count: int, key_name: str):
+    def _setup_deployment(self, deployment_id: str, count: int, key_name: str, min_count: int = None):
         """Background task to set up deployment"""
+        log_callback = self._make_log_callback(deployment_id)
+        timings = self._timings(deployment_id)
+        started_at, start, ok = datetime.utcnow(), time.monotonic(), False
         try:
-            deployment = self.storage.get_deployment(deployment_id)
-            log_callback = self._make_log_callback(deployment_id)
-            
-            # Step 1: Launch instances
-            log_callback("Launching EC2 instances...")
-            instance_ids = self.aws.launch_instances(
-                template_id=os.getenv('LAUNCH_TEMPLATE_ID'),
-                count=count,
-                key_name=key_name,
-                deployment_id=deployment_id
-            )
-            deployment['status'] = 'waiting_for_ips'
-            self.storage.save_deployment(deployment)
-            
-            # Step 2: Wait for running state and get IPs
-            log_callback(f"Waiting for {count} instances to reach running state...")
-            self.aws.wait_for_running(instance_ids)
-            
-            log_callback("Getting instance IPs...")
-            ip_map = self.aws.get_instance_ips(instance_ids)
-            
-            # NEW: Wait for instances to pass status checks (SSH will be ready)
-            log_callback("Waiting for instances to pass status checks...")
-            self.aws.wait_for_status_ok(instance_ids)
+            # Step 1: Claim warm-pool instances and launch the rest
+            # (from the baked image if there is one)
+            with timings.span('run_instances', count=count) as span:
+                instance_ids, preinstalled, image_id = self._acquire_instances(
+                    deployment_id, count, key_name, min_count or count, log_callback
+                )
+                span['launched'] = len(instance_ids)
+            self.storage.update_deployment(deployment_id, status='waiting_for_ips', instance_ids=instance_ids,
+                                           image_id=image_id)
+            self._checkpoint(deployment_id, instance_ids, 'launched')
             
-            # Step 3: Pick random head
-            instance_items = list(ip_map.items())
-            random.shuffle(instance_items)
-            head_id, head_ip = instance_items[0]
-            workers = instance_items[1:]
-            
-            deployment['head'] = {
-                'instance_id': head_id,
-                'ip': head_ip
-            }
-            deployment['workers'] = [
-                {'instance_id': wid, 'ip': wip} 
-                for wid, wip in workers
-            ]
-            deployment['status'] = 'setting_up'
-            self.storage.save_deployment(deployment)
-            
-            log_callback(f"Head node: {head_ip}")
-            log_callback(f"Worker nodes: {', '.join(wip for _, wip in workers)}")
-            
-            # Step 4: Set up workers per-worker (install then start), in parallel across workers
-            log_callback("Setting up worker nodes (installing dependencies)...")
-            worker_threads = []
-
-            def setup_single_worker(worker_ip: str):
-                # Install dependencies (blocking)
-                install_cmd = self._get_worker_setup_command_1()
-                rc = self.ssh.run_command(worker_ip, install_cmd, log_callback, use_pty=False, background=False)
-                if rc != 0:
-                    raise Exception(f"[{worker_ip}] Worker dependency installation failed with exit code {rc}")
-
-                # Start worker server (remote background via nohup)
-                if log_callback:
-                    log_callback(f"[{worker_ip}] Starting worker server...")
-                start_cmd = self._get_worker_setup_command_2()
-                rc_start = self.ssh.run_command(worker_ip, start_cmd, log_callback, use_pty=False, background=False)
-                if rc_start != 0 and log_callback:
-                    log_callback(f"[{worker_ip}] Warning: start command exit code {rc_start}")
-
-                # Wait for worker to become healthy before proceeding
-                if log_callback:
-                    log_callback(f"[{worker_ip}] Waiting for worker health...")
-                health_cmd = self._get_worker_health_check_command()
-                rc_health = self.ssh.run_command(worker_ip, health_cmd, log_callback, use_pty=False, background=False)
-                if rc_health != 0:
-                    raise Exception(f"[{worker_ip}] Worker failed to become healthy after start (exit {rc_health})")
-
-            for _, worker_ip in workers:
-                t = threading.Thread(target=setup_single_worker, args=(worker_ip,))
-                t.start()
-                worker_threads.append(t)
-
-            # Wait for all workers to finish their per-worker sequence (mirrors `wait`)
-            for t in worker_threads:
-                t.join()
-
-            # Step 5: Set up head node
-            log_callback("Setting up head node...")
-            worker_ips = [wip for _, wip in workers]
-            comma_separated_urls = ','.join(
-                f"http://{ip}:8080" for ip in worker_ips
-            )
-            # Split head setup into install (blocking) and start (nohup)
-            head_install_cmd = self._get_head_setup_install_command()
-            rc_head_install = self.ssh.run_command(head_ip, head_install_cmd, log_callback, use_pty=False, background=False)
-            if rc_head_install != 0:
-                raise Exception(f"[{head_ip}] Head install failed with exit code {rc_head_install}")
-
-            head_start_cmd = self._get_head_setup_start_command(comma_separated_urls)
-            self.ssh.run_command(head_ip, head_start_cmd, log_callback, use_pty=False, background=False)
+            # Step 2: Pick random head up front, so each node can be set up
+            # the moment it is ready instead of after the whole fleet
+            head_id = random.choice(instance_ids)
+            self._converge(deployment_id, instance_ids, head_id, preinstalled, log_callback)
             
             # Done!
-            deployment['status'] = 'running'
-            self.storage.save_deployment(deployment)
+            self.storage.update_deployment(deployment_id, status='running')
             log_callback("✓ Deployment complete!")
+            ok = True
             
         except Exception as e:
             log_callback(f"ERROR: {str(e)}")
+            self.storage.update_deployment(deployment_id, status='failed')
+        finally:
+            timings.add('setup', time.monotonic() - start, ok=ok, started_at=started_at, count=count)
+            self._finish_timings(deployment_id)
+            self._close_log(deployment_id)
+            _end_setup(deployment_id)
+
+    def resume_deployment(self, deployment_id: str, wait: bool = False) -> None:
+        """
+        Continue a deployment from its last good step, in the background
+        (or on this thread with wait=True, e.g. from a job).
+        Dead instances are replaced; every other node re-runs its setup
+        steps, each of which is skipped if a quick probe shows it is done.
+        """
+        deployment = self.storage.get_deployment(deployment_id)
+        if not deployment:
+            raise Exception("Deployment not found")
+        if deployment['status'] in ('terminating', 'terminated'):
+            raise Exception(f"Deployment is {deployment['status']}")
+        if not deployment.get('instance_ids'):
+            raise Exception("Deployment has no instances to resume; launch a new one instead")
+        with _active_lock:
+            if deployment_id in _active_setups:
+                raise Exception("Deployment setup is already in progress")
+            _active_setups.add(deployment_id)
+        self.storage.update_deployment(deployment_id, status='resuming')
+
+        if wait:
+            if not self._resume_deployment(deployment_id):
+                raise Exception("Resume failed; see the deployment log")
+            return
+        thread = threading.Thread(target=self._resume_deployment, args=(deployment_id,))
+        thread.daemon = True
+        thread.start()
+
+    def _resume_deployment(self, deployment_id: str) -> bool:
+        log_callback = self._make_log_callback(deployment_id)
+        try:
             deployment = self.storage.get_deployment(deployment_id)
-            deployment['status'] = 'failed'
-            self.storage.save_deployment(deployment)
-    
-    def _make_log_callback(self, deployment_id: str):
-        """Create a callback that logs to file"""
-        log_file = os.path.expanduser(
-            f"~/.aws-deployment-manager/logs/{deployment_id}.log"
+            log_callback("Resuming deployment...")
+            instance_ids = list(deployment['instance_ids'])
+            statuses = self.aws.get_instance_status(instance_ids)
+            for iid in instance_ids:
+                if iid not in statuses:
+                    # One unknown ID hides its whole batch; ask about the rest one by one
+                    statuses.update(self.aws.get_instance_status([iid]))
+            dead = [iid for iid in instance_ids if statuses.get(iid, {}).get('state', 'terminated') in FAILED_STATES]
+            alive = [iid for iid in instance_ids if iid not in dead]
+            preinstalled = set()
+
+            if dead:
+                log_callback(f"Replacing {len(dead)} dead instances: {', '.join(dead)}")
+                self.aws.terminate_instances(dead)
+                image_id = self._golden_image(deployment['key_name'], log_callback)
+                with self._timings(deployment_id).span('run_instances', count=len(dead)):
+                    replacements, image_id = self._launch_fresh(len(dead), deployment['key_name'], deployment_id,
+                                                                len(dead), log_callback, image_id)
+                if image_id:
+                    preinstalled.update(replacements)
+                instance_ids = alive + replacements
+
+                def replace(dep):
+                    dep['instance_ids'] = instance_ids
+                    for iid in dead:
+                        (dep.get('checkpoints') or {}).pop(iid, None)
+                self.storage.mutate_deployment(deployment_id, replace)
+                self._checkpoint(deployment_id, replacements, 'launched')
+
+            head_id = (deployment.get('head') or {}).get('instance_id')
+            if head_id not in instance_ids:
+                head_id = alive[0] if alive else instance_ids[0]
+                log_callback(f"Head instance is gone; {head_id} becomes the new head")
+            self._converge(deployment_id, instance_ids, head_id, preinstalled, log_callback)
+
+            self.storage.update_deployment(deployment_id, status='running')
+            log_callback("✓ Deployment resumed and complete!")
+            return True
+        except Exception as e:
+            log_callback(f"ERROR: {str(e)}")
+            self.storage.update_deployment(deployment_id, status='failed')
+            return False
+        finally:
+            self._finish_timings(deployment_id)
+            self._close_log(deployment_id)
+            _end_setup(deployment_id)
+
+    def _converge(self, deployment_id: str, instance_ids: List[str], head_id: str,
+                  preinstalled: set, log_callback, keep_workers: List[Tuple[str, str]] = ()):
+        """
+        Bring every node to its final state: set each one up as soon as it
+        is ready, then start the head with all workers. Every step records a
+        checkpoint and is skipped if its probe shows it is already done, so
+        this is also how a failed deployment is resumed.
+        keep_workers: (instance_id, ip) of running workers that are left
+        alone but stay in the head's worker list (when scaling out).
+        """
+        timings = self._timings(deployment_id)
+        commit = resolve_commit()
+        wheelhouse = None
+        if not preinstalled.issuperset(instance_ids):
+            wheelhouse = self._wheelhouse(commit, log_callback)
+
+        workers = list(keep_workers)
+        worker_count = len(workers) + len([iid for iid in instance_ids if iid != head_id])
+        head_ip = None
+        if head_id not in instance_ids:
+            head_ip = (self.storage.get_deployment(deployment_id).get('head') or {}).get('ip')
+        
+        def report_node(result: HostResult):
+            timings.add('node_setup', result.duration, host=result.host, ok=result.ok, status=result.status)
+            if not result.ok and result.status != 'cancelled':
+                log_callback(f"[{result.host}] Setup {result.status}: {result.error}")
+
+        # Bounded fan-out; the first failed node cancels the others
+        setup_fanout = FanOut(
+            max_concurrency=WORKER_SETUP_CONCURRENCY,
+            host_timeout=WORKER_SETUP_TIMEOUT,
+            fail_fast=True,
+            on_result=report_node
         )
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
         
-        def callback(message: str):
-            timestamp = datetime.utcnow().isoformat()
-            log_line = f"[{timestamp}] {message}\n"
-            
-            # Write to file
-            with open(log_file, 'a') as f:
-                f.write(log_line)
-            
-        return callback
+        def on_instance_ready(instance_id: str, ip: str):
+            nonlocal head_ip
+            role = 'head' if instance_id == head_id else 'worker'
+            self._checkpoint(deployment_id, [instance_id], 'running', ip=ip, role=role)
+            if instance_id == head_id:
+                head_ip = ip
+                log_callback(f"Head node: {head_ip}")
+                self.storage.update_deployment(
+                    deployment_id,
+                    head={'instance_id': head_id, 'ip': head_ip},
+                    status='setting_up'
+                )
+                # Install only; the head starts once every worker is healthy
+                setup_fanout.submit(ip, lambda cancel_event: self._install_head(
+                    ip, log_callback, cancel_event, installed=instance_id in preinstalled,
+                    wheelhouse=wheelhouse, commit=commit,
+                    checkpoint=self._step_recorder(deployment_id, instance_id, ip, timings)))
+            else:
+                workers.append((instance_id, ip))
+                log_callback(f"Worker node ready ({len(workers)}/{worker_count}): {ip}")
+                self.storage.update_deployment(
+                    deployment_id,
+                    workers=[{'instance_id': wid, 'ip': wip} for wid, wip in workers],
+                    status='setting_up'
+                )
+                setup_fanout.submit(ip, lambda cancel_event: self._setup_worker(
+                    ip, log_callback, cancel_event, installed=instance_id in preinstalled,
+                    wheelhouse=wheelhouse, commit=commit,
+                    checkpoint=self._step_recorder(deployment_id, instance_id, ip, timings)))
+        
+        # Step 3: Set up each node as soon as it is ready
+        try:
+            self._wait_until_ready(instance_ids, on_instance_ready, log_callback,
+                                   stop_event=setup_fanout.cancel_event, timings=timings)
+        except Exception:
+            setup_fanout.cancel()
+            setup_fanout.wait()
+            raise
+
+        # Step 4: Wait for all nodes to finish their per-node sequence (mirrors `wait`)
+        failures = describe_failures(setup_fanout.wait())
+        if failures:
+            raise Exception(f"Node setup failed:\n{failures}")
+
+        # Step 5: Start head node (already installed above)
+        self._start_head(deployment_id, head_id, head_ip, [wip for _, wip in workers], log_callback)
+
+    def scale_deployment(self, deployment_id: str, add: int = 0, remove: List[str] = None,
+                         wait: bool = False) -> None:
+        """
+        Add `add` workers to a running deployment, or drain and terminate
+        the workers in `remove` (instance IDs or IPs), in the background
+        (or on this thread with wait=True).
+        Other workers keep running; only the head is restarted with the
+        new worker list.
+        """
+        deployment = self.storage.get_deployment(deployment_id)
+        if not deployment:
+            raise Exception("Deployment not found")
+        if add < 0:
+            raise Exception("add must not be negative")
+        if bool(add) == bool(remove):
+            raise Exception("Give either a number of workers to add or the workers to remove")
+        if deployment['status'] != 'running':
+            raise Exception(f"Only running deployments can be scaled (this one is {deployment['status']})")
+        head = deployment.get('head') or {}
+        if not head.get('ip'):
+            raise Exception("Head IP not found for deployment")
+        removed = []
+        for ref in remove or []:
+            match = [w['instance_id'] for w in deployment.get('workers', []) if ref in (w['instance_id'], w['ip'])]
+            if not match:
+                if ref in (head.get('instance_id'), head.get('ip')):
+                    raise Exception("The head node cannot be removed")
+                raise Exception(f"{ref} is not a worker of this deployment")
+            removed += match
+        with _active_lock:
+            if deployment_id in _active_setups:
+                raise Exception("Deployment setup is already in progress")
+            _active_setups.add(deployment_id)
+        self.storage.update_deployment(deployment_id, status='scaling')
+
+        if wait:
+            error = self._scale_deployment(deployment_id, add, removed)
+            if error:
+                raise Exception(f"Scaling failed: {error}")
+            return
+        thread = threading.Thread(target=self._scale_deployment, args=(deployment_id, add, removed))
+        thread.daemon = True
+        thread.start()
+
+    def _scale_deployment(self, deployment_id: str, add: int, remove: List[str]) -> Optional[str]:
+        """
+        Returns None on success, else the error. The deployment only ends up
+        'failed' if the head could not be restarted; other errors (e.g. no
+        capacity for the new workers) leave the head and the remaining
+        workers serving, so it goes back to 'running'.
+        """
+        log_callback = self._make_log_callback(deployment_id)
+        workers = self.storage.get_deployment(deployment_id).get('workers', [])
+        try:
+            if add:
+                self._scale_out(deployment_id, add, log_callback)
+            else:
+                self._scale_in(deployment_id, remove, log_callback)
+            self.storage.update_deployment(deployment_id, status='running')
+            workers = self.storage.get_deployment(deployment_id).get('workers', [])
+            log_callback(f"✓ Scaling complete: {len(workers)} workers")
+            return None
+        except HeadStartError as e:
+            log_callback(f"ERROR: {str(e)}")
+            self.storage.update_deployment(deployment_id, status='failed')
+            return str(e)
+        except Exception as e:
+            log_callback(f"ERROR: {str(e)}")
+            if add:
+                # Raised before the head was pointed at the new workers
+                log_callback("Existing nodes are unchanged; the deployment keeps running without the new workers")
+                self.storage.update_deployment(deployment_id, status='running', workers=workers)
+            else:
+                # The head already runs without the removed workers
+                self.storage.update_deployment(deployment_id, status='running')
+            return str(e)
+        finally:
+            self._finish_timings(deployment_id)
+            self._close_log(deployment_id)
+            _end_setup(deployment_id)
+
+    def _scale_out(self, deployment_id: str, add: int, log_callback):
+        """Launch and set up `add` new workers, then point the head at all workers"""
+        deployment = self.storage.get_deployment(deployment_id)
+        log_callback(f"Scaling out: adding {add} workers...")
+        with self._timings(deployment_id).span('run_instances', count=add):
+            new_ids, preinstalled, _ = self._acquire_instances(
+                deployment_id, add, deployment['key_name'], math.ceil(add * LAUNCH_MIN_FRACTION), log_callback
+            )
+        # Record the new instances first, so a failure below can be resumed
+        # (or the instances cleaned up on delete)
+        self.storage.mutate_deployment(
+            deployment_id, lambda dep: dep.update(instance_ids=dep.get('instance_ids', []) + new_ids)
+        )
+        self._checkpoint(deployment_id, new_ids, 'launched')
+        keep = [(w['instance_id'], w['ip']) for w in deployment.get('workers', [])]
+        self._converge(deployment_id, new_ids, deployment['head']['instance_id'], preinstalled,
+                       log_callback, keep_workers=keep)
+
+    def _scale_in(self, deployment_id: str, remove: List[str], log_callback):
+        """
+        Drain and terminate workers: take them out of the head's worker list
+        first (so no new work goes to them), let their containers finish,
+        then terminate them.
+        """
+        deployment = self.storage.get_deployment(deployment_id)
+        leaving = [w for w in deployment.get('workers', []) if w['instance_id'] in remove]
+        staying = [w for w in deployment.get('workers', []) if w['instance_id'] not in remove]
+        log_callback(f"Scaling in: removing {len(leaving)} workers ({', '.join(w['ip'] for w in leaving)})...")
+
+        self.storage.update_deployment(deployment_id, workers=staying)
+        head = deployment['head']
+        self._start_head(deployment_id, head['instance_id'], head['ip'], [w['ip'] for w in staying], log_callback)
+
+        log_callback("Draining removed workers...")
+        with self._timings(deployment_id).span('drain', workers=len(leaving)):
+            self._drain_workers([w['ip'] for w in leaving], log_callback)
+        self.aws.terminate_instances([w['instance_id'] for w in leaving])
+
+        def forget(dep):
+            dep['instance_ids'] = [iid for iid in dep.get('instance_ids', []) if iid not in remove]
+            for iid in remove:
+                (dep.get('checkpoints') or {}).pop(iid, None)
+        self.storage.mutate_deployment(deployment_id, forget)
+
+    def _start_head(self, deployment_id: str, head_id: str, head_ip: str, worker_ips: List[str], log_callback):
+        """
+        Start the head server for worker_ips, unless it already runs with
+        exactly those workers. Raises HeadStartError if that fails.
+        """
+        comma_separated_urls = ','.join(
+            f"http://{ip}:8080" for ip in worker_ips
+        )
+        deployment = self.storage.get_deployment(deployment_id) or {}
+        node = (deployment.get('checkpoints') or {}).get(head_id) or {}
+        if (node.get('worker_urls') == comma_separated_urls and 'head_started' in node.get('steps', {})
+                and self._probe(head_ip, self._get_head_process_probe_command())):
+            log_callback(f"[{head_ip}] Head server already running with these workers")
+            return
+        log_callback("Starting head node...")
+        with self._timings(deployment_id).span('head_start', host=head_ip, workers=len(worker_ips)):
+            try:
+                self.ssh.run_command(head_ip, "pkill -9 -f 'scalable_docker\\.head_server' || true", log_callback,
+                                     use_pty=False, background=False)
+                head_start_cmd = self._get_head_setup_start_command(comma_separated_urls)
+                self.ssh.run_command(head_ip, head_start_cmd, log_callback, use_pty=False, background=False)
+            except Exception as e:
+                raise HeadStartError(f"[{head_ip}] Head server restart failed: {e}") from e
+        self._checkpoint(deployment_id, [head_id], 'head_started', worker_urls=comma_separated_urls)
+
+    def _checkpoint(self, deployment_id: str, instance_ids: List[str], step: str, **fields):
+        """
+        Record that nodes finished a setup step, in the deployment's
+        checkpoints: {instance_id: {'steps': {step: time}, 'ip', 'role', ...}}
+        """
+        now = datetime.utcnow().isoformat() + 'Z'
+        def mutate(deployment):
+            checkpoints = deployment.setdefault('checkpoints', {})
+            for instance_id in instance_ids:
+                node = checkpoints.setdefault(instance_id, {'steps': {}})
+                node.update(fields)
+                node['steps'][step] = now
+        self.storage.mutate_deployment(deployment_id, mutate)
+
+    def _step_recorder(self, deployment_id: str, instance_id: str, ip: str,
+                       timings: Timings) -> Callable[[str], None]:
+        """
+        checkpoint(step) for one node, which also records how long the step
+        took (since the previous step, or since this was called) and how
+        many SSH retries to the node it needed
+        """
+        clock = {'start': time.monotonic(), 'at': datetime.utcnow(), 'retries': retries_so_far(ip)}
+        def checkpoint(step: str):
+            now, retries = time.monotonic(), retries_so_far(ip)
+            timings.add(STEP_PHASES.get(step, step), now - clock['start'], host=ip, started_at=clock['at'],
+                        retries=retries - clock['retries'])
+            clock.update(start=now, at=datetime.utcnow(), retries=retries)
+            self._checkpoint(deployment_id, [instance_id], step)
+        return checkpoint
+
+    def _timings(self, deployment_id: str) -> Timings:
+        """The process-wide timing spans of a deployment, saved in storage's timings table"""
+        def persist(spans: List[Dict]):
+            self.storage.add_timings(deployment_id, spans, keep=MAX_TIMING_SPANS)
+        with _timings_lock:
+            timings = _timings.get(deployment_id)
+            if timings is None:
+                timings = Timings(persist)
+                _timings[deployment_id] = timings
+            return timings
+
+    def _finish_timings(self, deployment_id: str):
+        """At the end of an operation: save the deployment's pending spans and stop keeping them in memory"""
+        with _timings_lock:
+            timings = _timings.pop(deployment_id, None)
+        if timings is not None:
+            timings.flush()
+
+    def _probe(self, ip: str, command: str, cancel_event: threading.Event = None) -> bool:
+        """True if a quick check command succeeds on the node (i.e. a step is already done)"""
+        rc, _ = self.ssh.run_capture(ip, command, cancel_event, timeout=60)
+        return rc == 0
+
+    def _mark_commit(self, ip: str, commit: str, cancel_event: threading.Event = None):
+        """Remember which scalable_docker commit the node has, for later probes"""
+        if commit:
+            self.ssh.run_capture(ip, f"echo {commit} > {COMMIT_MARKER}", cancel_event)
     
-    def _get_worker_setup_command_1(self) -> str:
+    def _acquire_instances(self, deployment_id: str, count: int, key_name: str, min_count: int,
+                           log_callback) -> Tuple[List[str], set, str]:
+        """
+        Instances for a new deployment: warm-pool members first, fresh
+        launches for the remainder. Refills the pool in the background.
+        Returns (instance_ids, ids that need no installation, image_id of the fresh ones).
+        """
+        template_id = os.getenv('LAUNCH_TEMPLATE_ID')
+        commit = resolve_commit()
+        setup_hash = self.setup_hash(commit)
+        pool_key = WarmPoolManager.pool_key(template_id, key_name, setup_hash)
+        claimed = []
+        if WARM_POOL_SIZE > 0:
+            try:
+                claimed = self.pool.claim(count, pool_key, deployment_id)
+            except ClientError as e:
+                log_callback(f"Warning: could not claim warm-pool instances: {e}")
+            if claimed:
+                log_callback(f"Claimed {len(claimed)} warm-pool instances: {', '.join(claimed)}")
+
+        preinstalled = set(claimed)
+        instance_ids = list(claimed)
+        image_id = None
+        remaining = count - len(claimed)
+        if remaining > 0:
+            image_id = self._golden_image(key_name, log_callback)
+            log_callback(f"Launching {remaining} EC2 instances...")
+            try:
+                fresh, image_id = self._launch_fresh(remaining, key_name, deployment_id,
+                                                     max(1, min_count - len(claimed)), log_callback, image_id)
+            except Exception as e:
+                if len(claimed) < min_count:
+                    raise
+                log_callback(f"Warning: launching the remaining {remaining} instances failed ({e}); "
+                             f"continuing with {len(claimed)} warm-pool instances")
+                fresh = []
+            instance_ids += fresh
+            if image_id:
+                preinstalled.update(fresh)
+
+        if WARM_POOL_SIZE > 0:
+            self._refill_pool(pool_key, key_name, setup_hash, commit)
+        return instance_ids, preinstalled, image_id
+
+    def _launch_fresh(self, count: int, key_name: str, deployment_id: str, min_count: int,
+                      log_callback, image_id: str = None) -> Tuple[List[str], str]:
+        """Launch from image_id, or from the template if that image is gone; returns (ids, image used)"""
+        try:
+            return self._launch(count, key_name, deployment_id, min_count, log_callback, image_id), image_id
+        except ClientError as e:
+            if not image_id or not e.response['Error']['Code'].startswith('InvalidAMIID'):
+                raise
+        # The recorded image was deregistered behind our back
+        log_callback(f"Baked image {image_id} is gone; installing from scratch")
+        self.storage.set_meta('golden_image', None)
+        return self._launch(count, key_name, deployment_id, min_count, log_callback), None
+
+    def _refill_pool(self, pool_key: str, key_name: str, setup_hash: str, commit: str):
+        """Top the warm pool up in the background (from the baked image when there is one)"""
+        try:
+            image_id = self.baker.current_image(setup_hash) if GOLDEN_IMAGE != 'off' else None
+        except ClientError:
+            image_id = None
+        self.pool.refill_async(
+            pool_key,
+            template_id=os.getenv('LAUNCH_TEMPLATE_ID'),
+            key_name=key_name,
+            commands=self.setup_commands(commit),
+            ssh=self.ssh,
+            log_callback=get_log_writer(WARM_POOL_LOG).write,
+            image_id=image_id
+        )
+
+    def _launch(self, count: int, key_name: str, deployment_id: str, min_count: int,
+                log_callback, image_id: str = None) -> List[str]:
+        return self.aws.launch_instances(
+            template_id=os.getenv('LAUNCH_TEMPLATE_ID'),
+            count=count,
+            key_name=key_name,
+            deployment_id=deployment_id,
+            min_count=min_count,
+            log_callback=log_callback,
+            image_id=image_id
+        )
+
+    def setup_commands(self, commit: str = None) -> List[str]:
+        """
+        The install commands a baked image or warm-pool instance has already
+        run: scalable_docker pinned to `commit` (when it is known), and the
+        marker the deps probe checks it against.
+        """
+        commands = [self._get_worker_setup_command_1(commit), self._get_head_setup_install_command(commit)]
+        if commit:
+            commands.append(f"echo {commit} > {COMMIT_MARKER}")
+        return commands
+
+    def setup_hash(self, commit: str = None) -> str:
+        """
+        Hash of the setup commands for `commit` (default: where PACKAGE_REF
+        points now), so a moved branch means a new image and pool
+        """
+        return ImageBaker.setup_hash(self.setup_commands(commit or resolve_commit()))
+
+    def _golden_image(self, key_name: str, log_callback) -> str:
+        """
+        ID of the baked image matching the current setup commands, or None.
+        With GOLDEN_IMAGE=auto a missing image is baked in the background
+        for later launches.
+        """
+        if GOLDEN_IMAGE == 'off':
+            return None
+        setup_hash = self.setup_hash()
+        try:
+            image_id = self.baker.current_image(setup_hash)
+        except ClientError as e:
+            log_callback(f"Warning: could not look up baked images: {e}")
+            return None
+        if image_id:
+            log_callback(f"Using baked image {image_id} (setup {setup_hash}); skipping installation")
+            return image_id
+        if GOLDEN_IMAGE == 'auto':
+            self.bake_image(key_name, setup_hash)
+            log_callback(f"No baked image for setup {setup_hash} yet; baking one in the background "
+                         f"(log: {self.bake_log_path(setup_hash)})")
+        return None
+
+    def bake_image(self, key_name: str, setup_hash: str = None) -> bool:
+        """Bake an image for the current setup commands in the background (False if already baking)"""
+        commands = self.setup_commands(resolve_commit())
+        setup_hash = setup_hash or ImageBaker.setup_hash(commands)
+        return self.baker.bake_async(
+            setup_hash, commands,
+            template_id=os.getenv('LAUNCH_TEMPLATE_ID'),
+            key_name=key_name,
+            ssh=self.ssh,
+            log_callback=get_log_writer(self.bake_log_path(setup_hash)).write
+        )
+
+    @staticmethod
+    def bake_log_path(setup_hash: str) -> str:
+        return f"~/.aws-deployment-manager/logs/bake-{setup_hash}.log"
+
+    def _wait_until_ready(self, instance_ids: List[str], on_ready, log_callback,
+                          stop_event: threading.Event = None, timings: Timings = None):
+        """
+        Call on_ready(instance_id, ip) for each instance as soon as it can be used.
+        READINESS_MODE=ssh (default): running + answering with an SSH banner.
+        READINESS_MODE=status_ok: running + both EC2 status checks passed.
+        Raises if an instance never gets there.
+        With timings, records per node how long it took to get 'running',
+        and then to 'connect' (or to 'status_ok').
+        """
+        waited, waited_at = time.monotonic(), datetime.utcnow()
+        running_at = {}
+
+        def mark_running(instance_id: str, ip: str):
+            running_at[instance_id] = (time.monotonic(), datetime.utcnow())
+            if timings is not None:
+                timings.add('running', time.monotonic() - waited, host=ip, started_at=waited_at)
+
+        if timings is not None:
+            inner = on_ready
+            def on_ready(instance_id: str, ip: str):
+                phase = 'status_ok' if READINESS_MODE == 'status_ok' else 'connect'
+                since, since_at = running_at.get(instance_id, (waited, waited_at))
+                timings.add(phase, time.monotonic() - since, host=ip, started_at=since_at)
+                inner(instance_id, ip)
+
+        if READINESS_MODE == 'status_ok':
+            log_callback(f"Waiting for {len(instance_ids)} instances to reach running state and pass status checks...")
+            InstanceReadinessTracker(self.aws, instance_ids).run(on_ready, stop_event=stop_event)
+            return
+
+        log_callback(f"Waiting for {len(instance_ids)} instances to reach running state and accept SSH...")
+        probe = SSHProbe(deadline=SSH_PROBE_DEADLINE)
+        try:
+            def on_running(instance_id: str, ip: str):
+                mark_running(instance_id, ip)
+                probe.add(ip, on_ready=lambda _, iid=instance_id, ip=ip: on_ready(iid, ip))
+
+            tracker = InstanceReadinessTracker(self.aws, instance_ids, require_status_ok=False)
+            tracker.run(on_running, stop_event=stop_event)
+
+            while True:
+                results = probe.wait(timeout=1.0)
+                if len(results) == len(tracker.ready) or (stop_event is not None and stop_event.is_set()):
+                    break
+            failed = {ip: error for ip, error in results.items() if error}
+            if failed:
+                raise Exception("Instances never accepted SSH:\n" + "\n".join(
+                    f"{ip}: {error}" for ip, error in failed.items()
+                ))
+        finally:
+            probe.stop()
+
+    def _setup_worker(self, worker_ip: str, log_callback, cancel_event: threading.Event = None,
+                      installed: bool = False, wheelhouse: Wheelhouse = None, commit: str = None,
+                      checkpoint: Callable[[str], None] = None):
+        """
+        Install dependencies (unless the probe shows they are already there at
+        the right commit: baked image, warm pool, or a previous attempt), start
+        the worker server (unless it is already running) and wait for it to be
+        healthy. installed: the node was meant to come preinstalled.
+        checkpoint(step) is called after each step.
+        """
+        checkpoint = checkpoint or (lambda step: None)
+        # Install dependencies (blocking)
+        reinstalled = False
+        if self._probe(worker_ip, self._get_deps_probe_command(commit), cancel_event):
+            if not installed:
+                log_callback(f"[{worker_ip}] Dependencies already installed")
+        else:
+            if installed:
+                log_callback(f"[{worker_ip}] Preinstalled dependencies are missing or out of date; reinstalling")
+            if wheelhouse:
+                install_cmd = self._get_worker_system_setup_command()
+            else:
+                install_cmd = self._get_worker_setup_command_1(commit)
+            rc = self.ssh.run_command(worker_ip, install_cmd, log_callback, use_pty=False, background=False,
+                                      cancel_event=cancel_event)
+            if rc == 0 and wheelhouse:
+                rc = self._install_package(worker_ip, log_callback, cancel_event, wheelhouse)
+            if rc != 0:
+                raise Exception(f"[{worker_ip}] Worker dependency installation failed with exit code {rc}")
+            self._mark_commit(worker_ip, commit, cancel_event)
+            reinstalled = True
+        checkpoint('deps_installed')
+
+        # Start worker server (remote background via nohup)
+        if not reinstalled and self._probe(worker_ip, self._get_worker_process_probe_command(), cancel_event):
+            log_callback(f"[{worker_ip}] Worker server already running")
+        else:
+            if reinstalled:
+                # A server from a previous attempt would still run the old code
+                self.ssh.run_command(worker_ip, "pkill -9 -f 'scalable_docker\\.worker_server' || true", None,
+                                     use_pty=False, background=False, cancel_event=cancel_event)
+            if log_callback:
+                log_callback(f"[{worker_ip}] Starting worker server...")
+            start_cmd = self._get_worker_setup_command_2()
+            rc_start = self.ssh.run_command(worker_ip, start_cmd, log_callback, use_pty=False, background=False,
+                                            cancel_event=cancel_event)
+            if rc_start != 0 and log_callback:
+                log_callback(f"[{worker_ip}] Warning: start command exit code {rc_start}")
+        checkpoint('worker_started')
+
+        # Wait for worker to become healthy before proceeding
+        if log_callback:
+            log_callback(f"[{worker_ip}] Waiting for worker health...")
+        health_cmd = self._get_worker_health_check_command()
+        rc_health = self.ssh.run_command(worker_ip, health_cmd, log_callback, use_pty=False, background=False,
+                                         cancel_event=cancel_event)
+        if rc_health != 0:
+            raise Exception(f"[{worker_ip}] Worker failed to become healthy after start (exit {rc_health})")
+        checkpoint('healthy')
+
+    def _install_head(self, head_ip: str, log_callback, cancel_event: threading.Event = None,
+                      installed: bool = False, wheelhouse: Wheelhouse = None, commit: str = None,
+                      checkpoint: Callable[[str], None] = None):
+        """Install Python and scalable_docker on the head (blocking), unless it already has them"""
+        checkpoint = checkpoint or (lambda step: None)
+        if self._probe(head_ip, self._get_deps_probe_command(commit, docker=False), cancel_event):
+            if not installed:
+                log_callback(f"[{head_ip}] Head dependencies already installed")
+            checkpoint('head_installed')
+            return
+        if installed:
+            log_callback(f"[{head_ip}] Preinstalled dependencies are missing or out of date; reinstalling")
+        log_callback(f"[{head_ip}] Setting up head node...")
+        if wheelhouse:
+            head_install_cmd = self._get_head_system_setup_command()
+        else:
+            head_install_cmd = self._get_head_setup_install_command(commit)
+        rc_head_install = self.ssh.run_command(head_ip, head_install_cmd, log_callback, use_pty=False, background=False,
+                                               cancel_event=cancel_event)
+        if rc_head_install == 0 and wheelhouse:
+            rc_head_install = self._install_package(head_ip, log_callback, cancel_event, wheelhouse)
+        if rc_head_install != 0:
+            raise Exception(f"[{head_ip}] Head install failed with exit code {rc_head_install}")
+        self._mark_commit(head_ip, commit, cancel_event)
+        checkpoint('head_installed')
+
+    def _wheelhouse(self, commit: str, log_callback) -> Wheelhouse:
+        """The wheelhouse for the package's current commit, or None (disabled or commit unknown)"""
+        if not WHEELHOUSE:
+            return None
+        if not commit:
+            log_callback("Could not resolve the scalable_docker commit; nodes will install from git")
+            return None
+        wheelhouse = Wheelhouse(self.ssh, commit)
+        state = "cached" if wheelhouse.is_cached() else "will be built on the first node"
+        log_callback(f"scalable_docker {PACKAGE_REF} is at {commit[:12]}; wheelhouse {state}")
+        return wheelhouse
+
+    def _install_package(self, ip: str, log_callback, cancel_event: threading.Event,
+                         wheelhouse: Wheelhouse) -> int:
+        """
+        Install scalable_docker offline from the wheelhouse, falling back to
+        git at the same commit; returns the exit code
+        """
+        try:
+            if wheelhouse.prepare(ip, log_callback, cancel_event):
+                rc = wheelhouse.install(ip, log_callback, cancel_event)
+                if rc == 0:
+                    return 0
+                log_callback(f"[{ip}] Offline install failed with exit code {rc}; installing from git")
+        except CommandCancelled:
+            raise
+        except Exception as e:
+            log_callback(f"[{ip}] Wheelhouse unavailable ({e}); installing from git")
+        return self.ssh.run_command(ip, self._get_package_install_command(wheelhouse.commit), log_callback,
+                                    use_pty=False, background=False, cancel_event=cancel_event)
+
+    def _make_log_callback(self, deployment_id: str):
+        """Create a callback that logs to file (through the deployment's buffered writer)"""
+        return self._log_writer(deployment_id).write
+
+    def _log_writer(self, deployment_id: str) -> LogWriter:
+        return get_log_writer(self.log_path(deployment_id))
+
+    def _close_log(self, deployment_id: str):
+        """Flush the deployment's log at the end of an operation and release its writer"""
+        close_log_writer(self.log_path(deployment_id))
+
+    @staticmethod
+    def log_path(deployment_id: str) -> str:
+        return f"~/.aws-deployment-manager/logs/{deployment_id}.log"
+    
+    def _get_worker_setup_command_1(self, commit: str = None) -> str:
         """Returns the first worker setup command (install deps)"""
+        return f"{self._get_worker_system_setup_command()} && {self._get_package_install_command(commit)}"
+    
+    def _get_worker_system_setup_command(self) -> str:
+        """apt packages, Docker and the venv (everything but scalable_docker itself)"""
         return (
             "sudo apt update && "
             "sudo apt install -y python3-pip python3-venv python-is-python3 && "
@@ -186,11 +872,13 @@ class DeploymentManager:
             "sudo DEBIAN_FRONTEND=noninteractive apt-get update && "
             "sudo DEBIAN_FRONTEND=noninteractive apt-get install -y docker-ce && "
             "sudo usermod -aG docker $USER && "
-            "python3 -m venv ~/.venv && "
-            "~/.venv/bin/pip install --force-reinstall "
-            "git+https://github.com/astOwOlfo/scalable_docker.git@new"
+            "python3 -m venv ~/.venv"
         )
     
+    def _get_package_install_command(self, commit: str = None) -> str:
+        """Install scalable_docker into the venv straight from git (at `commit`, default PACKAGE_REF)"""
+        return f"~/.venv/bin/pip install --force-reinstall git+{PACKAGE_REPO}@{commit or PACKAGE_REF}"
+    
     def _get_worker_setup_command_2(self) -> str:
         """Returns the second worker setup command (start server)"""
         return (
@@ -206,14 +894,58 @@ class DeploymentManager:
             "sleep 1; done; echo \"worker process not running\"; exit 1'"
         )
     
-    def _get_head_setup_install_command(self) -> str:
+    def _get_head_setup_install_command(self, commit: str = None) -> str:
         """Install Python and scalable_docker on head (blocking)"""
+        return f"{self._get_head_system_setup_command()} && {self._get_package_install_command(commit)}"
+
+    def _get_head_system_setup_command(self) -> str:
+        """Python and the venv on the head (everything but scalable_docker itself)"""
         return (
             "sudo apt update && "
             "sudo apt install -y python3-pip python3-venv python-is-python3 && "
-            "python3 -m venv ~/.venv && "
-            "~/.venv/bin/pip install --force-reinstall "
-            "git+https://github.com/astOwOlfo/scalable_docker.git@new"
+            "python3 -m venv ~/.venv"
+        )
+
+    def _get_deps_probe_command(self, commit: str = None, docker: bool = True) -> str:
+        """
+        Exits 0 if the node already has Docker (unless docker=False) and an
+        importable scalable_docker at the expected commit (when both the
+        commit and the node's marker are known).
+        """
+        checks = []
+        if docker:
+            checks.append("command -v docker >/dev/null")
+        checks.append("~/.venv/bin/python -c 'import scalable_docker' 2>/dev/null")
+        if commit:
+            checks.append(f'{{ [ ! -f {COMMIT_MARKER} ] || [ "$(cat {COMMIT_MARKER})" = {commit} ]; }}')
+        return ' && '.join(checks)
+
+    def _get_worker_process_probe_command(self) -> str:
+        """Exits 0 if the worker server process is running"""
+        return "pgrep -f 'scalable_docker\\.worker_server' >/dev/null"
+
+    def _get_head_process_probe_command(self) -> str:
+        """Exits 0 if the head server process is running"""
+        return "pgrep -f 'scalable_docker\\.head_server' >/dev/null"
+
+    def _get_worker_drain_command(self) -> str:
+        """
+        Waits up to WORKER_DRAIN_TIMEOUT for running containers to finish;
+        exits 3 (naming how many are left) if they don't
+        """
+        return (
+            f"for i in $(seq 1 {int(WORKER_DRAIN_TIMEOUT)}); do "
+            "[ -z \"$(docker ps -q 2>/dev/null)\" ] && exit 0; sleep 1; "
+            "done; "
+            "echo \"Drain timed out: $(docker ps -q | wc -l) containers still running\"; exit 3"
+        )
+
+    def _get_worker_cleanup_command(self) -> str:
+        """Tears down every compose project on a worker, COMPOSE_TEARDOWN_PARALLELISM at a time"""
+        return (
+            "ls ~/.scalable_docker/*/docker-compose.yaml 2>/dev/null | "
+            f"xargs -r -P {COMPOSE_TEARDOWN_PARALLELISM} -I{{}} "
+            "docker compose -f {} down --volumes --remove-orphans 2>/dev/null; true"
         )
 
     def _get_head_setup_start_command(self, worker_urls: str) -> str:
@@ -226,31 +958,67 @@ class DeploymentManager:
     
     def delete_deployment(self, deployment_id: str) -> List[str]:
         """Terminate all instances in a deployment"""
-        deployment = self.storage.get_deployment(deployment_id)
-        if deployment:
-            deployment['status'] = 'terminating'  # Intermediate state
-            self.storage.save_deployment(deployment)
-        
-        terminated = self.aws.terminate_deployment(deployment_id)
-        
-        if terminated and deployment:
-            deployment['status'] = 'terminated'
-            self.storage.save_deployment(deployment)
-        
-        return terminated
+        terminated, errors = self.delete_deployments([deployment_id])
+        if deployment_id in errors:
+            raise Exception(errors[deployment_id])
+        return terminated[deployment_id]
+
+    def delete_deployments(self, deployment_ids: List[str]) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+        """
+        Terminate the instances of many deployments with batched EC2 calls.
+        Status changes are written in one batch before and one after; those
+        whose instances could not all be terminated end up 'failed'.
+        Returns ({deployment_id: terminated instance IDs}, {deployment_id: error}).
+        """
+        self.storage.update_deployments(deployment_ids, status='terminating')  # Intermediate state
+        started_at, start = datetime.utcnow(), time.monotonic()
+        terminated, errors = self.aws.terminate_deployments(deployment_ids)
+        duration = time.monotonic() - start
 
-    def restart_servers(self, deployment_id: str) -> None:
-        """Restart all servers (workers and head) by killing Python processes and re-running start commands."""
+        self.storage.update_deployments([d for d in deployment_ids if d not in errors], status='terminated')
+        for deployment_id in deployment_ids:
+            self._close_log(deployment_id)
+        if errors:
+            self.storage.update_deployments(list(errors), status='failed')
+        if len(deployment_ids) == 1:
+            timings = self._timings(deployment_ids[0])
+            timings.add('terminate', duration, ok=not errors, started_at=started_at,
+                        instances=len(terminated[deployment_ids[0]]))
+        else:
+            # Spans would cost a storage write per deployment; one histogram sample will do
+            PHASE_SECONDS.observe(duration, phase='bulk_terminate', ok=str(not errors).lower())
+        for deployment_id in deployment_ids:
+            self._finish_timings(deployment_id)
+        return terminated, errors
+
+    def restart_servers(self, deployment_id: str, mode: str = 'all', batch_size: int = None,
+                        cancel_event: threading.Event = None,
+                        progress: Callable[[int, int, str], None] = None) -> None:
+        """
+        Restart the servers by killing Python processes and re-running start commands.
+        mode='all': restart every worker at once, then the head (the cluster is
+        down meanwhile). mode='rolling': restart workers batch_size at a time
+        (default RESTART_BATCH_SIZE, or a quarter of the workers). Each batch
+        is first taken out of routing (the head is restarted without it), then
+        drained (its running containers get up to WORKER_DRAIN_TIMEOUT to
+        finish), restarted and health-checked. The next batch's head restart
+        puts it back, and the head gets every worker again at the end. The
+        other workers keep serving throughout; only the head blinks between
+        batches.
+        Setting cancel_event stops a rolling restart before its next batch
+        (every worker is put back and the deployment stays running) and an
+        'all' restart before it starts.
+        A failed restart leaves the deployment in its previous status (most
+        nodes are still serving) unless the head could not be restarted.
+        progress(done, total, message) is called as batches/steps complete.
+        """
+        progress = progress or (lambda done, total, message: None)
+        if mode not in ('all', 'rolling'):
+            raise Exception(f"Unknown restart mode: {mode}")
         deployment = self.storage.get_deployment(deployment_id)
         if not deployment:
             raise Exception("Deployment not found")
         
-        deployment['status'] = 'restarting'
-        self.storage.save_deployment(deployment)
-
-        log = self._make_log_callback(deployment_id)
-        log("Restart requested: killing Python processes and restarting servers on all nodes...")
-
         # Collect IPs
         head = deployment.get('head') or {}
         head_ip = head.get('ip')
@@ -259,53 +1027,121 @@ class DeploymentManager:
         if not head_ip:
             raise Exception("Head IP not found for deployment")
 
-        # Build commands (target only our processes)
-        kill_workers_cmd = "pkill -9 -f 'scalable_docker\\.worker_server' || true"
-        kill_head_cmd = "pkill -9 -f 'scalable_docker\\.head_server' || true"
-
-        # Workers: kill then re-run the worker start command
-        worker_start_cmd = self._get_worker_setup_command_2()
-
-        # Head: kill then re-run the head start command with current workers
-        comma_separated_urls = ','.join(f"http://{ip}:8080" for ip in worker_ips)
-        head_start_cmd = self._get_head_setup_start_command(comma_separated_urls)
-
-        # First: restart all workers (kill -> cleanup containers -> start -> health)
-        if worker_ips:
-            log("Restarting workers: killing existing worker processes...")
-            kill_commands = [(ip, kill_workers_cmd) for ip in worker_ips]
-            self.ssh.run_parallel(kill_commands, log_callback=log, use_pty=False, background=False)
-
-            log("Cleaning up stale Docker containers on workers...")
-            cleanup_cmd = (
-                "for f in ~/.scalable_docker/*/docker-compose.yaml; do "
-                "[ -f \"$f\" ] && docker compose -f \"$f\" down --volumes --remove-orphans 2>/dev/null; "
-                "done; true"
-            )
-            cleanup_commands = [(ip, cleanup_cmd) for ip in worker_ips]
-            self.ssh.run_parallel(cleanup_commands, log_callback=log, use_pty=False, background=False)
-
-            log("Starting worker servers in parallel...")
-            start_commands = [(ip, worker_start_cmd) for ip in worker_ips]
-            # Use background=True for start commands to avoid any blocking on remote launch
-            self.ssh.run_parallel(start_commands, log_callback=log, use_pty=False, background=True)
-
-            log("Verifying worker processes with pgrep...")
-            health_cmd = self._get_worker_health_check_command()
-            health_commands = [(ip, health_cmd) for ip in worker_ips]
-            self.ssh.run_parallel(health_commands, log_callback=log, use_pty=False, background=False)
-            log("All workers healthy. Proceeding to restart head...")
-        else:
-            log("No workers found; proceeding to restart head...")
+        previous_status = deployment['status']
+        self.storage.update_deployment(deployment_id, status='restarting')
+        log = self._make_log_callback(deployment_id)
+        timings = self._timings(deployment_id)
+        started_at, start = datetime.utcnow(), time.monotonic()
+        try:
+            if mode == 'rolling':
+                batch_size = max(1, batch_size or RESTART_BATCH_SIZE or math.ceil(len(worker_ips) / 4))
+                batches = [worker_ips[i:i + batch_size] for i in range(0, len(worker_ips), batch_size)]
+                log(f"Rolling restart requested: {len(worker_ips)} workers in {len(batches)} batches "
+                    f"of up to {batch_size}")
+                try:
+                    for i, batch in enumerate(batches, 1):
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise CommandCancelled(
+                                f"Rolling restart cancelled after {i - 1}/{len(batches)} batches")
+                        log(f"Taking batch {i}/{len(batches)} out of the head's worker list: {', '.join(batch)}")
+                        self._start_head(deployment_id, head['instance_id'], head_ip,
+                                         [ip for ip in worker_ips if ip not in batch], log)
+                        log(f"Draining batch {i}/{len(batches)}")
+                        with timings.span('drain', batch=i, workers=len(batch)):
+                            self._drain_workers(batch, log)
+                        log(f"Restarting batch {i}/{len(batches)}: {', '.join(batch)}")
+                        with timings.span('restart_batch', batch=i, workers=len(batch)):
+                            self._restart_workers(batch, log)
+                        log(f"Batch {i}/{len(batches)} healthy")
+                        progress(i, len(batches), f"Batch {i}/{len(batches)} healthy")
+                finally:
+                    if batches:
+                        log("Putting every worker back in the head's worker list")
+                        self._start_head(deployment_id, head['instance_id'], head_ip, worker_ips, log)
+            else:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CommandCancelled("Restart cancelled before it started")
+                log("Restart requested: killing Python processes and restarting servers on all nodes...")
+                # First: restart all workers (kill -> cleanup containers -> start -> health)
+                if worker_ips:
+                    self._restart_workers(worker_ips, log)
+                    log("All workers healthy. Proceeding to restart head...")
+                    progress(1, 2, "Workers healthy")
+                else:
+                    log("No workers found; proceeding to restart head...")
 
-        # Then: restart the head (kill -> start)
-        log("Restarting head: killing existing head server process...")
-        self.ssh.run_command(head_ip, kill_head_cmd, log_callback=log, use_pty=False, background=False)
+                # Then: restart the head (kill -> start) with current workers
+                log("Restarting head: killing existing head server process...")
+                kill_head_cmd = "pkill -9 -f 'scalable_docker\\.head_server' || true"
+                self.ssh.run_command(head_ip, kill_head_cmd, log_callback=log, use_pty=False, background=False)
 
-        log("Starting head server...")
-        # Use background=True for start command to avoid any blocking on remote launch
-        self.ssh.run_command(head_ip, head_start_cmd, log_callback=log, use_pty=False, background=True)
+                log("Starting head server...")
+                comma_separated_urls = ','.join(f"http://{ip}:8080" for ip in worker_ips)
+                head_start_cmd = self._get_head_setup_start_command(comma_separated_urls)
+                # Use background=True for start command to avoid any blocking on remote launch
+                self.ssh.run_command(head_ip, head_start_cmd, log_callback=log, use_pty=False, background=True)
+                progress(2, 2, "Head started")
+        except CommandCancelled as e:
+            # Only ever raised between batches: every node is up, old or new
+            log(str(e))
+            timings.add('restart', time.monotonic() - start, ok=False, started_at=started_at, mode=mode)
+            self._finish_timings(deployment_id)
+            self._close_log(deployment_id)
+            self.storage.update_deployment(deployment_id, status='running')
+            raise
+        except Exception as e:
+            log(f"ERROR: Restart failed: {e}")
+            timings.add('restart', time.monotonic() - start, ok=False, started_at=started_at, mode=mode)
+            self._finish_timings(deployment_id)
+            self._close_log(deployment_id)
+            if isinstance(e, HeadStartError):
+                self.storage.update_deployment(deployment_id, status='failed')
+            else:
+                # The untouched workers (and the head) are still serving
+                log(f"The deployment stays {previous_status}")
+                self.storage.update_deployment(deployment_id, status=previous_status)
+            raise
 
         log("✓ Restart complete")
-        deployment['status'] = 'running'
-        self.storage.save_deployment(deployment)
\ No newline at end of file
+        timings.add('restart', time.monotonic() - start, started_at=started_at, mode=mode)
+        self._finish_timings(deployment_id)
+        self._close_log(deployment_id)
+        self.storage.update_deployment(deployment_id, status='running')
+
+    def _drain_workers(self, worker_ips: List[str], log):
+        """
+        Wait (up to WORKER_DRAIN_TIMEOUT) for the workers' containers to
+        finish; they must already be out of the head's worker list.
+        Workers still busy at the timeout are logged, and the caller goes on
+        anyway (killing their containers).
+        """
+        drain_cmd = self._get_worker_drain_command()
+        try:
+            self.ssh.run_parallel([(ip, drain_cmd) for ip in worker_ips], log_callback=log,
+                                  use_pty=False, background=False, host_timeout=WORKER_DRAIN_TIMEOUT + 60)
+        except Exception as e:
+            log(f"Warning: draining did not finish; running containers will be killed:\n{e}")
+
+    def _restart_workers(self, worker_ips: List[str], log):
+        """Kill the worker servers, tear down their containers, start them again and wait until healthy"""
+        # Target only our processes
+        kill_workers_cmd = "pkill -9 -f 'scalable_docker\\.worker_server' || true"
+        log("Killing existing worker processes...")
+        kill_commands = [(ip, kill_workers_cmd) for ip in worker_ips]
+        self.ssh.run_parallel(kill_commands, log_callback=log, use_pty=False, background=False)
+
+        log("Cleaning up stale Docker containers on workers...")
+        cleanup_cmd = self._get_worker_cleanup_command()
+        cleanup_commands = [(ip, cleanup_cmd) for ip in worker_ips]
+        self.ssh.run_parallel(cleanup_commands, log_callback=log, use_pty=False, background=False)
+
+        log("Starting worker servers in parallel...")
+        start_cmd = self._get_worker_setup_command_2()
+        start_commands = [(ip, start_cmd) for ip in worker_ips]
+        # Use background=True for start commands to avoid any blocking on remote launch
+        self.ssh.run_parallel(start_commands, log_callback=log, use_pty=False, background=True)
+
+        log("Verifying worker processes with pgrep...")
+        health_cmd = self._get_worker_health_check_command()
+        health_commands = [(ip, health_cmd) for ip in worker_ips]
+        self.ssh.run_parallel(health_commands, log_callback=log, use_pty=False, background=False)
\ No newline at end of file
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('SSH_MAX_CONCURRENCY', '64'))
+
+@dataclass
+class HostResult:
+    """Outcome of one host's task in a fan-out"""
+    host: str
+    status: str = 'pending'  # ok | failed | timeout | cancelled
+    exit_code: Optional[int] = None
+    duration: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 'ok'
+
+
+class FanOut:
+    """
+    Runs one task per host on a bounded thread pool.
+
+    Each task is called as fn(cancel_event) and returns an exit code (or None
+    for success); it should give up promptly once cancel_event is set.
+    A task fails if it raises or returns a non-zero exit code. With
+    fail_fast=True the first failure cancels every other host: queued hosts
+    never start and running ones get their cancel_event set.
+    host_timeout (seconds) sets a host's cancel_event if it runs too long.
+    """
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 host_timeout: Optional[float] = None,
+                 fail_fast: bool = False,
+                 on_result: Callable[[HostResult], None] = None):
+        self.host_timeout = host_timeout
+        self.fail_fast = fail_fast
+        self.on_result = on_result
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency),
+                                            thread_name_prefix='fanout')
+        self._lock = threading.Lock()
+        self._results: Dict[str, HostResult] = {}
+        self._futures: Dict[str, Future] = {}
+        self._cancel_events: Dict[str, threading.Event] = {}
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        """Set once the whole fan-out is cancelled (e.g. by fail-fast)"""
+        return self._cancelled
+
+    def submit(self, host: str, fn: Callable[[threading.Event], Optional[int]]):
+        """Queue a task for host; may be called while other hosts are running"""
+        with self._lock:
+            result = HostResult(host)
+            self._results[host] = result
+            self._cancel_events[host] = threading.Event()
+            if self._cancelled.is_set():
+                result.status = 'cancelled'
+                return
+            self._futures[host] = self._executor.submit(self._run, host, fn)
+
+    def cancel(self):
+        """Cancel every queued and running host"""
+        with self._lock:
+            self._cancelled.set()
+            for host, future in self._futures.items():
+                if future.cancel():
+                    self._results[host].status = 'cancelled'
+            for event in self._cancel_events.values():
+                event.set()
+
+    def wait(self) -> List[HostResult]:
+        """Block until every submitted host finished or was cancelled"""
+        while True:
+            with self._lock:
+                futures = list(self._futures.values())
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()  # waits; errors are already recorded
+            with self._lock:
+                # Tasks may have been submitted while we were waiting
+                if len(self._futures) == len(futures):
+                    break
+        self._executor.shutdown(wait=True)
+        return list(self._results.values())
+
+    def _run(self, host: str, fn: Callable[[threading.Event], Optional[int]]):
+        result = self._results[host]
+        cancel_event = self._cancel_events[host]
+        timer = None
+        if self.host_timeout:
+            timer = threading.Timer(self.host_timeout, cancel_event.set)
+            timer.daemon = True
+            timer.start()
+
+        start = time.time()
+        try:
+            if cancel_event.is_set():
+                result.status = 'cancelled'
+                return
+            exit_code = fn(cancel_event)
+            result.exit_code = exit_code
+            if exit_code:
+                result.status = 'failed'
+                result.error = f"exit code {exit_code}"
+            else:
+                result.status = 'ok'
+        except Exception as e:
+            result.error = str(e)
+            if self._cancelled.is_set():
+                result.status = 'cancelled'
+            elif cancel_event.is_set():
+                result.status = 'timeout'
+                result.error = f"timed out after {self.host_timeout}s: {e}"
+            else:
+                result.status = 'failed'
+        finally:
+            if timer:
+                timer.cancel()
+            result.duration = time.time() - start
+
+        if self.on_result:
+            try:
+                self.on_result(result)
+            except Exception:
+                pass
+        if not result.ok and self.fail_fast and not self._cancelled.is_set():
+            self.cancel()
+
+
+class AnyEvent:
+    """
+    Reads as set once any of several events is set, so a task can answer
+    to its host's cancel_event and a caller's at once. Only is_set() and
+    wait() are supported.
+    """
+
+    def __init__(self, *events: Optional[threading.Event]):
+        self.events = [e for e in events if e is not None]
+
+    def is_set(self) -> bool:
+        return any(e.is_set() for e in self.events)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            time.sleep(remaining)
+        return True
+
+
+def run_fanout(tasks: Dict[str, Callable[[threading.Event], Optional[int]]],
+               **kwargs) -> List[HostResult]:
+    """Run {host: fn} with FanOut(**kwargs) and return every host's result"""
+    fanout = FanOut(**kwargs)
+    for host, fn in tasks.items():
+        fanout.submit(host, fn)
+    return fanout.wait()
+
+
+def describe_failures(results: List[HostResult]) -> str:
+    """One line per host that did not succeed"""
+    return "\n".join(
+        f"{r.host}: {r.status}" + (f" ({r.error})" if r.error else "")
+        for r in results if not r.ok
+    )
@@ -0,0 +1,232 @@
+import hashlib
+import os
+import posixpath
+import shlex
+import threading
+import urllib.parse
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from ssh_mux import CommandCancelled
+
+CHUNK_SIZE = 1 << 20  # local read size; paramiko splits it into pipelined SFTP writes
+RELAY_PORT = int(os.getenv('BROADCAST_RELAY_PORT', '8765'))
+
+_hash_cache: Dict[Tuple[str, float, int], str] = {}
+_hash_lock = threading.Lock()
+
+def file_sha256(path: str) -> str:
+    """sha256 of a local file, cached by (path, mtime, size)"""
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    with _hash_lock:
+        cached = _hash_cache.get(key)
+    if cached:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    with _hash_lock:
+        _hash_cache[key] = digest.hexdigest()
+    return _hash_cache[key]
+
+
+@dataclass
+class FileEntry:
+    """One file to transfer; rel_path is relative to the remote root, with '/' separators"""
+    rel_path: str
+    local_path: str
+    size: int
+    sha256: str
+
+
+def build_manifest(local_path: str, skip: Tuple[str, ...] = ()) -> List[FileEntry]:
+    """Every file under local_path (or local_path itself), except names listed in skip"""
+    local_path = os.path.expanduser(local_path)
+    if os.path.isfile(local_path):
+        paths = [(os.path.basename(local_path), local_path)]
+    else:
+        paths = []
+        for root, dirs, files in os.walk(local_path):
+            dirs.sort()
+            for name in sorted(files):
+                if name in skip:
+                    continue
+                full = os.path.join(root, name)
+                paths.append((os.path.relpath(full, local_path).replace(os.sep, '/'), full))
+    return [FileEntry(rel, full, os.path.getsize(full), file_sha256(full)) for rel, full in paths]
+
+
+def remote_root(path: str) -> str:
+    """Remote paths are relative to the home directory unless absolute ('~/x' means 'x')"""
+    if path == '~':
+        return '.'
+    return path[2:] if path.startswith('~/') else path
+
+
+def checksum_command(root: str, entries: List[FileEntry]) -> str:
+    """Prints 'sha256  path' for each entry that exists under root"""
+    paths = ' '.join(shlex.quote(e.rel_path) for e in entries)
+    return f"cd {shlex.quote(root)} 2>/dev/null && sha256sum -- {paths} 2>/dev/null; true"
+
+
+def parse_checksums(lines: List[str]) -> Dict[str, str]:
+    result = {}
+    for line in lines:
+        parts = line.split(None, 1)
+        if len(parts) == 2 and len(parts[0]) == 64:
+            result[parts[1].lstrip('*')] = parts[0]
+    return result
+
+
+def mkdir_command(root: str, entries: List[FileEntry]) -> str:
+    dirs = sorted({posixpath.dirname(e.rel_path) for e in entries} - {''})
+    paths = ' '.join(shlex.quote(posixpath.join(root, d)) for d in dirs)
+    return f"mkdir -p {shlex.quote(root)} {paths}"
+
+
+def fetch_command(root: str, entries: List[FileEntry], source: str, port: int = RELAY_PORT) -> str:
+    """Download entries from a relay's HTTP server into root and verify their checksums"""
+    steps = [mkdir_command(root, entries), f"cd {shlex.quote(root)}"]
+    for e in entries:
+        path = shlex.quote(e.rel_path)
+        part = shlex.quote(e.rel_path + '.part')
+        url = shlex.quote(f"http://{source}:{port}/{urllib.parse.quote(e.rel_path)}")
+        steps.append(
+            f"curl -fsS --connect-timeout 5 --retry 3 --retry-connrefused -o {part} {url} && mv {part} {path}"
+        )
+    checks = ' '.join(shlex.quote(f"{e.sha256}  {e.rel_path}") for e in entries)
+    steps.append(f"printf '%s\\n' {checks} | sha256sum -c --quiet -")
+    return ' && '.join(steps)
+
+
+def serve_command(root: str, port: int = RELAY_PORT) -> str:
+    """
+    Start a throwaway HTTP server for root, so other nodes can fetch from
+    this one. It listens on the node's private IP only (printed, for the
+    fetchers to use), not on every interface.
+    """
+    return (
+        "ip=$(hostname -I | awk '{print $1}'); [ -n \"$ip\" ] || exit 1; "
+        f"nohup python3 -m http.server {port} --bind \"$ip\" --directory {shlex.quote(root)} "
+        "< /dev/null > /dev/null 2>&1 & echo \"$ip\""
+    )
+
+
+def stop_serving_command(port: int = RELAY_PORT) -> str:
+    # '[.]' so the pattern doesn't match this shell's own command line
+    return f"pkill -f 'http[.]server {port}' || true"
+
+
+@dataclass
+class TransferResult:
+    """Outcome of one host's part of a broadcast"""
+    host: str
+    status: str = 'pending'  # ok | failed | cancelled
+    source: str = 'direct'   # 'direct' (from here) or the node it was relayed from
+    files_sent: int = 0
+    files_skipped: int = 0
+    bytes_sent: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 'ok'
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second"""
+        return self.bytes_sent / self.duration if self.duration > 0 else 0.0
+
+    def describe(self) -> str:
+        if not self.ok:
+            return f"{self.status}: {self.error}"
+        via = 'direct' if self.source == 'direct' else f"via {self.source}"
+        return (
+            f"{self.bytes_sent / 1e6:.1f} MB in {self.duration:.1f}s "
+            f"({self.throughput / 1e6:.1f} MB/s, {via}); "
+            f"{self.files_sent} sent, {self.files_skipped} unchanged"
+        )
+
+
+class RelaySources:
+    """
+    Hands out transfer sources: the launcher itself (at most direct_slots
+    uploads at once) or a seeded node (at most per_seed transfers each).
+    Seeds are preferred, so the launcher's uplink only feeds the first
+    layers of the tree.
+    """
+
+    def __init__(self, direct_slots: int, per_seed: int, relay: bool = True):
+        self.per_seed = per_seed
+        self.relay = relay
+        self._cond = threading.Condition()
+        self._direct_free = direct_slots
+        self._seeds: Dict[str, int] = {}
+        self._addresses: Dict[str, str] = {}
+        self._servers: List[str] = []
+        self._relayed_ok = False
+
+    def acquire(self, cancel_event: threading.Event = None, allow_relay: bool = True) -> Optional[str]:
+        """Block until a source is free; returns a seed host, or None for a direct upload"""
+        with self._cond:
+            while True:
+                if self.relay and allow_relay and self._seeds:
+                    seed = max(self._seeds, key=self._seeds.get)
+                    if self._seeds[seed] > 0:
+                        self._seeds[seed] -= 1
+                        return seed
+                if self._direct_free > 0:
+                    self._direct_free -= 1
+                    return None
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CommandCancelled("Cancelled while waiting for a transfer source")
+                self._cond.wait(0.5)
+
+    def release(self, source: Optional[str], ok: Optional[bool] = True):
+        """
+        Hand a source back. ok=False: the relay failed; ok=None: the
+        transfer was interrupted (e.g. cancelled), which says nothing about
+        whether relaying works.
+        """
+        with self._cond:
+            if source is None:
+                self._direct_free += 1
+            elif source in self._seeds:
+                self._seeds[source] += 1
+                if ok:
+                    self._relayed_ok = True
+                elif ok is False and not self._relayed_ok:
+                    # The first relay failed: nodes probably can't reach each other
+                    self.relay = False
+            self._cond.notify_all()
+
+    def add_server(self, host: str):
+        """Remember a host that may be serving files, so it is stopped after the broadcast"""
+        with self._cond:
+            if host not in self._servers:
+                self._servers.append(host)
+
+    def add_seed(self, host: str, address: str = None):
+        """host now serves everything, at address (default: host)"""
+        with self._cond:
+            if self.relay:
+                self._seeds[host] = self.per_seed
+                self._addresses[host] = address or host
+                self._cond.notify_all()
+
+    def address(self, seed: str) -> str:
+        """Where fetchers reach a seed's server"""
+        with self._cond:
+            return self._addresses.get(seed, seed)
+
+    @property
+    def seeds(self) -> List[str]:
+        with self._cond:
+            return list(self._seeds)
+
+    @property
+    def servers(self) -> List[str]:
+        with self._cond:
+            return list(self._servers)
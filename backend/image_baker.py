@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from botocore.exceptions import ClientError
+from aws_client import AWSClient
+from readiness import InstanceReadinessTracker
+from ssh_runner import SSHRunner
+from storage import Storage
+
+IMAGE_CREATOR = 'aws-deployment-manager'  # CreatedBy tag of our images
+
+# Hashes with a bake in progress (process-wide, so concurrent launches bake once)
+_baking: Dict[str, threading.Thread] = {}
+_baking_lock = threading.Lock()
+
+class ImageBaker:
+    """
+    Builds "golden" AMIs with the node setup already done.
+
+    An image is tagged with a hash of the setup commands it was built with
+    (SetupHash; the commands pin the package commit), so changing those
+    commands makes launches ignore the old image until a new one is baked.
+    A new image replaces the older ones: they are deregistered and their
+    snapshots deleted. The most recent image is also recorded in storage
+    to avoid a describe_images call on every launch.
+    """
+
+    def __init__(self, aws: AWSClient, storage: Storage):
+        self.aws = aws
+        self.storage = storage
+
+    @staticmethod
+    def setup_hash(commands: List[str]) -> str:
+        """Short, stable hash of the setup commands an image is built with"""
+        digest = hashlib.sha256()
+        for command in commands:
+            digest.update(command.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()[:16]
+
+    def record(self) -> Optional[Dict]:
+        """The last baked image: {'setup_hash', 'image_id', 'created_at'}"""
+        return self.storage.get_meta('golden_image')
+
+    def current_image(self, setup_hash: str) -> Optional[str]:
+        """ID of an available image baked with setup_hash, or None"""
+        record = self.record()
+        if record and record.get('setup_hash') == setup_hash:
+            return record['image_id']
+        images = self.aws.find_images({'SetupHash': setup_hash})
+        if not images:
+            return None
+        self._record(setup_hash, images[0]['ImageId'])
+        return images[0]['ImageId']
+
+    def baking(self) -> List[str]:
+        """Setup hashes with a bake in progress"""
+        with _baking_lock:
+            return [h for h, thread in _baking.items() if thread.is_alive()]
+
+    def bake_async(self, setup_hash: str, commands: List[str], template_id: str,
+                   key_name: str, ssh: SSHRunner, log_callback: Callable[[str], None]) -> bool:
+        """Start bake() in the background; False if one is already running for this hash"""
+        with _baking_lock:
+            thread = _baking.get(setup_hash)
+            if thread is not None and thread.is_alive():
+                return False
+
+            def run():
+                try:
+                    self.bake(setup_hash, commands, template_id, key_name, ssh, log_callback)
+                except Exception as e:
+                    log_callback(f"ERROR: Image bake failed: {e}")
+
+            thread = threading.Thread(target=run, daemon=True)
+            _baking[setup_hash] = thread
+            thread.start()
+            return True
+
+    def bake(self, setup_hash: str, commands: List[str], template_id: str,
+             key_name: str, ssh: SSHRunner, log_callback: Callable[[str], None]) -> str:
+        """
+        Launch one node, run the setup commands on it, snapshot it and
+        record the image. The node is terminated afterwards either way.
+        Returns the new image ID.
+        """
+        log_callback(f"Baking image for setup {setup_hash}: launching build node...")
+        instance_ids = self.aws.launch_instances(
+            template_id=template_id,
+            count=1,
+            key_name=key_name,
+            deployment_id=f"bake-{setup_hash}"
+        )
+        try:
+            tracker = InstanceReadinessTracker(self.aws, instance_ids, require_status_ok=False)
+            tracker.run(lambda iid, ip: log_callback(f"Build node {iid} running at {ip}"))
+            ip = tracker.ready[instance_ids[0]]
+
+            for command in commands:
+                rc = ssh.run_command(ip, command, log_callback, use_pty=False, background=False)
+                if rc != 0:
+                    raise Exception(f"[{ip}] Setup command failed with exit code {rc}")
+
+            log_callback("Creating image...")
+            image_id = self.aws.create_image(
+                instance_ids[0],
+                name=f"aws-deployment-manager-{setup_hash}-{int(time.time())}",
+                tags={'SetupHash': setup_hash, 'CreatedBy': IMAGE_CREATOR}
+            )
+            self.aws.wait_for_image(image_id)
+            self._record(setup_hash, image_id)
+            log_callback(f"✓ Baked image {image_id}")
+            self._prune(image_id, log_callback)
+            return image_id
+        finally:
+            self.aws.terminate_instances(instance_ids)
+
+    def _prune(self, image_id: str, log_callback: Callable[[str], None]):
+        """Deregister the images baked before image_id (a concurrent, newer bake's survive)"""
+        images = self.aws.find_images({'CreatedBy': IMAGE_CREATOR})
+        created = next((image.get('CreationDate', '') for image in images if image['ImageId'] == image_id), None)
+        if created is None:
+            return
+        for image in images:
+            old_id = image['ImageId']
+            if old_id == image_id or image.get('CreationDate', '') > created:
+                continue
+            try:
+                self.aws.deregister_image(old_id)
+                log_callback(f"Deregistered old image {old_id} and its snapshots")
+            except ClientError as e:
+                log_callback(f"Warning: could not deregister old image {old_id}: {e}")
+
+    def _record(self, setup_hash: str, image_id: str):
+        self.storage.set_meta('golden_image', {
+            'setup_hash': setup_hash,
+            'image_id': image_id,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        })
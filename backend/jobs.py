@@ -0,0 +1,177 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ssh_mux import CommandCancelled
+from storage import Storage
+
+# Long operations (restart, delete, scale, resume, bulk) running at once; the rest queue
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+ACTIVE_STATES = ('queued', 'running')
+
+
+class JobConflict(Exception):
+    """Another kind of job is already queued or running for the deployment"""
+
+    def __init__(self, job: Dict):
+        super().__init__(f"{job['kind']} job {job['id']} is already {job['status']} for this deployment")
+        self.job = job
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat() + 'Z'
+
+
+class Job:
+    """Handle passed to a job's function: its record, cancellation flag and progress reporting"""
+
+    def __init__(self, manager: 'JobManager', record: Dict):
+        self.manager = manager
+        self.record = record
+        self.cancel_event = threading.Event()
+
+    @property
+    def id(self) -> str:
+        return self.record['id']
+
+    def progress(self, done: int, total: int, message: str = None):
+        """Record how far the job got (e.g. restart batches done out of total)"""
+        self.manager._update(self, progress={'done': done, 'total': total, 'message': message})
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise CommandCancelled(f"Job {self.id} was cancelled")
+
+
+class JobManager:
+    """
+    Runs long operations on a bounded thread pool, so API requests can
+    return 202 with a job ID right away.
+
+    At most one job is active (queued or running) per deployment (a bulk job
+    claims all of its deployments): submitting the same kind with the same
+    params again returns the active job, anything else raises JobConflict.
+    Job records (status, progress, result, error) are saved in storage on
+    every change. Jobs that were still active when the process stopped are
+    marked failed on startup.
+
+    Cancelling a queued job drops it; a running job gets its cancel_event
+    set and stops at its next check (see Job.check_cancelled).
+    """
+
+    def __init__(self, storage: Storage, max_workers: int = JOB_WORKERS):
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='job')
+        self._lock = threading.RLock()
+        self._jobs: Dict[str, Job] = {}           # active jobs by id
+        self._by_deployment: Dict[str, Job] = {}  # active job per deployment
+        for record in storage.get_jobs(statuses=list(ACTIVE_STATES), limit=10000):
+            record.update(status='failed', finished_at=_now(), error="Interrupted by a server restart")
+            storage.save_job(record)
+
+    def submit(self, kind: str, deployment_id: Optional[str], fn: Callable[[Job], Any],
+               params: Dict = None, deployment_ids: List[str] = None) -> Tuple[Dict, bool]:
+        """
+        Queue fn(job) and return (job record, True), or (the active job's
+        record, False) if an identical job is already queued or running.
+        Bulk jobs pass deployment_id=None and all their deployment_ids.
+        fn's return value becomes the job's 'result'.
+        """
+        params = params or {}
+        claims = list(deployment_ids or ([deployment_id] if deployment_id else []))
+        with self._lock:
+            for claimed in claims:
+                active = self._by_deployment.get(claimed)
+                if active is None:
+                    continue
+                if active.record['kind'] == kind and active.record['params'] == params:
+                    return dict(active.record), False
+                raise JobConflict(dict(active.record))
+            record = {
+                'id': f"job-{uuid.uuid4().hex[:12]}",
+                'kind': kind,
+                'deployment_id': deployment_id,
+                'deployment_ids': claims,
+                'params': params,
+                'status': 'queued',
+                'created_at': _now(),
+                'started_at': None,
+                'finished_at': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'cancel_requested': False,
+            }
+            job = Job(self, record)
+            self._jobs[job.id] = job
+            for claimed in claims:
+                self._by_deployment[claimed] = job
+            self.storage.save_job(record)
+        self._executor.submit(self._run, job, fn)
+        return dict(record), True
+
+    def active(self, deployment_id: str) -> Optional[Dict]:
+        """The job queued or running for a deployment, if any"""
+        with self._lock:
+            job = self._by_deployment.get(deployment_id)
+            return dict(job.record) if job is not None else None
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job.record)
+        return self.storage.get_job(job_id)
+
+    def list(self, deployment_id: str = None, active_only: bool = False, limit: int = 100) -> List[Dict]:
+        statuses = list(ACTIVE_STATES) if active_only else None
+        return self.storage.get_jobs(deployment_id, statuses, limit)
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """Request cancellation; returns the job record, or None if there is no such job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return self.storage.get_job(job_id)
+            job.cancel_event.set()
+            if job.record['status'] == 'queued':
+                self._finish(job, status='cancelled', cancel_requested=True, error="Cancelled before it started")
+            else:
+                self._update(job, cancel_requested=True)
+            return dict(job.record)
+
+    def _update(self, job: Job, **fields):
+        # Saved under the lock, so a late progress update can't overwrite the final record
+        with self._lock:
+            if job.id not in self._jobs:
+                return
+            job.record.update(fields)
+            self.storage.save_job(job.record)
+
+    def _run(self, job: Job, fn: Callable[[Job], Any]):
+        with self._lock:
+            if job.id not in self._jobs:  # cancelled while queued
+                return
+            self._update(job, status='running', started_at=_now())
+        try:
+            result = fn(job)
+            self._finish(job, status='succeeded', result=result)
+        except CommandCancelled as e:
+            self._finish(job, status='cancelled', error=str(e))
+        except Exception as e:
+            print(f"Job {job.id} ({job.record['kind']}) failed: {e}")
+            self._finish(job, status='failed', error=str(e))
+
+    def _finish(self, job: Job, **fields):
+        with self._lock:
+            if job.id not in self._jobs:
+                return
+            job.record.update(fields, finished_at=_now())
+            self._jobs.pop(job.id, None)
+            for claimed in job.record['deployment_ids']:
+                if self._by_deployment.get(claimed) is job:
+                    del self._by_deployment[claimed]
+            self.storage.save_job(job.record)
@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+from botocore.exceptions import ClientError
+
+# Errors that only mean "not here, not now": retry the shortfall in another subnet
+CAPACITY_ERRORS = (
+    'InsufficientInstanceCapacity',
+    'InsufficientFreeAddressesInSubnet',
+    'Unsupported',
+)
+
+@dataclass
+class SubnetSlot:
+    """One subnet the planner may launch into"""
+    subnet_id: Optional[str]  # None: let EC2 pick (no subnets known)
+    availability_zone: Optional[str] = None
+    exhausted: bool = False
+    launched: List[str] = field(default_factory=list)
+    last_error: Optional[str] = None
+
+
+class LaunchPlanner:
+    """
+    Launches `count` instances spread across subnets (one per AZ), with
+    partial fulfilment.
+
+    Each round splits the outstanding count evenly over the subnets that
+    still have capacity and calls run_instances(MinCount=1, MaxCount=share)
+    for all of them concurrently. A subnet that answers with a capacity
+    error, or launches fewer than asked, is marked exhausted and the
+    shortfall moves to the others in the next round. Any other error
+    aborts the launch.
+    """
+
+    def __init__(self, run_instances: Callable[..., List[str]], subnets: List[Dict],
+                 max_rounds: int = 4):
+        """
+        run_instances(subnet_id, max_count) -> instance ids; subnets are
+        {'SubnetId', 'AvailabilityZone'} dicts (empty: a single slot without a subnet).
+        """
+        self.run_instances = run_instances
+        self.max_rounds = max_rounds
+        self.slots = [SubnetSlot(s['SubnetId'], s.get('AvailabilityZone')) for s in subnets] or [SubnetSlot(None)]
+        self._lock = threading.Lock()
+
+    @property
+    def launched(self) -> List[str]:
+        with self._lock:
+            return [iid for slot in self.slots for iid in slot.launched]
+
+    def errors(self) -> List[str]:
+        """The last capacity error of each subnet that had one"""
+        return [f"{slot.subnet_id or 'default'}: {slot.last_error}" for slot in self.slots if slot.last_error]
+
+    def run(self, count: int, log_callback=None) -> List[str]:
+        """Launch up to count instances and return their ids (possibly fewer)"""
+        with ThreadPoolExecutor(max_workers=len(self.slots), thread_name_prefix='launch') as executor:
+            for round_no in range(self.max_rounds):
+                remaining = count - len(self.launched)
+                available = [slot for slot in self.slots if not slot.exhausted]
+                if remaining <= 0 or not available:
+                    break
+                plan = self._split(remaining, available)
+                if log_callback and round_no > 0:
+                    log_callback(f"Retrying {remaining} instances in " + ", ".join(
+                        f"{slot.availability_zone or slot.subnet_id} ({n})" for slot, n in plan
+                    ))
+                futures = [executor.submit(self._launch, slot, n) for slot, n in plan]
+                errors = [f.exception() for f in futures]
+                fatal = next((e for e in errors if e is not None), None)
+                if fatal is not None:
+                    raise fatal
+        return self.launched
+
+    @staticmethod
+    def _split(remaining: int, slots: List[SubnetSlot]) -> List[tuple]:
+        share, extra = divmod(remaining, len(slots))
+        plan = [(slot, share + (1 if i < extra else 0)) for i, slot in enumerate(slots)]
+        return [(slot, n) for slot, n in plan if n > 0]
+
+    def _launch(self, slot: SubnetSlot, n: int):
+        try:
+            ids = self.run_instances(slot.subnet_id, n)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code not in CAPACITY_ERRORS:
+                raise
+            slot.exhausted = True
+            slot.last_error = code
+            return
+        with self._lock:
+            slot.launched.extend(ids)
+        if len(ids) < n:
+            # MinCount=1 launched what fits; don't ask this subnet again
+            slot.exhausted = True
+            slot.last_error = f"only {len(ids)} of {n} launched"
@@ -0,0 +1,89 @@
+import itertools
+import os
+import threading
+from collections import deque
+from typing import Dict, List, Tuple
+
+class LogChannel:
+    """
+    In-memory broadcast of one log file's lines.
+
+    Every line has a sequence number equal to its line number in the file,
+    so it can be used as an SSE event id and survives a server restart.
+    The most recent lines are kept in a bounded ring buffer; subscribers that
+    fall further behind (or join late) have the gap read from the file.
+    """
+
+    def __init__(self, path: str, capacity: int = 5000):
+        self.path = path
+        self._lines: deque = deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._seq = self._count_file_lines()
+        self.users = 0  # writers and streams holding it (guarded by _channels_lock)
+
+    def _count_file_lines(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def publish(self, lines: List[str]):
+        """Announce lines that were just appended to the file"""
+        with self._cond:
+            for line in lines:
+                self._seq += 1
+                self._lines.append((self._seq, line))
+            self._cond.notify_all()
+
+    def read_since(self, seq: int, timeout: float = None, limit: int = 1000) -> List[Tuple[int, str]]:
+        """
+        Up to `limit` (seq, line) pairs after `seq`, oldest first.
+        Waits up to `timeout` seconds for new lines if there are none yet.
+        """
+        with self._cond:
+            if self._seq <= seq and timeout:
+                self._cond.wait_for(lambda: self._seq > seq, timeout)
+            oldest = self._lines[0][0] if self._lines else self._seq + 1
+            if seq + 1 >= oldest:
+                start = seq + 1 - oldest
+                return list(itertools.islice(self._lines, start, start + limit))
+        # Lines before the ring buffer: they're already in the file
+        return self._read_file(seq, min(oldest - 1, seq + limit))
+
+    def _read_file(self, after: int, until: int) -> List[Tuple[int, str]]:
+        if not os.path.exists(self.path) or until <= after:
+            return []
+        # newline='\n': stray carriage returns must not split lines and shift seqs
+        with open(self.path, 'r', newline='\n', errors='replace') as f:
+            lines = itertools.islice(f, after, until)
+            return [(after + i + 1, line.rstrip('\n')) for i, line in enumerate(lines)]
+
+
+_channels: Dict[str, LogChannel] = {}
+_channels_lock = threading.Lock()
+
+def get_log_channel(path: str) -> LogChannel:
+    """
+    The process-wide channel for a log file, created on first use.
+    Every caller must hand it back with release_log_channel() once done
+    (the log writer when it closes, a stream when the client goes away).
+    """
+    path = os.path.expanduser(path)
+    with _channels_lock:
+        channel = _channels.get(path)
+        if channel is None:
+            channel = LogChannel(path)
+            _channels[path] = channel
+        channel.users += 1
+        return channel
+
+def release_log_channel(channel: LogChannel):
+    """Drop the channel once nobody writes to or streams from it; lines stay in the file"""
+    with _channels_lock:
+        channel.users -= 1
+        if channel.users <= 0 and _channels.get(channel.path) is channel:
+            del _channels[channel.path]
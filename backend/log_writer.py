@@ -0,0 +1,156 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List
+from log_broadcast import get_log_channel, release_log_channel
+
+_STOP = object()
+
+class LogWriter:
+    """
+    Appends lines to one log file from a single background thread.
+    write() only timestamps the message and queues it, so it is cheap to call
+    from many SSH threads at once; the writer thread keeps the file open and
+    writes queued lines in batches, in the order they were queued.
+    Each batch is published to the file's LogChannel once it is on disk.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.2):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Created before the first write, so its line count matches the file
+        self.channel = get_log_channel(path)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, message: str):
+        timestamp = datetime.utcnow().isoformat()
+        # One timestamped file line per message line
+        lines = [f"[{timestamp}] {line}\n" for line in str(message).split('\n')]
+        if self._put(lines):
+            return
+        # A straggler (e.g. a still-running SSH thread) after the writer was
+        # closed: append it once the final batch is on disk
+        self._thread.join()
+        _append_late(self.path, lines)
+
+    def _put(self, lines: List[str]) -> bool:
+        """Queue lines for the writer thread; False once the writer is closed"""
+        with self._close_lock:
+            if self._closed:
+                return False
+            for line in lines:
+                self._queue.put(line)
+            return True
+
+    def flush(self, timeout: float = 10):
+        """Block until everything written so far is on disk"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout: float = 10):
+        """Flush and stop the writer thread; later writes are appended without it"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        with open(self.path, 'a') as f:
+            while True:
+                item = self._queue.get()
+                batch: List[str] = []
+                waiters: List[threading.Event] = []
+                stop = False
+                deadline = time.time() + self.flush_interval
+                # Collect until the batch is full, the interval passes, or someone waits on it
+                while True:
+                    if item is _STOP:
+                        stop = True
+                        break
+                    if isinstance(item, threading.Event):
+                        waiters.append(item)
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if batch:
+                    f.write(''.join(batch))
+                    f.flush()
+                    self.channel.publish([line[:-1] for line in batch])
+                for waiter in waiters:
+                    waiter.set()
+                if stop:
+                    release_log_channel(self.channel)
+                    return
+
+
+_writers: Dict[str, LogWriter] = {}
+_writers_lock = threading.Lock()
+
+def get_log_writer(path: str) -> LogWriter:
+    """The process-wide writer for a log file, created on first use"""
+    path = os.path.expanduser(path)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = LogWriter(path)
+            _writers[path] = writer
+        return writer
+
+def _append_late(path: str, lines: List[str]):
+    """
+    Write lines that arrived after their writer closed: into the file's
+    current writer if a new operation opened one, else straight to the file
+    (holding _writers_lock, so no writer can start appending meanwhile).
+    """
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is not None and writer._put(lines):
+            return
+        # Taken before the write, so a channel created here counts the file without these lines
+        channel = get_log_channel(path)
+        try:
+            with open(path, 'a') as f:
+                f.write(''.join(lines))
+            channel.publish([line[:-1] for line in lines])
+        finally:
+            release_log_channel(channel)
+
+def close_log_writer(path: str):
+    """
+    Flush, close and forget a log file's writer (if it has one), so finished
+    deployments don't each keep a thread and an open file.
+    """
+    path = os.path.expanduser(path)
+    with _writers_lock:
+        writer = _writers.pop(path, None)
+    if writer is not None:
+        writer.close()
+
+def close_all_log_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+atexit.register(close_all_log_writers)
@@ -0,0 +1,260 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Upper bounds (seconds) for timing histograms: sub-second API calls up to half-hour installs
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+# Persist a deployment's spans at most this often while it is being set up
+TIMINGS_FLUSH_INTERVAL = 2.0
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_float(value: float) -> str:
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_float(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts, sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.label_names)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    le = f'le="{_format_float(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+                inf = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, inf)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_float(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+# Process-wide registry, rendered by /metrics
+_metrics: Dict[str, object] = {}
+_metrics_lock = threading.Lock()
+
+def counter(name: str, help: str, label_names: Tuple[str, ...] = ()) -> Counter:
+    """The process-wide counter called name, created on first use"""
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = Counter(name, help, label_names)
+        return _metrics[name]
+
+def histogram(name: str, help: str, label_names: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """The process-wide histogram called name, created on first use"""
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = Histogram(name, help, label_names, buckets)
+        return _metrics[name]
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+PHASE_SECONDS = histogram(
+    'deployment_phase_seconds', 'Duration of deployment phases, per node where the phase is per node',
+    ('phase', 'ok')
+)
+AWS_CALL_SECONDS = histogram('aws_api_call_seconds', 'Duration of EC2 API calls', ('operation',))
+AWS_RETRIES = counter('aws_api_retries_total', 'Retries botocore made for EC2 API calls', ('operation',))
+AWS_ERRORS = counter('aws_api_errors_total', 'EC2 API calls that returned an error', ('operation', 'code'))
+SSH_COMMAND_SECONDS = histogram('ssh_command_seconds', 'Duration of remote commands', ('ok',))
+SSH_CONNECT_SECONDS = histogram('ssh_connect_seconds', 'Time to open a new SSH connection, retries included')
+SSH_CONNECT_RETRIES = counter('ssh_connect_retries_total', 'Failed SSH connection attempts that were retried')
+
+
+# Retries so far, by source ('aws', 'ssh' and 'ssh:<host>'), so a timing span
+# can tell how many happened while it ran. Only sources that ever retried get
+# an entry.
+_retries: Dict[str, int] = {}
+_retries_lock = threading.Lock()
+
+def count_retries(n: int = 1, host: Optional[str] = None):
+    """Note n SSH retries for host, or n EC2 API retries without one"""
+    with _retries_lock:
+        if host is None:
+            _retries['aws'] = _retries.get('aws', 0) + n
+        else:
+            _retries['ssh'] = _retries.get('ssh', 0) + n
+            _retries[f'ssh:{host}'] = _retries.get(f'ssh:{host}', 0) + n
+
+def retries_so_far(host: Optional[str] = None) -> int:
+    """SSH retries for one host, or every EC2 and SSH retry in the process"""
+    with _retries_lock:
+        if host is not None:
+            return _retries.get(f'ssh:{host}', 0)
+        return _retries.get('aws', 0) + _retries.get('ssh', 0)
+
+
+def instrument_boto_client(client):
+    """Time every call a boto3 client makes and count its retries and errors"""
+    service = client.meta.service_model.service_name
+
+    def before_call(model, context, **kwargs):
+        context['metrics_start'] = time.monotonic()
+
+    def after_call(model, parsed, context, **kwargs):
+        start = context.pop('metrics_start', None)
+        if start is not None:
+            AWS_CALL_SECONDS.observe(time.monotonic() - start, operation=model.name)
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            AWS_RETRIES.inc(retries, operation=model.name)
+            count_retries(retries)
+        error = (parsed or {}).get('Error', {}).get('Code')
+        if error:
+            AWS_ERRORS.inc(operation=model.name, code=error)
+
+    client.meta.events.register(f'before-call.{service}', before_call)
+    client.meta.events.register(f'after-call.{service}', after_call)
+
+
+class Timings:
+    """
+    Timing spans for one deployment: {'phase', 'host', 'started_at',
+    'duration', 'ok', 'retries', ...}. Each span is also observed in the
+    deployment_phase_seconds histogram. Spans are handed to persist() in
+    batches (at most every TIMINGS_FLUSH_INTERVAL seconds, and on flush()).
+
+    'retries' counts the retries made while a span ran: SSH connection
+    retries to its host, or for spans without a host every EC2 API and SSH
+    retry in the process (so concurrent operations are counted too).
+    """
+
+    def __init__(self, persist: Callable[[List[Dict]], None]):
+        self.persist = persist
+        self._pending: List[Dict] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    @contextmanager
+    def span(self, phase: str, host: Optional[str] = None, **fields):
+        """Time the with-block; it counts as failed if it raises"""
+        started_at = datetime.utcnow()
+        start = time.monotonic()
+        retries = retries_so_far(host)
+        ok = False
+        try:
+            yield fields
+            ok = True
+        finally:
+            self.add(phase, time.monotonic() - start, host, ok, started_at,
+                     retries=retries_so_far(host) - retries, **fields)
+
+    def add(self, phase: str, duration: float, host: Optional[str] = None, ok: bool = True,
+            started_at: datetime = None, retries: Optional[int] = None, **fields):
+        """Record a span measured elsewhere (e.g. from timestamps); retries if it was counted"""
+        PHASE_SECONDS.observe(duration, phase=phase, ok=str(ok).lower())
+        span = {
+            'phase': phase,
+            'host': host,
+            'started_at': (started_at or datetime.utcnow()).isoformat() + 'Z',
+            'duration': round(duration, 3),
+            'ok': ok,
+        }
+        if retries is not None:
+            span['retries'] = retries
+        span.update(fields)
+        with self._lock:
+            self._pending.append(span)
+            due = time.monotonic() - self._last_flush >= TIMINGS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        if pending:
+            try:
+                self.persist(pending)
+            except Exception as e:
+                print(f"Could not save timings: {e}")
+
+
+def summarize(spans: List[Dict]) -> Dict[str, Dict]:
+    """
+    Per phase: {'count', 'failed', 'retries', 'total', 'max', 'mean',
+    'slowest_host'}, to find the slowest phase and the slowest nodes
+    """
+    result: Dict[str, Dict] = {}
+    for span in spans:
+        phase = result.setdefault(span['phase'], {
+            'count': 0, 'failed': 0, 'retries': 0, 'total': 0.0, 'max': 0.0, 'slowest_host': None
+        })
+        phase['count'] += 1
+        phase['retries'] += span.get('retries', 0)
+        phase['total'] += span['duration']
+        if not span.get('ok', True):
+            phase['failed'] += 1
+        if span['duration'] >= phase['max']:
+            phase['max'] = span['duration']
+            phase['slowest_host'] = span.get('host')
+    for phase in result.values():
+        phase['total'] = round(phase['total'], 3)
+        phase['mean'] = round(phase['total'] / phase['count'], 3)
+    return result
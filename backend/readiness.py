@@ -0,0 +1,70 @@
+import threading
+import time
+from typing import Callable, Dict, List
+from aws_client import AWSClient
+
+FAILED_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+
+class InstanceReadinessTracker:
+    """
+    Watches a fleet of freshly launched instances and reports each one as
+    soon as it is ready, instead of waiting for the slowest one.
+
+    Every round makes one batched describe_instance_status call for all
+    instances that aren't ready yet, plus one describe_instances call for
+    the public IPs of those that just became ready.
+    An instance is ready when it is running and, if require_status_ok, has
+    passed both EC2 status checks.
+    """
+
+    def __init__(self, aws: AWSClient, instance_ids: List[str],
+                 require_status_ok: bool = True,
+                 poll_interval: float = 5.0,
+                 timeout: float = 1200):
+        self.aws = aws
+        self.instance_ids = list(instance_ids)
+        self.require_status_ok = require_status_ok
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.ready: Dict[str, str] = {}  # instance_id -> public ip
+
+    def run(self, on_ready: Callable[[str, str], None],
+            stop_event: threading.Event = None):
+        """
+        Call on_ready(instance_id, public_ip) once per instance as it becomes
+        ready. Returns when all are ready (or stop_event is set); raises if an
+        instance dies or the timeout passes first.
+        """
+        deadline = time.time() + self.timeout
+        while len(self.ready) < len(self.instance_ids):
+            if stop_event is not None and stop_event.is_set():
+                return
+            waiting = [iid for iid in self.instance_ids if iid not in self.ready]
+            statuses = self.aws.get_instance_status(waiting)
+
+            dead = [iid for iid, st in statuses.items() if st['state'] in FAILED_STATES]
+            if dead:
+                raise Exception(f"Instances stopped before becoming ready: {', '.join(dead)}")
+
+            newly_ready = [
+                iid for iid, st in statuses.items()
+                if st['state'] == 'running' and (st['status_ok'] or not self.require_status_ok)
+            ]
+            if newly_ready:
+                ips = self.aws.get_instance_ips(newly_ready)
+                for iid in newly_ready:
+                    ip = ips.get(iid)
+                    if not ip:
+                        continue  # no public IP assigned yet; try again next round
+                    self.ready[iid] = ip
+                    on_ready(iid, ip)
+
+            if len(self.ready) == len(self.instance_ids):
+                return
+            if time.time() > deadline:
+                missing = [iid for iid in self.instance_ids if iid not in self.ready]
+                raise Exception(f"Timed out waiting for instances: {', '.join(missing)}")
+            if stop_event is not None:
+                stop_event.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
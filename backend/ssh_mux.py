@@ -0,0 +1,268 @@
+import codecs
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, List, Optional
+import paramiko
+
+READ_CHUNK = 64 * 1024
+
+class CommandCancelled(Exception):
+    """Raised by CommandHandle.wait() when the command was cancelled"""
+
+class LineSplitter:
+    """
+    Incrementally decodes UTF-8 bytes and calls on_line for every complete line.
+    A partial trailing line is kept as a list of fragments, so a long line
+    arriving in many chunks isn't re-copied on every chunk.
+    """
+
+    def __init__(self, on_line: Callable[[str], None]):
+        self.on_line = on_line
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending: List[str] = []
+
+    def feed(self, data: bytes):
+        text = self._decoder.decode(data)
+        if '\n' not in text:
+            if text:
+                self._pending.append(text)
+            return
+        lines = text.split('\n')
+        if self._pending:
+            self._pending.append(lines[0])
+            lines[0] = ''.join(self._pending)
+            self._pending = []
+        tail = lines.pop()
+        if tail:
+            self._pending.append(tail)
+        for line in lines:
+            self.on_line(line)
+
+    def flush(self):
+        """Emit whatever is left after the stream ended without a newline"""
+        text = self._decoder.decode(b'', final=True)
+        if text:
+            self._pending.append(text)
+        if self._pending:
+            line = ''.join(self._pending)
+            self._pending = []
+            self.on_line(line)
+
+
+class CommandHandle:
+    """A command whose output is being read by a ChannelMultiplexer"""
+
+    def __init__(self, multiplexer: 'ChannelMultiplexer', channel: paramiko.Channel,
+                 on_stdout: Callable[[str], None],
+                 on_stderr: Callable[[str], None],
+                 idle_timeout: Optional[float] = None,
+                 on_quiet: Callable[[], None] = None,
+                 quiet_interval: float = 30):
+        self.multiplexer = multiplexer
+        self.channel = channel
+        self.stdout = LineSplitter(on_stdout)
+        self.stderr = LineSplitter(on_stderr)
+        self.idle_timeout = idle_timeout
+        self.on_quiet = on_quiet
+        self.quiet_interval = quiet_interval
+        self.last_output = time.time()
+        self.last_quiet = self.last_output
+        self.error: Optional[Exception] = None
+        self.fd = -1
+        self.done = threading.Event()
+
+    def wait(self, cancel_event: threading.Event = None) -> int:
+        """
+        Block until the command's output is drained; returns its exit code.
+        If cancel_event gets set first, the channel is closed and
+        CommandCancelled is raised.
+        """
+        if cancel_event is not None:
+            while not self.done.wait(0.25):
+                if cancel_event.is_set():
+                    self.multiplexer.cancel(self, CommandCancelled("Command cancelled"))
+                    break
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.channel.recv_exit_status()
+
+
+class ChannelMultiplexer:
+    """
+    Reads many paramiko channels from a single I/O thread.
+    Every channel's fileno() is registered with a selector, so the thread
+    sleeps until one of them has data instead of polling each channel.
+    """
+
+    def __init__(self, select_timeout: float = 1.0):
+        self.select_timeout = select_timeout
+        self._selector = selectors.DefaultSelector()
+        self._pending: List[CommandHandle] = []
+        self._cancelling: List = []
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._handles = set()
+        self._thread = None
+        self._next_timer_check = 0.0
+
+    def watch(self, channel: paramiko.Channel,
+              on_stdout: Callable[[str], None],
+              on_stderr: Callable[[str], None],
+              idle_timeout: Optional[float] = None,
+              on_quiet: Callable[[], None] = None) -> CommandHandle:
+        """
+        Start reading a channel on which a command was already started.
+        on_stdout/on_stderr get one decoded line at a time (without the newline).
+        If idle_timeout is set and the command prints nothing for that long,
+        the channel is closed and wait() raises TimeoutError.
+        """
+        handle = CommandHandle(self, channel, on_stdout, on_stderr, idle_timeout, on_quiet)
+        # Create the notification pipe now; the selector tracks its fd rather
+        # than the channel, since fileno() would make a fresh pipe once closed
+        handle.fd = channel.fileno()
+        with self._lock:
+            self._pending.append(handle)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        self._wake_w.send(b'\0')
+        return handle
+
+    def cancel(self, handle: CommandHandle, error: Exception):
+        """Stop reading a handle and close its channel (done on the I/O thread)"""
+        with self._lock:
+            self._cancelling.append((handle, error))
+        self._wake_w.send(b'\0')
+
+    def _loop(self):
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                # Never let the shared I/O thread die: every command in the
+                # process would hang in wait(). We can't tell which channel broke
+                # the selector, so fail everything it was watching and start over.
+                print(f"SSH multiplexer error, failing {len(self._handles)} commands: {e}")
+                self._reset(e)
+                time.sleep(0.1)
+
+    def _step(self):
+        for key, _ in self._selector.select(self.select_timeout):
+            if key.data is None:
+                self._drain_wakeups()
+            else:
+                self._service(key.data)
+        self._add_pending()
+        now = time.time()
+        if now >= self._next_timer_check:
+            self._next_timer_check = now + self.select_timeout
+            self._check_timers(now)
+
+    def _reset(self, error: Exception):
+        for handle in list(self._handles):
+            self._finish(handle, error)
+            try:
+                handle.channel.close()
+            except Exception:
+                pass
+        try:
+            self._selector.close()
+        except Exception:
+            pass
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _add_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            cancelling, self._cancelling = self._cancelling, []
+        for handle in pending:
+            try:
+                self._selector.register(handle.fd, selectors.EVENT_READ, handle)
+            except Exception as e:
+                handle.error = e
+                handle.done.set()
+                continue
+            self._handles.add(handle)
+            # Data may have arrived before registration
+            self._service(handle)
+        for handle, error in cancelling:
+            # Unregister before closing, so the fd can't be reused while still selected
+            self._finish(handle, error)
+            try:
+                handle.channel.close()
+            except Exception:
+                pass
+
+    def _service(self, handle: CommandHandle):
+        channel = handle.channel
+        try:
+            got_data = False
+            while channel.recv_ready():
+                data = channel.recv(READ_CHUNK)
+                if not data:
+                    break
+                handle.stdout.feed(data)
+                got_data = True
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(READ_CHUNK)
+                if not data:
+                    break
+                handle.stderr.feed(data)
+                got_data = True
+            if got_data:
+                handle.last_output = handle.last_quiet = time.time()
+            if (channel.eof_received or channel.closed) and not (
+                    channel.recv_ready() or channel.recv_stderr_ready()):
+                self._finish(handle)
+        except Exception as e:
+            self._finish(handle, e)
+
+    def _check_timers(self, now: float):
+        for handle in list(self._handles):
+            if handle.idle_timeout and now - handle.last_output > handle.idle_timeout:
+                self._finish(handle, TimeoutError(
+                    f"No output for {handle.idle_timeout}s"
+                ))
+                try:
+                    handle.channel.close()
+                except Exception:
+                    pass
+            elif handle.on_quiet and now - handle.last_quiet > handle.quiet_interval:
+                handle.last_quiet = now
+                try:
+                    handle.on_quiet()
+                except Exception:
+                    pass
+
+    def _finish(self, handle: CommandHandle, error: Exception = None):
+        if handle not in self._handles:
+            return
+        self._handles.discard(handle)
+        try:
+            self._selector.unregister(handle.fd)
+        except (KeyError, ValueError):
+            pass
+        try:
+            handle.stdout.flush()
+            handle.stderr.flush()
+        except Exception as e:
+            error = error or e
+        handle.error = error
+        handle.done.set()
+
+
+# Shared by every SSHRunner in the process: one I/O thread for all channels
+default_multiplexer = ChannelMultiplexer()
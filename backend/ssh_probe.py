@@ -0,0 +1,216 @@
+import errno
+import random
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Maps (host, port) to the address actually dialed for SSH. Replaceable, e.g.
+# to go through local port forwards or (in the benchmarks) to stand-in servers.
+_address_resolver: Callable[[str, int], Tuple[str, int]] = lambda host, port: (host, port)
+
+def set_address_resolver(resolver: Callable[[str, int], Tuple[str, int]]):
+    global _address_resolver
+    _address_resolver = resolver
+
+def resolve_address(host: str, port: int = 22) -> Tuple[str, int]:
+    return _address_resolver(host, port)
+
+def jittered_backoff(attempt: int, initial: float, maximum: float) -> float:
+    """Exponential backoff for the given attempt (0-based), with +/-50% jitter"""
+    delay = min(maximum, initial * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class _Target:
+    def __init__(self, host: str, on_ready: Callable[[str], None],
+                 on_failed: Callable[[str, str], None], deadline: float):
+        self.host = host
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.deadline = deadline
+        self.attempt = 0
+        self.next_attempt = 0.0
+        self.sock: Optional[socket.socket] = None
+        self.attempt_deadline = 0.0
+        self.banner = b''
+        self.last_error = 'not attempted'
+
+
+class SSHProbe:
+    """
+    Finds out when hosts start accepting SSH, without blocking a thread per host.
+
+    A single thread does non-blocking TCP connects to port 22 on every pending
+    host and reads the server's identification banner ("SSH-2.0-..."), which
+    only appears once sshd is actually up. Failed attempts are retried with
+    jittered exponential backoff until the host's deadline.
+    """
+
+    def __init__(self, port: int = 22,
+                 deadline: float = 600,
+                 initial_backoff: float = 1.0,
+                 max_backoff: float = 15.0,
+                 attempt_timeout: float = 5.0):
+        self.port = port
+        self.deadline = deadline
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.attempt_timeout = attempt_timeout
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending: List[_Target] = []
+        self._targets: List[_Target] = []
+        self._outstanding = 0
+        self._results: Dict[str, Optional[str]] = {}  # host -> None (ready) or error
+        self._idle = threading.Condition(self._lock)
+        self._stopped = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def add(self, host: str, on_ready: Callable[[str], None] = None,
+            on_failed: Callable[[str, str], None] = None):
+        """
+        Start probing host. on_ready(host) is called (from the probe thread)
+        once it answers with an SSH banner; on_failed(host, error) if the
+        deadline passes first.
+        """
+        target = _Target(host, on_ready, on_failed, time.time() + self.deadline)
+        with self._lock:
+            self._pending.append(target)
+            self._outstanding += 1
+        self._wake_w.send(b'\0')
+
+    def wait(self, timeout: float = None) -> Dict[str, Optional[str]]:
+        """Wait until every added host is ready or failed; returns {host: error or None}"""
+        with self._lock:
+            self._idle.wait_for(lambda: self._outstanding == 0 or self._stopped, timeout)
+            return dict(self._results)
+
+    def stop(self):
+        """Abandon all pending probes"""
+        with self._lock:
+            self._stopped = True
+            self._idle.notify_all()
+        self._wake_w.send(b'\0')
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    break
+                self._targets.extend(self._pending)
+                self._pending = []
+            now = time.time()
+            for target in list(self._targets):
+                self._tick(target, now)
+            timeout = self._next_timeout()
+            for key, events in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._on_event(key.data, events)
+        for target in self._targets:
+            self._close(target)
+
+    def _next_timeout(self) -> float:
+        now = time.time()
+        wakeups = [
+            t.attempt_deadline if t.sock is not None else t.next_attempt
+            for t in self._targets
+        ]
+        if not wakeups:
+            return 1.0
+        return max(0.0, min(min(wakeups) - now, 1.0))
+
+    def _tick(self, target: _Target, now: float):
+        if target.sock is not None:
+            if now > target.attempt_deadline:
+                self._retry(target, 'timed out')
+            return
+        if now >= target.deadline:
+            self._done(target, f"no SSH banner within {self.deadline:.0f}s ({target.last_error})")
+        elif now >= target.next_attempt:
+            self._connect(target, now)
+
+    def _connect(self, target: _Target, now: float):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        target.sock = sock
+        target.banner = b''
+        target.attempt_deadline = now + self.attempt_timeout
+        try:
+            rc = sock.connect_ex(resolve_address(target.host, self.port))
+        except OSError as e:
+            self._retry(target, str(e))
+            return
+        if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._retry(target, errno.errorcode.get(rc, str(rc)))
+            return
+        self._selector.register(sock, selectors.EVENT_WRITE, target)
+
+    def _on_event(self, target: _Target, events: int):
+        sock = target.sock
+        if sock is None:
+            return
+        if events & selectors.EVENT_WRITE:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._retry(target, errno.errorcode.get(err, str(err)))
+                return
+            # Connected; now wait for the server to identify itself
+            self._selector.modify(sock, selectors.EVENT_READ, target)
+            return
+        try:
+            data = sock.recv(256)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._retry(target, str(e))
+            return
+        if not data:
+            self._retry(target, 'connection closed before banner')
+            return
+        target.banner += data
+        if target.banner.startswith(b'SSH-'):
+            self._done(target, None)
+        elif b'\n' in target.banner or len(target.banner) >= 256:
+            self._retry(target, 'unexpected banner')
+
+    def _retry(self, target: _Target, error: str):
+        self._close(target)
+        target.last_error = error
+        target.next_attempt = time.time() + jittered_backoff(target.attempt, self.initial_backoff, self.max_backoff)
+        target.attempt += 1
+
+    def _close(self, target: _Target):
+        if target.sock is not None:
+            try:
+                self._selector.unregister(target.sock)
+            except (KeyError, ValueError):
+                pass
+            target.sock.close()
+            target.sock = None
+
+    def _done(self, target: _Target, error: Optional[str]):
+        self._close(target)
+        self._targets.remove(target)
+        try:
+            if error is None and target.on_ready:
+                target.on_ready(target.host)
+            elif error is not None and target.on_failed:
+                target.on_failed(target.host, error)
+        except Exception as e:
+            print(f"SSH probe callback for {target.host} failed: {e}")
+        with self._lock:
+            self._results[target.host] = error
+            self._outstanding -= 1
+            self._idle.notify_all()
@@ -1,64 +1,253 @@
 import paramiko
+import atexit
 import threading
-import select
 import time
-from typing import Callable, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import os
+import posixpath
+from fanout import AnyEvent, FanOut, HostResult, describe_failures, run_fanout, DEFAULT_MAX_CONCURRENCY
+from file_transfer import (
+    CHUNK_SIZE, FileEntry, RelaySources, TransferResult, build_manifest, checksum_command,
+    fetch_command, mkdir_command, parse_checksums, remote_root, serve_command, stop_serving_command
+)
+from ssh_mux import ChannelMultiplexer, CommandCancelled, default_multiplexer
+from ssh_probe import jittered_backoff, resolve_address
+from metrics import SSH_COMMAND_SECONDS, SSH_CONNECT_RETRIES, SSH_CONNECT_SECONDS, count_retries
+
+_key_cache: Dict[Tuple[str, int], paramiko.PKey] = {}
+_key_lock = threading.Lock()
+
+def load_private_key(key_path: str) -> paramiko.PKey:
+    """
+    Load a private key (RSA, ED25519 or ECDSA), cached process-wide.
+    The cache is keyed by path and mtime so a replaced key file is re-read.
+    """
+    key_path = os.path.expanduser(key_path)
+    cache_key = (key_path, os.stat(key_path).st_mtime_ns)
+    with _key_lock:
+        key = _key_cache.get(cache_key)
+        if key is not None:
+            return key
 
-class SSHRunner:
-    def __init__(self, key_path: str, username: str = 'ubuntu'):
-        self.key_path = os.path.expanduser(key_path)
-        self.username = username
-        
         # Try to load the key - handle both RSA and ED25519, and different formats
         try:
-            self.key = paramiko.RSAKey.from_private_key_file(self.key_path)
+            key = paramiko.RSAKey.from_private_key_file(key_path)
         except Exception:
             try:
-                self.key = paramiko.Ed25519Key.from_private_key_file(self.key_path)
+                key = paramiko.Ed25519Key.from_private_key_file(key_path)
             except Exception:
                 try:
-                    self.key = paramiko.ECDSAKey.from_private_key_file(self.key_path)
+                    key = paramiko.ECDSAKey.from_private_key_file(key_path)
                 except Exception as e:
-                    raise Exception(f"Could not load SSH key from {self.key_path}. Error: {e}")
+                    raise Exception(f"Could not load SSH key from {key_path}. Error: {e}")
+        _key_cache[cache_key] = key
+        return key
+
+
+class _PooledConnection:
+    def __init__(self, client: paramiko.SSHClient):
+        self.client = client
+        self.active = 0
+        self.last_used = time.time()
+
+    @property
+    def transport(self) -> Optional[paramiko.Transport]:
+        return self.client.get_transport()
+
+    def is_alive(self) -> bool:
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+
+class SSHConnectionPool:
+    """
+    Keeps one authenticated SSH transport per (ip, username) alive across
+    commands. Each command opens its own channel on the shared transport.
+    Broken transports are replaced on next use; idle ones are closed by a
+    background reaper. The first connection to a host is retried with
+    jittered exponential backoff for up to connect_deadline seconds.
+    """
+
+    def __init__(self, keepalive: int = 30, idle_timeout: int = 300,
+                 connect_deadline: float = 300, initial_backoff: float = 2, max_backoff: float = 30):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.connect_deadline = connect_deadline
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._connections: Dict[Tuple[str, str], _PooledConnection] = {}
+        self._host_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._connected_once = set()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def acquire(self, ip: str, username: str, pkey: paramiko.PKey,
+                log_callback: Callable[[str], None] = None,
+                cancel_event: threading.Event = None) -> paramiko.Transport:
+        """
+        Return a live transport to ip, connecting if needed.
+        Every acquire() must be paired with a release().
+        """
+        key = (ip, username)
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+            self._start_reaper()
+
+        # Per-host lock: concurrent commands to one host share a single handshake
+        with host_lock:
+            with self._lock:
+                conn = self._connections.get(key)
+            if conn is None or not conn.is_alive():
+                if conn is not None:
+                    conn.client.close()
+                conn = _PooledConnection(self._connect(ip, username, pkey, log_callback, cancel_event))
+                with self._lock:
+                    self._connections[key] = conn
+                    self._connected_once.add(key)
+            with self._lock:
+                conn.active += 1
+                conn.last_used = time.time()
+            return conn.transport
+
+    def release(self, ip: str, username: str):
+        with self._lock:
+            conn = self._connections.get((ip, username))
+            if conn is not None:
+                conn.active = max(0, conn.active - 1)
+                conn.last_used = time.time()
+
+    def evict(self, ip: str, username: str):
+        """Drop (and close) the pooled connection to a host, e.g. after an error"""
+        with self._lock:
+            conn = self._connections.pop((ip, username), None)
+        if conn is not None:
+            conn.client.close()
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.client.close()
+
+    def _connect(self, ip: str, username: str, pkey: paramiko.PKey,
+                 log_callback: Callable[[str], None] = None,
+                 cancel_event: threading.Event = None) -> paramiko.SSHClient:
+        # Only the first connection to a host gets the long retry loop (the
+        # instance may still be booting); reconnects fail fast
+        first_connect = (ip, username) not in self._connected_once
+        deadline = time.time() + (self.connect_deadline if first_connect else 0)
+
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            address, port = resolve_address(ip)
+            try:
+                client.connect(
+                    address, 
+                    port=port,
+                    username=username, 
+                    pkey=pkey,
+                    timeout=30
+                )
+                client.get_transport().set_keepalive(self.keepalive)
+                SSH_CONNECT_SECONDS.observe(time.monotonic() - start)
+                if log_callback:
+                    log_callback(f"[{ip}] Connection successful")
+                return client
+            except Exception:
+                client.close()
+                delay = jittered_backoff(attempt, self.initial_backoff, self.max_backoff)
+                if time.time() + delay > deadline:
+                    raise  # Final attempt failed
+                attempt += 1
+                SSH_CONNECT_RETRIES.inc()
+                count_retries(host=ip)
+                if log_callback:
+                    log_callback(f"[{ip}] Connection attempt {attempt} failed, retrying in {delay:.1f}s...")
+                if cancel_event is not None:
+                    if cancel_event.wait(delay):
+                        raise CommandCancelled(f"[{ip}] Connection cancelled")
+                else:
+                    time.sleep(delay)
+
+    def _start_reaper(self):
+        """Start the idle-connection reaper thread (caller holds self._lock)"""
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(60, self.idle_timeout))
+            now = time.time()
+            with self._lock:
+                stale = [
+                    key for key, conn in self._connections.items()
+                    if conn.active == 0 and (now - conn.last_used > self.idle_timeout or not conn.is_alive())
+                ]
+                closing = [self._connections.pop(key) for key in stale]
+            for conn in closing:
+                conn.client.close()
+
+
+# Shared by every SSHRunner in the process
+default_pool = SSHConnectionPool()
+atexit.register(default_pool.close_all)
+
+
+class _PooledSFTP:
+    """SFTPClient that hands its pooled connection back when closed"""
+
+    def __init__(self, sftp: paramiko.SFTPClient, release: Callable[[], None]):
+        self.sftp = sftp
+        self._release = release
+
+    def __enter__(self) -> paramiko.SFTPClient:
+        return self.sftp
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.sftp.close()
+        finally:
+            self._release()
+        return False
+
+
+class SSHRunner:
+    def __init__(self, key_path: str, username: str = 'ubuntu',
+                 pool: SSHConnectionPool = None,
+                 multiplexer: ChannelMultiplexer = None):
+        self.key_path = os.path.expanduser(key_path)
+        self.username = username
+        self.pool = pool or default_pool
+        self.multiplexer = multiplexer or default_multiplexer
+        self.key = load_private_key(self.key_path)
     
     def run_command(self, ip: str, command: str, 
                     log_callback: Callable[[str], None] = None,
                     timeout: int = 600,
                     use_pty: bool = True,
-                    background: bool = False) -> int:
+                    background: bool = False,
+                    cancel_event: threading.Event = None) -> int:
         """
         Run a command via SSH on a remote host.
+        Reuses a pooled connection and opens one channel for the command.
         Calls log_callback with each line of output.
+        `timeout` is how long the command may go without printing anything.
+        Setting cancel_event aborts the command with CommandCancelled.
         Returns exit code.
         """
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # Retry connection up to 10 times (5 minutes total)
-        max_retries = 10
-        for attempt in range(max_retries):
-            try:
-                client.connect(
-                    ip, 
-                    username=self.username, 
-                    pkey=self.key,
-                    timeout=30
-                )
-                if log_callback:
-                    log_callback(f"[{ip}] Connection successful")
-                break  # Connection successful
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    if log_callback:
-                        log_callback(f"[{ip}] Connection attempt {attempt + 1} failed, retrying in 30s...")
-                    time.sleep(30)
-                else:
-                    raise  # Final attempt failed
+        channel = self._open_channel(ip, log_callback, cancel_event)
+        start = time.monotonic()
+        rc = None
         
         try:
-            stdin, stdout, stderr = client.exec_command(command, get_pty=use_pty, timeout=timeout)
-            
+            if use_pty:
+                channel.get_pty()
+            channel.exec_command(command)
             if background:
                 # For background commands, don't wait - just close and return
                 if log_callback:
@@ -66,95 +255,227 @@ class SSHRunner:
                 time.sleep(1)  # Give it a moment to start
                 return 0
             
-            # Read output with progress updates
-            last_log_time = time.time()
-            output_buffer = ""
-            error_buffer = ""
+            def log_line(prefix: str):
+                def emit(line: str):
+                    if log_callback and line.strip():
+                        log_callback(f"[{ip}] {prefix}{line.strip()}")
+                return emit
             
-            while not stdout.channel.exit_status_ready():
-                # Check if there's data to read
-                if stdout.channel.recv_ready():
-                    chunk = stdout.channel.recv(1024).decode('utf-8', errors='replace')
-                    output_buffer += chunk
-                    
-                    # Log complete lines
-                    while '\n' in output_buffer:
-                        line, output_buffer = output_buffer.split('\n', 1)
-                        if log_callback and line.strip():
-                            log_callback(f"[{ip}] {line.strip()}")
-                        last_log_time = time.time()
-                
-                if stdout.channel.recv_stderr_ready():
-                    chunk = stdout.channel.recv_stderr(1024).decode('utf-8', errors='replace')
-                    error_buffer += chunk
-                    
-                    # Log complete lines
-                    while '\n' in error_buffer:
-                        line, error_buffer = error_buffer.split('\n', 1)
-                        if log_callback and line.strip():
-                            log_callback(f"[{ip}] ERROR: {line.strip()}")
-                        last_log_time = time.time()
-                
+            def still_running():
                 # Send periodic "still running" message
-                if time.time() - last_log_time > 30:
-                    if log_callback:
-                        log_callback(f"[{ip}] Still running... (no output for 30s)")
-                    last_log_time = time.time()
-                
-                time.sleep(0.1)  # Small delay to avoid busy waiting
-            
-            # Read any remaining output
-            remaining_out = stdout.read().decode('utf-8', errors='replace')
-            if remaining_out and log_callback:
-                for line in remaining_out.split('\n'):
-                    if line.strip():
-                        log_callback(f"[{ip}] {line.strip()}")
-            
-            remaining_err = stderr.read().decode('utf-8', errors='replace')
-            if remaining_err and log_callback:
-                for line in remaining_err.split('\n'):
-                    if line.strip():
-                        log_callback(f"[{ip}] ERROR: {line.strip()}")
+                if log_callback:
+                    log_callback(f"[{ip}] Still running... (no output for 30s)")
             
-            exit_code = stdout.channel.recv_exit_status()
-            return exit_code
+            # Output is read by the shared I/O thread; we just wait for the exit code
+            handle = self.multiplexer.watch(
+                channel,
+                on_stdout=log_line(""),
+                on_stderr=log_line("ERROR: "),
+                idle_timeout=timeout,
+                on_quiet=still_running
+            )
+            rc = handle.wait(cancel_event)
+            return rc
             
         finally:
-            client.close()
+            if not background:
+                # Timed-out, cancelled and failed commands count too (as ok="false")
+                SSH_COMMAND_SECONDS.observe(time.monotonic() - start, ok=str(rc == 0).lower())
+            channel.close()
+            self.pool.release(ip, self.username)
+
+    def _open_channel(self, ip: str, log_callback: Callable[[str], None] = None,
+                      cancel_event: threading.Event = None) -> paramiko.Channel:
+        """Open a session channel on the pooled transport, retrying once (on a new connection if it died)"""
+        for attempt in range(2):
+            transport = self.pool.acquire(ip, self.username, self.key, log_callback, cancel_event)
+            try:
+                return transport.open_session(timeout=30)
+            except Exception:
+                self.pool.release(ip, self.username)
+                # A live transport may just be refusing more sessions (MaxSessions) or
+                # slow to answer; closing it would kill every other command on it
+                if not transport.is_active():
+                    self.pool.evict(ip, self.username)
+                if attempt == 1:
+                    raise
     
+    def run_capture(self, ip: str, command: str, cancel_event: threading.Event = None,
+                    timeout: int = 600) -> Tuple[int, List[str]]:
+        """Run a command and return (exit code, stdout lines) instead of logging its output"""
+        lines: List[str] = []
+        channel = self._open_channel(ip, None, cancel_event)
+        try:
+            channel.exec_command(command)
+            handle = self.multiplexer.watch(channel, on_stdout=lines.append,
+                                            on_stderr=lambda line: None, idle_timeout=timeout)
+            return handle.wait(cancel_event), lines
+        finally:
+            channel.close()
+            self.pool.release(ip, self.username)
+
+    def broadcast(self, local_path: str, remote_dir: str, hosts: List[str],
+                  log_callback: Callable[[str], None] = None,
+                  max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                  relay: bool = False,
+                  relay_fanout: int = 4,
+                  skip: Tuple[str, ...] = (),
+                  cancel_event: threading.Event = None) -> List[TransferResult]:
+        """
+        Push a local file or directory (except names in skip) into remote_dir
+        on every host. Files whose remote sha256 already matches are skipped;
+        the rest go over pipelined SFTP writes to '<name>.part' and are then
+        renamed into place.
+        With relay=True only relay_fanout hosts are uploaded to from here;
+        every host that has everything serves it over HTTP to up to
+        relay_fanout others, so the tree grows without going through the
+        launcher's uplink. A failed relay falls back to a direct upload.
+        Relay servers listen on the nodes' private IPs and are stopped once
+        the broadcast is over.
+        Setting cancel_event aborts every host's transfer.
+        Returns one TransferResult per host (with throughput), in host order.
+        """
+        entries = build_manifest(local_path, skip)
+        root = remote_root(remote_dir)
+        sources = RelaySources(direct_slots=relay_fanout if relay else max_concurrency,
+                               per_seed=relay_fanout, relay=relay)
+        results = {host: TransferResult(host) for host in hosts}
+        fanout = FanOut(max_concurrency=max_concurrency)
+        for host in hosts:
+            fanout.submit(host, lambda host_cancel, host=host: self._broadcast_to(
+                host, entries, root, sources, results[host], AnyEvent(cancel_event, host_cancel)
+            ))
+        try:
+            for host_result in fanout.wait():
+                result = results[host_result.host]
+                if not host_result.ok and result.status == 'pending':
+                    result.status = host_result.status
+                    result.error = host_result.error
+        finally:
+            # Every server started, including those that never became seeds
+            servers = sources.servers
+            if servers:
+                run_fanout({
+                    server: lambda cancel_event, server=server: self.run_capture(
+                        server, stop_serving_command(), cancel_event)[0]
+                    for server in servers
+                }, max_concurrency=max_concurrency)
+        if log_callback:
+            for host in hosts:
+                log_callback(f"[{host}] Transfer {results[host].describe()}")
+        return [results[host] for host in hosts]
+
+    def _broadcast_to(self, ip: str, entries: List[FileEntry], root: str, sources: RelaySources,
+                      result: TransferResult, cancel_event: threading.Event):
+        start = time.time()
+        try:
+            rc, lines = self.run_capture(ip, checksum_command(root, entries), cancel_event)
+            remote = parse_checksums(lines) if rc == 0 else {}
+            needed = [e for e in entries if remote.get(e.rel_path) != e.sha256]
+            result.files_skipped = len(entries) - len(needed)
+            if needed:
+                source = sources.acquire(cancel_event)
+                if source is not None:
+                    rc = None
+                    try:
+                        rc, _ = self.run_capture(ip, fetch_command(root, needed, sources.address(source)),
+                                                 cancel_event)
+                    finally:
+                        sources.release(source, ok=None if rc is None else rc == 0)
+                    if rc == 0:
+                        result.source = source
+                    else:
+                        source = sources.acquire(cancel_event, allow_relay=False)
+                if source is None:
+                    try:
+                        self._sftp_put(ip, root, needed, cancel_event)
+                    finally:
+                        sources.release(None)
+                result.files_sent = len(needed)
+                result.bytes_sent = sum(e.size for e in needed)
+            result.status = 'ok'
+        except Exception as e:
+            result.status = 'cancelled' if isinstance(e, CommandCancelled) else 'failed'
+            result.error = str(e)
+            raise
+        finally:
+            result.duration = time.time() - start
+        if sources.relay:
+            # Everything is here now; let other hosts fetch from this one
+            # (fetchers retry until the server is listening)
+            sources.add_server(ip)
+            rc, lines = self.run_capture(ip, serve_command(root), cancel_event)
+            if rc == 0 and lines:
+                sources.add_seed(ip, lines[-1].strip())
+
+    def _sftp_put(self, ip: str, root: str, entries: List[FileEntry], cancel_event: threading.Event = None):
+        rc, _ = self.run_capture(ip, mkdir_command(root, entries), cancel_event)
+        if rc != 0:
+            raise Exception(f"[{ip}] Could not create {root} (exit code {rc})")
+        with self._open_sftp(ip, None, cancel_event) as sftp:
+            for entry in entries:
+                target = posixpath.join(root, entry.rel_path)
+                with open(entry.local_path, 'rb') as src, sftp.open(target + '.part', 'wb') as dst:
+                    # Don't wait for each write's ack; paramiko checks them all on close
+                    dst.set_pipelined(True)
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise CommandCancelled(f"[{ip}] Upload cancelled")
+                        dst.write(chunk)
+                sftp.posix_rename(target + '.part', target)
+
+    def download_dir(self, ip: str, remote_dir: str, local_dir: str,
+                     log_callback: Callable[[str], None] = None,
+                     cancel_event: threading.Event = None) -> int:
+        """Copy the files of a flat remote directory into local_dir; returns bytes received"""
+        os.makedirs(local_dir, exist_ok=True)
+        received = 0
+        with self._open_sftp(ip, log_callback, cancel_event) as sftp:
+            for attr in sftp.listdir_attr(remote_dir):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CommandCancelled(f"[{ip}] Download cancelled")
+                sftp.get(f"{remote_dir}/{attr.filename}", os.path.join(local_dir, attr.filename))
+                received += attr.st_size or 0
+        return received
+
+    def _open_sftp(self, ip: str, log_callback: Callable[[str], None] = None,
+                   cancel_event: threading.Event = None) -> '_PooledSFTP':
+        """An SFTP session over the pooled connection (use as a context manager)"""
+        channel = self._open_channel(ip, log_callback, cancel_event)
+        try:
+            channel.invoke_subsystem('sftp')
+            return _PooledSFTP(paramiko.SFTPClient(channel), lambda: self.pool.release(ip, self.username))
+        except Exception:
+            channel.close()
+            self.pool.release(ip, self.username)
+            raise
+
     def run_parallel(self, commands: List[Tuple[str, str]], 
                 log_callback: Callable[[str], None] = None,
                 use_pty: bool = True,
-                background: bool = False):
+                background: bool = False,
+                max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                host_timeout: float = None,
+                fail_fast: bool = False) -> List[HostResult]:
         """
-        Run multiple SSH commands in parallel.
+        Run multiple SSH commands in parallel, at most max_concurrency at a time.
         commands: List of (ip, command) tuples
-        Raises exception if any command fails.
+        With fail_fast=True the first failure cancels the remaining hosts.
+        Returns per-host results; raises exception if any command fails.
         """
-        results = []
-        threads = []
-        
-        def run_and_store(ip, command):
-            try:
-                exit_code = self.run_command(ip, command, log_callback, use_pty=use_pty, background=background)
-                results.append((ip, exit_code))
-            except Exception as e:
-                results.append((ip, e))
-        
+        fanout = FanOut(max_concurrency=max_concurrency,
+                        host_timeout=host_timeout,
+                        fail_fast=fail_fast and not background)
         for ip, command in commands:
-            thread = threading.Thread(
-                target=run_and_store,
-                args=(ip, command)
-            )
-            thread.start()
-            threads.append(thread)
-        
-        for thread in threads:
-            thread.join()
+            fanout.submit(ip, lambda cancel_event, ip=ip, command=command: self.run_command(
+                ip, command, log_callback, use_pty=use_pty, background=background,
+                cancel_event=cancel_event
+            ))
+        results = fanout.wait()
         
         # Check for failures (skip for background commands)
         if not background:
-            failures = [(ip, result) for ip, result in results if isinstance(result, Exception) or result != 0]
-            if failures:
-                error_msg = "\n".join([f"{ip}: {result}" for ip, result in failures])
-                raise Exception(f"Some worker setups failed:\n{error_msg}")
\ No newline at end of file
+            error_msg = describe_failures(results)
+            if error_msg:
+                raise Exception(f"Some worker setups failed:\n{error_msg}")
+        return results
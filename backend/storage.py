@@ -1,37 +1,465 @@
 import json
 import os
-from typing import Dict, List, Optional
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional
+
+SCHEMA_VERSION = 4
 
 class Storage:
+    """
+    SQLite-backed deployment store.
+    One row per deployment, keyed by id, so reads and writes of a single
+    deployment don't depend on how many deployments exist.
+
+    Deployments are also kept in an in-memory write-through cache. Every
+    change bumps a monotonic version counter stored alongside the rows, so
+    the cache only re-reads rows newer than the version it has seen when the
+    database file is changed by someone else.
+    The cache holds each row's committed JSON, so getters hand out fresh
+    dicts: callers may change what they get and save it, and nothing they do
+    to it reaches the cache or other callers until it is saved.
+    """
+
     def __init__(self, data_dir: str = "~/.aws-deployment-manager"):
         self.data_dir = os.path.expanduser(data_dir)
+        self.db_file = os.path.join(self.data_dir, "deployments.db")
+        # Legacy whole-file store, migrated into the database on first start
         self.deployments_file = os.path.join(self.data_dir, "deployments.json")
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._cache: Dict[str, str] = {}     # id -> committed JSON
+        self._statuses: Dict[str, str] = {}  # id -> status, for filtering without parsing
+        self._row_versions: Dict[str, int] = {}
+        self._created_versions: Dict[str, int] = {}
+        self._removed: Dict[str, int] = {}
+        self._version = 0
+        self._signature = None
         self._ensure_dirs()
-    
+        self._init_schema()
+        self._migrate_json()
+        self._refresh()
+
     def _ensure_dirs(self):
         os.makedirs(self.data_dir, exist_ok=True)
         os.makedirs(os.path.join(self.data_dir, "logs"), exist_ok=True)
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections aren't thread-safe)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: we issue BEGIN/COMMIT ourselves
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def _init_schema(self):
+        with self._transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS deployments ("
+                    "id TEXT PRIMARY KEY, "
+                    "status TEXT, "
+                    "created_at TEXT, "
+                    "data TEXT NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_deployments_status ON deployments(status)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_deployments_created_at ON deployments(created_at)")
+            if version < 2:
+                conn.execute("ALTER TABLE deployments ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE deployments ADD COLUMN created_version INTEGER NOT NULL DEFAULT 0")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_deployments_version ON deployments(version)")
+                conn.execute("CREATE TABLE IF NOT EXISTS tombstones (id TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_tombstones_version ON tombstones(version)")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+                # Rows carried over from schema 1 become version 1
+                if conn.execute("SELECT COUNT(*) FROM deployments").fetchone()[0]:
+                    conn.execute("UPDATE deployments SET version = 1, created_version = 1")
+                    conn.execute("UPDATE meta SET value = '1' WHERE key = 'version'")
+            if version < 3:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id TEXT PRIMARY KEY, "
+                    "deployment_id TEXT, "
+                    "status TEXT, "
+                    "created_at TEXT, "
+                    "data TEXT NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_deployment ON jobs(deployment_id, created_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+            if version < 4:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS timings ("
+                    "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "deployment_id TEXT NOT NULL, "
+                    "data TEXT NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_timings_deployment ON timings(deployment_id, seq)")
+                # Spans used to be kept in the deployment record itself
+                rows = conn.execute("SELECT id, data FROM deployments WHERE data LIKE '%\"timings\"%'").fetchall()
+                for deployment_id, data in rows:
+                    deployment = json.loads(data)
+                    spans = deployment.pop('timings', None) or []
+                    conn.executemany("INSERT INTO timings (deployment_id, data) VALUES (?, ?)",
+                                     [(deployment_id, json.dumps(span)) for span in spans])
+                    conn.execute("UPDATE deployments SET data = ? WHERE id = ?", (json.dumps(deployment), deployment_id))
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate_json(self):
+        """One-time import of the old deployments.json file"""
         if not os.path.exists(self.deployments_file):
-            with open(self.deployments_file, 'w') as f:
-                json.dump({}, f)
-    
+            return
+        try:
+            with open(self.deployments_file, 'r') as f:
+                deployments = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not migrate {self.deployments_file}: {e}")
+            return
+
+        with self._transaction() as conn:
+            for deployment in deployments.values():
+                # Never clobber rows that were written after a previous migration
+                exists = conn.execute(
+                    "SELECT 1 FROM deployments WHERE id = ?", (deployment['id'],)
+                ).fetchone()
+                if not exists:
+                    self._write(conn, deployment)
+        os.replace(self.deployments_file, self.deployments_file + ".migrated")
+        print(f"Migrated {len(deployments)} deployments into {self.db_file}")
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection) -> int:
+        """Increment the global change counter; must run inside a transaction"""
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    @staticmethod
+    def _write_row(conn: sqlite3.Connection, deployment: Dict, version: int) -> str:
+        data = json.dumps(deployment)
+        conn.execute(
+            "INSERT INTO deployments (id, status, created_at, data, version, created_version) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+            "created_at = excluded.created_at, data = excluded.data, version = excluded.version",
+            (deployment['id'], deployment.get('status'), deployment.get('created_at'), data, version, version)
+        )
+        conn.execute("DELETE FROM tombstones WHERE id = ?", (deployment['id'],))
+        return data
+
+    def _file_signature(self):
+        """Cheap fingerprint of the database files, to notice writes by other processes"""
+        signature = []
+        for path in (self.db_file, self.db_file + "-wal"):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _refresh(self):
+        """Pull in rows changed since the cached version, if the files changed"""
+        with self._lock:
+            signature = self._file_signature()
+            if signature == self._signature:
+                return
+            # One read transaction, so the rows and the counter are consistent
+            with _Transaction(self._conn(), "BEGIN DEFERRED") as conn:
+                rows = conn.execute(
+                    "SELECT id, data, version, created_version FROM deployments WHERE version > ?",
+                    (self._version,)
+                ).fetchall()
+                tombstones = conn.execute(
+                    "SELECT id, version FROM tombstones WHERE version > ?", (self._version,)
+                ).fetchall()
+                current = int(conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+            for row in rows:
+                self._cache_put(*row)
+            for dep_id, version in tombstones:
+                self._forget(dep_id, version)
+            self._version = current
+            self._signature = signature
+
+    def _forget(self, deployment_id: str, version: int):
+        self._cache.pop(deployment_id, None)
+        self._statuses.pop(deployment_id, None)
+        self._row_versions.pop(deployment_id, None)
+        self._created_versions.pop(deployment_id, None)
+        self._removed[deployment_id] = version
+
+    def _write(self, conn: sqlite3.Connection, deployment: Dict):
+        """Write one deployment inside a transaction; returns what _cache_put needs"""
+        version = self._bump_version(conn)
+        data = self._write_row(conn, deployment, version)
+        created_version = conn.execute(
+            "SELECT created_version FROM deployments WHERE id = ?", (deployment['id'],)
+        ).fetchone()[0]
+        return deployment['id'], data, version, created_version
+
+    def _cache_put(self, deployment_id: str, data: str, version: int, created_version: int):
+        """Mirror a committed row into the cache; caller holds the lock"""
+        self._cache[deployment_id] = data
+        self._statuses[deployment_id] = json.loads(data).get('status')
+        self._row_versions[deployment_id] = version
+        self._created_versions[deployment_id] = created_version
+        self._removed.pop(deployment_id, None)
+
+    def _advance(self, version: int):
+        # If another process wrote in between, leave _version behind so the
+        # next _refresh() picks those rows up too
+        if version == self._version + 1:
+            self._version = version
+        self._changed.notify_all()
+
+    @property
+    def version(self) -> int:
+        """Current change counter; increases on every save/update/delete"""
+        self._refresh()
+        return self._version
+
+    def wait_for_change(self, since_version: int, timeout: float = None) -> int:
+        """
+        Block until the version moves past since_version (or timeout) and
+        return the current version. Writes from this process wake waiters
+        immediately; other processes' writes are noticed when the wait ends.
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: self._version > since_version, timeout)
+        return self.version
+
     def get_all_deployments(self) -> Dict:
-        with open(self.deployments_file, 'r') as f:
-            return json.load(f)
-    
+        self._refresh()
+        with self._lock:
+            return {dep_id: json.loads(data) for dep_id, data in self._cache.items()}
+
+    def get_deployments_by_status(self, statuses: List[str]) -> Dict:
+        self._refresh()
+        with self._lock:
+            return {
+                dep_id: json.loads(self._cache[dep_id]) for dep_id, status in self._statuses.items()
+                if status in statuses
+            }
+
     def get_deployment(self, deployment_id: str) -> Optional[Dict]:
-        deployments = self.get_all_deployments()
-        return deployments.get(deployment_id)
-    
+        self._refresh()
+        data = self._cache.get(deployment_id)
+        return json.loads(data) if data is not None else None
+
+    def get_deployment_version(self, deployment_id: str) -> Optional[int]:
+        """Version of the last change to one deployment (usable as an ETag)"""
+        self._refresh()
+        return self._row_versions.get(deployment_id)
+
+    def get_changes_since(self, version: int) -> Dict:
+        """
+        Returns what changed after `version`:
+        {'version': current, 'created': {...}, 'updated': {...}, 'removed': [ids]}
+        """
+        self._refresh()
+        with self._lock:
+            created, updated = {}, {}
+            for dep_id, row_version in self._row_versions.items():
+                if row_version > version:
+                    target = created if self._created_versions[dep_id] > version else updated
+                    target[dep_id] = json.loads(self._cache[dep_id])
+            removed = [dep_id for dep_id, v in self._removed.items() if v > version]
+            return {
+                'version': self._version,
+                'created': created,
+                'updated': updated,
+                'removed': removed
+            }
+
     def save_deployment(self, deployment: Dict):
-        deployments = self.get_all_deployments()
-        deployments[deployment['id']] = deployment
-        with open(self.deployments_file, 'w') as f:
-            json.dump(deployments, f, indent=2)
-    
+        with self._lock:
+            with self._transaction() as conn:
+                written = self._write(conn, deployment)
+            self._cache_put(*written)
+            self._advance(written[2])
+
+    def update_deployment(self, deployment_id: str, **fields) -> Optional[Dict]:
+        """
+        Atomically update only the given top-level fields (e.g. status=...).
+        Returns the updated deployment, or None if it doesn't exist.
+        """
+        return self.mutate_deployment(deployment_id, lambda deployment: deployment.update(fields))
+
+    def mutate_deployment(self, deployment_id: str, mutate: Callable[[Dict], None]) -> Optional[Dict]:
+        """
+        Atomically read-modify-write one deployment: mutate(deployment) gets a
+        private copy of the stored record and changes it in place (for nested
+        fields that several threads update, e.g. per-node checkpoints).
+        Returns the updated deployment, or None if it doesn't exist.
+        """
+        with self._lock:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT data FROM deployments WHERE id = ?", (deployment_id,)
+                ).fetchone()
+                if not row:
+                    return None
+                deployment = json.loads(row[0])
+                mutate(deployment)
+                written = self._write(conn, deployment)
+            self._cache_put(*written)
+            self._advance(written[2])
+            return deployment
+
+    def update_deployments(self, deployment_ids: List[str], **fields) -> int:
+        """
+        Set the same top-level fields on many deployments in one transaction
+        (one version bump for all of them, none if none of them exist).
+        Returns how many were updated.
+        """
+        with self._lock:
+            with self._transaction() as conn:
+                rows = []
+                for deployment_id in deployment_ids:
+                    row = conn.execute(
+                        "SELECT data, created_version FROM deployments WHERE id = ?", (deployment_id,)
+                    ).fetchone()
+                    if row:
+                        rows.append((deployment_id, row))
+                if not rows:
+                    return 0
+                version = self._bump_version(conn)
+                written = []
+                for deployment_id, (data, created_version) in rows:
+                    deployment = json.loads(data)
+                    deployment.update(fields)
+                    written.append((deployment_id, self._write_row(conn, deployment, version), version,
+                                    created_version))
+            for row in written:
+                self._cache_put(*row)
+            self._advance(version)
+            return len(written)
+
+    def get_meta(self, key: str, default=None):
+        """A small JSON setting kept next to the deployments (e.g. the baked image)"""
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (f"meta:{key}",)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (f"meta:{key}", json.dumps(value))
+            )
+
+    def save_job(self, job: Dict):
+        """
+        Insert or replace a background job record (see jobs.py). Jobs live
+        in their own table and don't move the deployments' version counter.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, deployment_id, status, created_at, data) VALUES (?, ?, ?, ?, ?)",
+                (job['id'], job.get('deployment_id'), job.get('status'), job.get('created_at'), json.dumps(job))
+            )
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_jobs(self, deployment_id: str = None, statuses: List[str] = None, limit: int = 100) -> List[Dict]:
+        """Job records, newest first, optionally for one deployment and/or in the given statuses"""
+        query, args = "SELECT data FROM jobs WHERE 1 = 1", []
+        if deployment_id is not None:
+            query += " AND deployment_id = ?"
+            args.append(deployment_id)
+        if statuses:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            args += statuses
+        query += " ORDER BY created_at DESC LIMIT ?"
+        args.append(limit)
+        return [json.loads(row[0]) for row in self._conn().execute(query, args).fetchall()]
+
+    def add_timings(self, deployment_id: str, spans: List[Dict], keep: int = None):
+        """
+        Append timing spans for a deployment (see metrics.Timings), keeping
+        only its newest `keep`. Like jobs, spans live in their own table and
+        don't move the deployments' version counter.
+        """
+        with self._transaction() as conn:
+            conn.executemany("INSERT INTO timings (deployment_id, data) VALUES (?, ?)",
+                             [(deployment_id, json.dumps(span)) for span in spans])
+            if keep is not None:
+                conn.execute(
+                    "DELETE FROM timings WHERE deployment_id = ? AND seq <= "
+                    "(SELECT seq FROM timings WHERE deployment_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (deployment_id, deployment_id, keep)
+                )
+
+    def get_timings(self, deployment_id: str) -> List[Dict]:
+        """A deployment's timing spans, oldest first"""
+        rows = self._conn().execute(
+            "SELECT data FROM timings WHERE deployment_id = ? ORDER BY seq", (deployment_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
     def delete_deployment(self, deployment_id: str):
-        deployments = self.get_all_deployments()
-        if deployment_id in deployments:
-            del deployments[deployment_id]
-            with open(self.deployments_file, 'w') as f:
-                json.dump(deployments, f, indent=2)
\ No newline at end of file
+        with self._lock:
+            with self._transaction() as conn:
+                cur = conn.execute("DELETE FROM deployments WHERE id = ?", (deployment_id,))
+                if cur.rowcount == 0:
+                    return
+                conn.execute("DELETE FROM timings WHERE deployment_id = ?", (deployment_id,))
+                version = self._bump_version(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO tombstones (id, version) VALUES (?, ?)",
+                    (deployment_id, version)
+                )
+            self._forget(deployment_id, version)
+            self._advance(version)
+
+    def delete_deployments(self, deployment_ids: List[str]) -> int:
+        """
+        Delete many deployments in one transaction (one version bump, none if
+        none of them existed); returns how many existed
+        """
+        with self._lock:
+            with self._transaction() as conn:
+                deleted = []
+                for deployment_id in deployment_ids:
+                    cur = conn.execute("DELETE FROM deployments WHERE id = ?", (deployment_id,))
+                    if cur.rowcount:
+                        deleted.append(deployment_id)
+                        conn.execute("DELETE FROM timings WHERE deployment_id = ?", (deployment_id,))
+                if not deleted:
+                    return 0
+                version = self._bump_version(conn)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tombstones (id, version) VALUES (?, ?)",
+                    [(deployment_id, version) for deployment_id in deleted]
+                )
+            for deployment_id in deleted:
+                self._forget(deployment_id, version)
+            self._advance(version)
+            return len(deleted)
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK, so read-modify-write can't interleave"""
+
+    def __init__(self, conn: sqlite3.Connection, begin: str = "BEGIN IMMEDIATE"):
+        self.conn = conn
+        self.begin = begin
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute(self.begin)
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+class _Entry:
+    def __init__(self, loader: Callable[[], Any], ttl: float, refresh: bool):
+        self.loader = loader
+        self.ttl = ttl
+        self.refresh = refresh
+        self.value = None
+        self.loaded_at = 0.0
+        self.last_access = 0.0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def fresh(self, now: float) -> bool:
+        return self.loaded and now - self.loaded_at < self.ttl
+
+
+class TTLCache:
+    """
+    Small thread-safe cache with a TTL per entry.
+
+    Concurrent misses on one key run the loader once. Entries fetched with
+    refresh=True are reloaded by a background thread shortly before they
+    expire (as long as someone read them since their last load), so hot
+    keys don't stall callers on a miss.
+    """
+
+    def __init__(self, refresh_ahead: float = 0.8, poll_interval: float = 1.0):
+        self.refresh_ahead = refresh_ahead
+        self.poll_interval = poll_interval
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+        self._refresher = None
+
+    def get(self, key: str, loader: Callable[[], Any], ttl: float, refresh: bool = False) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(loader, ttl, refresh)
+                self._entries[key] = entry
+            entry.last_access = now
+            if entry.fresh(now):
+                self._stats['hits'] += 1
+                return entry.value
+            self._stats['misses'] += 1
+            if refresh:
+                self._start_refresher()
+
+        with entry.lock:
+            # Another thread may have loaded it while we waited
+            if not entry.fresh(time.time()):
+                self._load(entry)
+            return entry.value
+
+    def invalidate(self, key: Optional[str] = None, prefix: Optional[str] = None):
+        """Drop one key, every key starting with prefix, or (no arguments) everything"""
+        with self._lock:
+            if key is not None:
+                self._entries.pop(key, None)
+            elif prefix is not None:
+                for k in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[k]
+            else:
+                self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def _load(self, entry: _Entry):
+        value = entry.loader()
+        entry.value = value
+        entry.loaded_at = time.time()
+        entry.loaded = True
+
+    def _start_refresher(self):
+        """Start the background refresh thread (caller holds self._lock)"""
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            now = time.time()
+            with self._lock:
+                due = [
+                    entry for entry in self._entries.values()
+                    if entry.refresh and entry.loaded
+                    and entry.last_access > entry.loaded_at
+                    and now - entry.loaded_at >= entry.ttl * self.refresh_ahead
+                ]
+            for entry in due:
+                if not entry.lock.acquire(blocking=False):
+                    continue  # a caller is loading it right now
+                try:
+                    self._load(entry)
+                    with self._lock:
+                        self._stats['refreshes'] += 1
+                except Exception as e:
+                    # Keep serving the old value until it expires
+                    print(f"Background refresh failed: {e}")
+                    with self._lock:
+                        self._stats['errors'] += 1
+                finally:
+                    entry.lock.release()
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from aws_client import AWSClient
+from fanout import FanOut, describe_failures
+from readiness import InstanceReadinessTracker
+from ssh_runner import SSHRunner
+
+# DeploymentId of instances that belong to the pool rather than a deployment
+POOL_DEPLOYMENT_ID = 'warm-pool'
+LIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+# How long a claimed member may take to leave 'stopped' after StartInstances
+CLAIM_START_TIMEOUT = float(os.getenv('WARM_POOL_START_TIMEOUT', '120'))
+
+# Pools with a refill in progress (process-wide, so concurrent claims refill once)
+_refilling: Dict[str, threading.Thread] = {}
+_refilling_lock = threading.Lock()
+_claim_lock = threading.Lock()
+
+class WarmPoolManager:
+    """
+    Keeps `size` fully installed, stopped instances around so launches can
+    start them instead of booting and installing fresh ones.
+
+    Members are tagged WarmPool=<template>/<key name>/<setup hash> (instances
+    only fit a launch with the same template, SSH key and setup commands,
+    which pin the package commit) and WarmPoolState=provisioning|ready.
+    Claiming a member re-tags it with the deployment's DeploymentId and
+    starts it.
+    """
+
+    def __init__(self, aws: AWSClient, size: int):
+        self.aws = aws
+        self.size = size
+
+    @staticmethod
+    def pool_key(template_id: str, key_name: str, setup_hash: str) -> str:
+        return f"{template_id}/{key_name}/{setup_hash}"
+
+    def claim(self, count: int, pool_key: str, deployment_id: str) -> List[str]:
+        """
+        Take up to count ready members, hand them to deployment_id and start
+        them. Returns once they have left 'stopped' (readiness tracking treats
+        stopped instances as dead); members that don't are terminated and
+        left out.
+        """
+        if self.size <= 0 or count <= 0:
+            return []
+        with _claim_lock:
+            members = self.aws.find_instances({'WarmPool': pool_key, 'WarmPoolState': 'ready'}, ['stopped'])
+            instance_ids = [m['InstanceId'] for m in members[:count]]
+            if not instance_ids:
+                return []
+            self.aws.untag_instances(instance_ids, ['WarmPool', 'WarmPoolState'])
+            self.aws.tag_instances(instance_ids, {
+                'DeploymentId': deployment_id,
+                'Name': f'deployment-{deployment_id}'
+            })
+        try:
+            self.aws.start_instances(instance_ids)
+        except Exception:
+            # Already tagged with the deployment; don't leave them behind stopped
+            self.aws.terminate_instances(instance_ids)
+            raise
+        stuck = self._wait_until_started(instance_ids)
+        if stuck:
+            print(f"Warm pool: {', '.join(stuck)} did not start; terminating")  # Debug
+            self.aws.terminate_instances(stuck)
+        return [iid for iid in instance_ids if iid not in stuck]
+
+    def _wait_until_started(self, instance_ids: List[str], poll_interval: float = 2.0) -> List[str]:
+        """
+        Wait for instances just sent StartInstances to show up as anything but
+        stopped/stopping (describe calls can lag behind the start); returns
+        those that still haven't after CLAIM_START_TIMEOUT.
+        """
+        deadline = time.time() + CLAIM_START_TIMEOUT
+        while True:
+            statuses = self.aws.get_instance_status(instance_ids)
+            waiting = [iid for iid in instance_ids
+                       if statuses.get(iid, {}).get('state', 'stopped') in ('stopped', 'stopping')]
+            if not waiting or time.time() > deadline:
+                return waiting
+            time.sleep(poll_interval)
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """{pool key: {state: member count}}"""
+        result: Dict[str, Dict[str, int]] = {}
+        for member in self.aws.find_instances({'DeploymentId': POOL_DEPLOYMENT_ID}, LIVE_STATES):
+            key = member['Tags'].get('WarmPool', '?')
+            state = member['Tags'].get('WarmPoolState', '?')
+            result.setdefault(key, {})
+            result[key][state] = result[key].get(state, 0) + 1
+        return result
+
+    def refill_async(self, pool_key: str, template_id: str, key_name: str,
+                     commands: List[str], ssh: SSHRunner, log_callback: Callable[[str], None],
+                     image_id: Optional[str] = None) -> bool:
+        """Start refill() in the background; False if the pool is disabled or already refilling"""
+        if self.size <= 0:
+            return False
+        with _refilling_lock:
+            thread = _refilling.get(pool_key)
+            if thread is not None and thread.is_alive():
+                return False
+
+            def run():
+                try:
+                    self.refill(pool_key, template_id, key_name, commands, ssh, log_callback, image_id)
+                except Exception as e:
+                    log_callback(f"ERROR: Warm pool refill failed: {e}")
+
+            thread = threading.Thread(target=run, daemon=True)
+            _refilling[pool_key] = thread
+            thread.start()
+            return True
+
+    def refill(self, pool_key: str, template_id: str, key_name: str,
+               commands: List[str], ssh: SSHRunner, log_callback: Callable[[str], None],
+               image_id: Optional[str] = None):
+        """
+        Top the pool up to `size`: launch the shortfall, install (unless
+        image_id already has everything), stop the instances and mark them
+        ready. Members built for other setup commands are terminated.
+        """
+        self._prune(pool_key, log_callback)
+        members = self.aws.find_instances({'WarmPool': pool_key}, LIVE_STATES)
+        shortfall = self.size - len(members)
+        if shortfall <= 0:
+            return
+        log_callback(f"Warm pool {pool_key}: launching {shortfall} instances...")
+        instance_ids = self.aws.launch_instances(
+            template_id=template_id,
+            count=shortfall,
+            key_name=key_name,
+            deployment_id=POOL_DEPLOYMENT_ID,
+            min_count=1,
+            log_callback=log_callback,
+            image_id=image_id,
+            extra_tags={'WarmPool': pool_key, 'WarmPoolState': 'provisioning'}
+        )
+
+        fanout = FanOut()
+        ips: Dict[str, str] = {}
+
+        def install(ip: str, cancel_event: threading.Event):
+            for command in commands:
+                rc = ssh.run_command(ip, command, log_callback, use_pty=False, background=False,
+                                     cancel_event=cancel_event)
+                if rc != 0:
+                    return rc
+
+        def on_ready(instance_id: str, ip: str):
+            ips[ip] = instance_id
+            if not image_id:
+                fanout.submit(ip, lambda cancel_event: install(ip, cancel_event))
+
+        try:
+            InstanceReadinessTracker(self.aws, instance_ids, require_status_ok=False).run(on_ready)
+        except Exception:
+            fanout.cancel()
+            fanout.wait()
+            self.aws.terminate_instances(instance_ids)
+            raise
+        results = fanout.wait()
+        failed = [ips[r.host] for r in results if not r.ok]
+        if failed:
+            log_callback(f"Warm pool setup failed on some instances:\n{describe_failures(results)}")
+            self.aws.terminate_instances(failed)
+        ready = [iid for iid in instance_ids if iid not in failed]
+        if ready:
+            self.aws.stop_instances(ready, wait=True)
+            self.aws.tag_instances(ready, {'WarmPoolState': 'ready'})
+        log_callback(f"✓ Warm pool {pool_key}: {len(ready)} instances ready")
+
+    def _prune(self, pool_key: str, log_callback: Callable[[str], None]):
+        """Terminate members for the same template and key but different setup commands"""
+        prefix = pool_key.rsplit('/', 1)[0] + '/'
+        stale = [
+            m['InstanceId'] for m in self.aws.find_instances({'DeploymentId': POOL_DEPLOYMENT_ID}, LIVE_STATES)
+            if m['Tags'].get('WarmPool', '').startswith(prefix) and m['Tags'].get('WarmPool') != pool_key
+        ]
+        if stale:
+            log_callback(f"Warm pool: terminating {len(stale)} instances with outdated setup")
+            self.aws.terminate_instances(stale)
@@ -0,0 +1,151 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Callable, Optional
+from ssh_mux import CommandCancelled
+from ssh_runner import SSHRunner
+from ttl_cache import TTLCache
+
+PACKAGE_REPO = 'https://github.com/astOwOlfo/scalable_docker.git'
+PACKAGE_REF = 'new'
+LOCAL_CACHE_DIR = '~/.aws-deployment-manager/wheelhouse'
+REMOTE_ROOT = 'wheelhouse'  # relative to the remote home directory
+MARKER = '.complete'
+COMMIT_TTL = 300
+# Pin the commit instead of asking git (e.g. offline)
+PINNED_COMMIT = os.getenv('SCALABLE_DOCKER_COMMIT')
+
+_commits = TTLCache()
+
+def resolve_commit(repo: str = PACKAGE_REPO, ref: str = PACKAGE_REF) -> Optional[str]:
+    """The commit `ref` currently points to (cached briefly), or None if git can't tell"""
+    if PINNED_COMMIT:
+        return PINNED_COMMIT
+    def load():
+        out = subprocess.run(['git', 'ls-remote', repo, ref], capture_output=True, text=True,
+                             timeout=30, check=True).stdout
+        if not out.strip():
+            raise Exception(f"{ref} not found in {repo}")
+        return out.split()[0]
+    try:
+        return _commits.get(f'{repo}@{ref}', load, COMMIT_TTL)
+    except Exception as e:
+        print(f"Could not resolve {repo}@{ref}: {e}")
+        return None
+
+
+class Wheelhouse:
+    """
+    scalable_docker and all its dependencies as wheels, for one commit.
+
+    The wheels are built once with `pip wheel` on the first node that needs
+    them (so they match the nodes' platform), copied into a local cache
+    keyed by commit, and pushed to every other node over SFTP, which then
+    installs offline. A marker file records a complete copy, locally and on
+    each node, so an unchanged commit is neither rebuilt nor re-sent.
+    """
+
+    def __init__(self, ssh: SSHRunner, commit: str, repo: str = PACKAGE_REPO,
+                 cache_dir: str = LOCAL_CACHE_DIR):
+        self.ssh = ssh
+        self.commit = commit
+        self.repo = repo
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.local_dir = os.path.join(self.cache_dir, commit)
+        self.remote_dir = f"{REMOTE_ROOT}/{commit}"
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._builder: Optional[str] = None
+        self.ok = self.is_cached()
+        if self.ok:
+            self._ready.set()
+
+    def is_cached(self) -> bool:
+        return os.path.exists(os.path.join(self.local_dir, MARKER))
+
+    def prepare(self, ip: str, log_callback: Callable[[str], None],
+                cancel_event: threading.Event = None) -> bool:
+        """
+        Make sure the wheels exist: the first caller builds them on its own
+        node, the others wait for that. Returns False if the build failed
+        (callers then install from git).
+        """
+        with self._lock:
+            build = not self._ready.is_set() and self._builder is None
+            if build:
+                self._builder = ip
+        if build:
+            try:
+                self._build(ip, log_callback, cancel_event)
+                self.ok = True
+            except CommandCancelled:
+                raise
+            except Exception as e:
+                log_callback(f"[{ip}] Building the wheelhouse failed: {e}")
+                self.ok = False
+            finally:
+                self._ready.set()
+            return self.ok
+        while not self._ready.wait(1.0):
+            if cancel_event is not None and cancel_event.is_set():
+                raise CommandCancelled(f"[{ip}] Cancelled while waiting for the wheelhouse")
+        return self.ok
+
+    def install(self, ip: str, log_callback: Callable[[str], None],
+                cancel_event: threading.Event = None) -> int:
+        """Push the wheels to ip (unless it has them) and install offline; returns the exit code"""
+        if ip != self._builder:
+            self._push(ip, log_callback, cancel_event)
+        log_callback(f"[{ip}] Installing scalable_docker from the wheelhouse...")
+        return self.ssh.run_command(ip, self.install_command(), log_callback, use_pty=False,
+                                    background=False, cancel_event=cancel_event)
+
+    def install_command(self) -> str:
+        return (
+            f"~/.venv/bin/pip install --no-index --find-links ~/{self.remote_dir} "
+            f"--force-reinstall ~/{self.remote_dir}/*.whl"
+        )
+
+    def _build(self, ip: str, log_callback: Callable[[str], None], cancel_event: threading.Event):
+        log_callback(f"[{ip}] Building wheelhouse for {self.commit[:12]}...")
+        d = self.remote_dir
+        build_cmd = (
+            f"test -f {d}/{MARKER} || ("
+            f"rm -rf {d}.tmp && mkdir -p {d}.tmp && "
+            f"~/.venv/bin/pip wheel --wheel-dir {d}.tmp git+{self.repo}@{self.commit} && "
+            f"rm -rf {d} && mv {d}.tmp {d} && touch {d}/{MARKER})"
+        )
+        rc = self.ssh.run_command(ip, build_cmd, log_callback, use_pty=False, background=False,
+                                  cancel_event=cancel_event)
+        if rc != 0:
+            raise Exception(f"pip wheel failed with exit code {rc}")
+
+        # Keep a local copy for the other nodes and later deployments
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f'{self.commit}.', dir=self.cache_dir)
+        try:
+            received = self.ssh.download_dir(ip, d, tmp_dir, log_callback, cancel_event)
+            open(os.path.join(tmp_dir, MARKER), 'w').close()
+            try:
+                os.rename(tmp_dir, self.local_dir)
+            except OSError:
+                pass  # another deployment cached this commit meanwhile
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        log_callback(f"[{ip}] Wheelhouse cached locally ({received / 1e6:.1f} MB)")
+
+    def _push(self, ip: str, log_callback: Callable[[str], None], cancel_event: threading.Event):
+        rc = self.ssh.run_command(ip, f"test -f {self.remote_dir}/{MARKER}", None, use_pty=False,
+                                  background=False, cancel_event=cancel_event)
+        if rc == 0:
+            log_callback(f"[{ip}] Wheelhouse {self.commit[:12]} already present")
+            return
+        [result] = self.ssh.broadcast(self.local_dir, self.remote_dir, [ip], skip=(MARKER,),
+                                      cancel_event=cancel_event)
+        if not result.ok:
+            raise Exception(result.error)
+        self.ssh.run_command(ip, f"touch {self.remote_dir}/{MARKER}", None, use_pty=False,
+                             background=False, cancel_event=cancel_event)
+        log_callback(f"[{ip}] Pushed wheelhouse: {result.describe()}")
@@ -0,0 +1,67 @@
+"""
+EC2 stand-in: moto's in-memory EC2, plus a configurable boot delay.
+
+moto reports instances as running the moment they are launched; the
+simulated client keeps them 'pending' (and their status checks
+'initializing') for `boot_delay` seconds, which is what the readiness
+tracker sees on real EC2. moto also launches only MinCount instances,
+where EC2 launches as many as it has capacity for (up to MaxCount), so
+run_instances calls are sent with MinCount raised to MaxCount. And moto
+draws public IPs at random from a /16, so a few hundred instances would
+likely share one; EC2 never hands out the same address twice at once.
+"""
+import itertools
+import os
+import threading
+import time
+from typing import Dict, List
+
+from moto.ec2.models import elastic_network_interfaces
+
+from aws_client import AWSClient
+
+KEY_NAME = 'benchmark-key'
+
+_addresses = itertools.count(1)
+elastic_network_interfaces.random_public_ip = lambda: '54.{}.{}.{}'.format(*next(_addresses).to_bytes(3, 'big'))
+
+
+class SimulatedAWSClient(AWSClient):
+    def __init__(self, boot_delay: float = 0.0):
+        super().__init__()
+        self.boot_delay = boot_delay
+        self._launched_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.ec2.meta.events.register('before-parameter-build.ec2.RunInstances', self._full_capacity)
+
+    @staticmethod
+    def _full_capacity(params, **kwargs):
+        params['MinCount'] = params.get('MaxCount', params.get('MinCount', 1))
+
+    def launch_instances(self, *args, **kwargs) -> List[str]:
+        instance_ids = super().launch_instances(*args, **kwargs)
+        now = time.monotonic()
+        with self._lock:
+            for instance_id in instance_ids:
+                self._launched_at[instance_id] = now
+        return instance_ids
+
+    def get_instance_status(self, instance_ids: List[str]) -> Dict[str, Dict]:
+        result = super().get_instance_status(instance_ids)
+        now = time.monotonic()
+        with self._lock:
+            for instance_id, status in result.items():
+                launched = self._launched_at.get(instance_id)
+                if status['state'] == 'running' and launched is not None and now - launched < self.boot_delay:
+                    status.update(state='pending', status_ok=False)
+        return result
+
+
+def setup_account(aws: AWSClient):
+    """The key pair and launch template DeploymentManager launches with"""
+    aws.ec2.create_key_pair(KeyName=KEY_NAME)
+    template = aws.ec2.create_launch_template(
+        LaunchTemplateName='benchmark',
+        LaunchTemplateData={'ImageId': 'ami-12c6146b', 'InstanceType': 't3.micro'}
+    )
+    os.environ['LAUNCH_TEMPLATE_ID'] = template['LaunchTemplate']['LaunchTemplateId']
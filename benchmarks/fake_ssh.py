@@ -0,0 +1,193 @@
+"""
+In-process stand-in for the nodes' sshd.
+
+Every simulated host gets its own listening socket on 127.0.0.1 (handed out
+through ssh_probe's address resolver), so the server knows which host a
+connection is for. Commands are never executed: each one is classified
+(install, start, health check, probe, ...) and answered after a configurable
+latency with a configurable amount of output, while a small per-host state
+(installed, worker/head running) keeps probes and health checks truthful.
+"""
+import logging
+import selectors
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+
+import paramiko
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+# The readiness probe hangs up right after the banner; don't log that as an error
+logging.getLogger('benchmarks.fake_ssh').setLevel(logging.CRITICAL)
+
+
+@dataclass
+class SimulationConfig:
+    boot_delay: float = 0.0       # seconds an instance stays 'pending' after launch
+    ssh_delay: float = 0.0        # seconds after 'running' before sshd accepts connections
+    command_latency: float = 0.05  # seconds per ordinary command
+    install_latency: float = 1.0   # seconds per install command
+    output_lines: int = 100       # lines printed by each install command
+
+
+@dataclass
+class FakeHost:
+    ip: str
+    listener: socket.socket
+    accepts_at: float
+    installed: bool = False
+    worker_running: bool = False
+    head_running: bool = False
+    commands: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+def classify(command: str) -> str:
+    if 'import scalable_docker' in command:
+        return 'probe_deps'
+    if 'worker process running' in command:
+        return 'health'
+    if command.startswith('pgrep'):
+        return 'probe_head' if 'head_server' in command else 'probe_worker'
+    if command.startswith('pkill'):
+        return 'kill_head' if 'head_server' in command else 'kill_worker'
+    if 'nohup' in command and 'scalable_docker.worker_server' in command:
+        return 'start_worker'
+    if 'nohup' in command and 'scalable_docker.head_server' in command:
+        return 'start_head'
+    if 'pip install' in command or 'apt' in command:
+        return 'install'
+    return 'other'
+
+
+class FakeSSHCluster:
+    """Listens for every simulated host; serves exec requests from their simulated state"""
+
+    def __init__(self, config: SimulationConfig):
+        self.config = config
+        self.hosts: Dict[str, FakeHost] = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+
+    def resolve(self, host: str, port: int) -> Tuple[str, int]:
+        """ssh_probe address resolver: the local listener standing in for host"""
+        return '127.0.0.1', self.host(host).listener.getsockname()[1]
+
+    def host(self, ip: str) -> FakeHost:
+        with self._lock:
+            fake = self.hosts.get(ip)
+            if fake is None:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(64)
+                listener.setblocking(False)
+                fake = FakeHost(ip, listener, time.monotonic() + self.config.ssh_delay)
+                self.hosts[ip] = fake
+                self._selector.register(listener, selectors.EVENT_READ, fake)
+                self._wake_w.send(b'\0')
+            return fake
+
+    def stop(self):
+        self._stopped = True
+        self._wake_w.send(b'\0')
+        self._thread.join(timeout=5)
+        for fake in self.hosts.values():
+            fake.listener.close()
+
+    def _accept_loop(self):
+        while not self._stopped:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.data is None:
+                    self._wake_r.recv(4096)
+                    continue
+                fake: FakeHost = key.data
+                try:
+                    sock, _ = fake.listener.accept()
+                except BlockingIOError:
+                    continue
+                if time.monotonic() < fake.accepts_at:
+                    sock.close()  # sshd not up yet; the client retries
+                    continue
+                sock.setblocking(True)
+                threading.Thread(target=self._serve, args=(fake, sock), daemon=True).start()
+
+    def _serve(self, fake: FakeHost, sock: socket.socket):
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel('benchmarks.fake_ssh')
+        transport.add_server_key(HOST_KEY)
+        try:
+            transport.start_server(server=_Server(self, fake))
+        except Exception:
+            transport.close()
+
+    def run(self, fake: FakeHost, command: str, channel: paramiko.Channel):
+        kind = classify(command)
+        with fake.lock:
+            fake.commands += 1
+        rc = 0
+        if kind == 'install':
+            self._emit(channel, self.config.install_latency, self.config.output_lines, command)
+            fake.installed = True
+        elif kind == 'probe_deps':
+            rc = 0 if fake.installed else 1
+        elif kind == 'probe_worker':
+            rc = 0 if fake.worker_running else 1
+        elif kind == 'probe_head':
+            rc = 0 if fake.head_running else 1
+        elif kind == 'health':
+            time.sleep(self.config.command_latency)
+            rc = 0 if fake.worker_running else 1
+            channel.sendall(b"worker process running\n" if rc == 0 else b"worker process not running\n")
+        else:
+            time.sleep(self.config.command_latency)
+            if kind == 'kill_worker':
+                fake.worker_running = False
+            elif kind == 'kill_head':
+                fake.head_running = False
+            elif kind == 'start_worker':
+                fake.worker_running = fake.installed
+            elif kind == 'start_head':
+                fake.head_running = fake.installed
+        channel.send_exit_status(rc)
+        # EOF rather than close: a close could overtake the reply to the exec request
+        channel.shutdown_write()
+
+    def _emit(self, channel: paramiko.Channel, duration: float, lines: int, command: str):
+        """Print `lines` lines spread over `duration` seconds, like a package install"""
+        chunks = max(1, min(lines, 20))
+        per_chunk = max(1, lines // chunks)
+        line = (f"simulated output of: {command[:40]}".ljust(100) + "\n").encode()
+        for _ in range(chunks):
+            time.sleep(duration / chunks)
+            channel.sendall(line * per_chunk)
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, cluster: FakeSSHCluster, fake: FakeHost):
+        self.cluster = cluster
+        self.fake = fake
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.cluster.run, args=(self.fake, command.decode(errors='replace'), channel), daemon=True
+        ).start()
+        return True
@@ -0,0 +1,388 @@
+"""
+Offline benchmarks for the deployment manager's control plane.
+
+Runs DeploymentManager against moto's in-memory EC2 and an in-process
+paramiko server standing in for every node (see fake_ec2.py and
+fake_ssh.py), so nothing touches AWS or the network. Measures:
+
+- launch, restart (all-at-once and rolling) and delete per cluster size
+- Storage write/read/update throughput with 10k deployments
+- SSE log fan-out to many concurrent clients
+
+Results are written as JSON; with --compare, timings that got worse than
+a baseline by more than --tolerance make the run exit with status 1.
+Compare runs from the same machine only: the simulated nodes share this
+process (and its GIL), so at a few hundred nodes the numbers include the
+stand-ins' own CPU time.
+
+    uv run --group dev python benchmarks/run.py --sizes 1,10,100,500 --out results.json
+    uv run --group dev python benchmarks/run.py --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(os.path.dirname(HERE), 'backend')
+
+
+def configure_environment(home: str):
+    """Point everything at throwaway state; must run before the backend is imported"""
+    os.environ.update({
+        'HOME': home,
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'LAUNCH_TEMPLATE_VERSION': '$Latest',
+        # Install over SSH every time; no wheelhouse, baked images or warm pool
+        'WHEELHOUSE': '0',
+        'GOLDEN_IMAGE': 'off',
+        'WARM_POOL_SIZE': '0',
+        'SCALABLE_DOCKER_COMMIT': '0' * 40,
+    })
+    sys.path.insert(0, BACKEND)
+    sys.path.insert(0, HERE)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def wait_for_status(storage, deployment_id: str, statuses=('running', 'failed'), timeout: float = 3600) -> str:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = storage.get_deployment(deployment_id)['status']
+        if status in statuses:
+            return status
+        time.sleep(0.05)
+    raise Exception(f"{deployment_id} still not {'/'.join(statuses)} after {timeout}s")
+
+
+def unique_second():
+    """Deployment IDs are per second; wait for a fresh one"""
+    now = int(time.time())
+    while int(time.time()) == now:
+        time.sleep(0.01)
+
+
+def bench_cluster(sizes: List[int], config, key_path: str) -> List[Dict]:
+    import ssh_probe
+    from metrics import summarize
+    from deployment_manager import DeploymentManager
+    from fake_ec2 import KEY_NAME, SimulatedAWSClient, setup_account
+    from fake_ssh import FakeSSHCluster
+    from ssh_runner import SSHRunner
+    from storage import Storage
+
+    aws = SimulatedAWSClient(boot_delay=config.boot_delay)
+    setup_account(aws)
+    storage = Storage()
+    fake_ssh = FakeSSHCluster(config)
+    ssh_probe.set_address_resolver(fake_ssh.resolve)
+    manager = DeploymentManager(aws, SSHRunner(key_path, 'ubuntu'), storage)
+
+    results = []
+    try:
+        for size in sizes:
+            unique_second()
+            print(f"cluster size {size}: launching...", flush=True)
+            start = time.monotonic()
+            deployment_id = manager.launch_deployment(size, KEY_NAME, name=f"bench-{size}")
+            status = wait_for_status(storage, deployment_id)
+            launch = time.monotonic() - start
+            if status != 'running':
+                raise Exception(f"Launching {size} nodes failed; see ~/.aws-deployment-manager/logs/{deployment_id}.log")
+            phases = {
+                phase: {'max': s['max'], 'mean': s['mean']}
+                for phase, s in summarize(storage.get_timings(deployment_id)).items()
+            }
+
+            print(f"cluster size {size}: restarting...", flush=True)
+            start = time.monotonic()
+            manager.restart_servers(deployment_id, mode='all')
+            restart_all = time.monotonic() - start
+            start = time.monotonic()
+            manager.restart_servers(deployment_id, mode='rolling')
+            restart_rolling = time.monotonic() - start
+
+            print(f"cluster size {size}: deleting...", flush=True)
+            start = time.monotonic()
+            manager.delete_deployment(deployment_id)
+            delete = time.monotonic() - start
+
+            results.append({
+                'size': size,
+                'launch_seconds': round(launch, 3),
+                'restart_all_seconds': round(restart_all, 3),
+                'restart_rolling_seconds': round(restart_rolling, 3),
+                'delete_seconds': round(delete, 3),
+                'phases': phases,
+            })
+            print(f"cluster size {size}: launch {launch:.2f}s, restart {restart_all:.2f}s "
+                  f"(rolling {restart_rolling:.2f}s), delete {delete:.2f}s", flush=True)
+    finally:
+        fake_ssh.stop()
+    return results
+
+
+def bench_storage(count: int, threads: int) -> Dict:
+    from storage import Storage
+
+    data_dir = tempfile.mkdtemp(prefix='storage-bench-')
+    storage = Storage(data_dir)
+    ids = [f"bench-{i}" for i in range(count)]
+
+    def record(deployment_id: str) -> Dict:
+        return {
+            'id': deployment_id,
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+            'name': deployment_id,
+            'status': 'running',
+            'key_name': 'k',
+            'head': {'instance_id': 'i-0', 'ip': '10.0.0.1'},
+            'workers': [{'instance_id': f'i-{n}', 'ip': f'10.0.{n // 250}.{n % 250}'} for n in range(1, 9)],
+            'log_file': f"~/.aws-deployment-manager/logs/{deployment_id}.log",
+        }
+
+    start = time.monotonic()
+    for deployment_id in ids:
+        storage.save_deployment(record(deployment_id))
+    write = time.monotonic() - start
+
+    start = time.monotonic()
+    for _ in range(count):
+        storage.get_deployment(random.choice(ids))
+    read = time.monotonic() - start
+
+    start = time.monotonic()
+    listed = len(storage.get_all_deployments())
+    list_all = time.monotonic() - start
+
+    per_thread = count // threads
+    def update(n: int):
+        for deployment_id in ids[n * per_thread:(n + 1) * per_thread]:
+            storage.update_deployment(deployment_id, status='restarting')
+    workers = [threading.Thread(target=update, args=(n,)) for n in range(threads)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    update_concurrent = time.monotonic() - start
+
+    start = time.monotonic()
+    reopened = len(Storage(data_dir).get_all_deployments())
+    reopen = time.monotonic() - start
+
+    assert listed == reopened == count
+    return {
+        'deployments': count,
+        'writes_per_second': round(count / write, 1),
+        'reads_per_second': round(count / read, 1),
+        'list_all_seconds': round(list_all, 4),
+        'concurrent_updates_per_second': round(per_thread * threads / update_concurrent, 1),
+        'update_threads': threads,
+        'reopen_seconds': round(reopen, 3),
+    }
+
+
+def bench_sse(clients: int, lines: int, rate: float) -> Dict:
+    import app as flask_app
+    from log_writer import get_log_writer
+
+    storage = flask_app.storage
+    deployment_id = f"sse-bench-{int(time.time())}"
+    log_file = f"~/.aws-deployment-manager/logs/{deployment_id}.log"
+    storage.save_deployment({
+        'id': deployment_id, 'created_at': datetime.utcnow().isoformat() + 'Z', 'name': deployment_id,
+        'status': 'setting_up', 'key_name': 'k', 'head': None, 'workers': [], 'log_file': log_file,
+    })
+
+    latencies: List[List[float]] = [[] for _ in range(clients)]
+    received = [0] * clients
+    started = threading.Barrier(clients + 1)
+
+    def client(n: int):
+        # The test client only returns once the first event is out, so line up before connecting;
+        # every client starts from line 0 either way
+        started.wait()
+        response = flask_app.app.test_client().get(f"/api/deployments/{deployment_id}/logs/stream",
+                                                   buffered=False)
+        for chunk in response.response:
+            for event in chunk.decode().split('\n\n'):
+                if not event.startswith('id: '):
+                    continue
+                payload = json.loads(event.split('data: ', 1)[1])
+                now = time.time()
+                for message in payload['messages']:
+                    sent_at = float(message.rsplit(' ', 1)[1])
+                    latencies[n].append(now - sent_at)
+                    received[n] += 1
+        response.close()
+
+    threads = [threading.Thread(target=client, args=(n,), daemon=True) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+
+    writer = get_log_writer(log_file)
+    start = time.monotonic()
+    for i in range(lines):
+        writer.write(f"line {i} {time.time()}")
+        if rate:
+            time.sleep(1 / rate)
+    writer.flush()
+    storage.update_deployment(deployment_id, status='running')
+    for thread in threads:
+        thread.join(timeout=120)
+    elapsed = time.monotonic() - start
+
+    everything = [latency for per_client in latencies for latency in per_client]
+    return {
+        'clients': clients,
+        'lines': lines,
+        'complete_clients': sum(1 for n in received if n == lines),
+        'delivered_lines_per_second': round(sum(received) / elapsed, 1),
+        'latency_p50_ms': round(percentile(everything, 0.5) * 1000, 2),
+        'latency_p99_ms': round(percentile(everything, 0.99) * 1000, 2),
+        'latency_mean_ms': round(statistics.fmean(everything) * 1000, 2) if everything else 0.0,
+    }
+
+
+def flatten(results: Dict, prefix: str = '') -> Dict[str, float]:
+    """{'cluster.10.launch_seconds': ..., 'storage.writes_per_second': ...}"""
+    flat = {}
+    for key, value in results.items():
+        if key in ('meta', 'phases'):
+            continue
+        if key == 'cluster':
+            for row in value:
+                flat.update(flatten(row, f"{prefix}cluster.{row['size']}."))
+        elif isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and key != 'size':
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Metrics that regressed by more than tolerance (times up, or throughputs down)"""
+    regressions = []
+    current, previous = flatten(results), flatten(baseline)
+    for key, value in current.items():
+        before = previous.get(key)
+        if not before:
+            continue
+        if key.endswith('_seconds') or key.endswith('_ms'):
+            change = value / before - 1
+        elif key.endswith('_per_second'):
+            change = before / value - 1 if value else float('inf')
+        else:
+            continue
+        if change > tolerance:
+            regressions.append(f"{key}: {before} -> {value} ({change:+.0%})")
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,10,50', help="comma-separated cluster sizes (up to 500)")
+    parser.add_argument('--boot-delay', type=float, default=0.0, help="seconds instances stay pending")
+    parser.add_argument('--ssh-delay', type=float, default=0.0, help="seconds until sshd accepts after running")
+    parser.add_argument('--command-latency', type=float, default=0.05, help="seconds per ordinary command")
+    parser.add_argument('--install-latency', type=float, default=1.0, help="seconds per install command")
+    parser.add_argument('--output-lines', type=int, default=100, help="lines printed per install command")
+    parser.add_argument('--storage-deployments', type=int, default=10000)
+    parser.add_argument('--storage-threads', type=int, default=8)
+    parser.add_argument('--sse-clients', type=int, default=100)
+    parser.add_argument('--sse-lines', type=int, default=2000)
+    parser.add_argument('--sse-rate', type=float, default=0, help="lines per second written (0: as fast as possible)")
+    parser.add_argument('--skip', default='', help="comma-separated suites to skip: cluster,storage,sse")
+    parser.add_argument('--out', default='benchmark-results.json')
+    parser.add_argument('--compare', help="baseline results file to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown vs the baseline")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='deployment-manager-bench-')
+    configure_environment(home)
+    skip = set(filter(None, args.skip.split(',')))
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    try:
+        import paramiko
+        from fake_ssh import SimulationConfig
+
+        key_path = os.path.join(home, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        config = SimulationConfig(
+            boot_delay=args.boot_delay,
+            ssh_delay=args.ssh_delay,
+            command_latency=args.command_latency,
+            install_latency=args.install_latency,
+            output_lines=args.output_lines,
+        )
+        results = {
+            'meta': {
+                'started_at': datetime.utcnow().isoformat() + 'Z',
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'config': vars(args),
+            }
+        }
+        if 'storage' not in skip:
+            print(f"storage: {args.storage_deployments} deployments...", flush=True)
+            results['storage'] = bench_storage(args.storage_deployments, args.storage_threads)
+            print(f"storage: {results['storage']}", flush=True)
+        if 'sse' not in skip:
+            print(f"sse: {args.sse_clients} clients...", flush=True)
+            results['sse'] = bench_sse(args.sse_clients, args.sse_lines, args.sse_rate)
+            print(f"sse: {results['sse']}", flush=True)
+        if 'cluster' not in skip:
+            sizes = [int(size) for size in args.sizes.split(',') if size]
+            results['cluster'] = bench_cluster(sizes, config, key_path)
+    finally:
+        mock.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.out}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
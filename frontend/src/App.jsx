@@ -2,6 +2,15 @@ import React, { useState, useEffect } from 'react';
 import LaunchForm from './LaunchForm';
 import DeploymentList from './DeploymentList';
 
+function applyDiff(deployments, diff) {
+  const changed = [...diff.created, ...diff.updated];
+  const dropped = new Set([...diff.removed, ...changed.map(d => d.id)]);
+  return deployments
+    .filter(d => !dropped.has(d.id))
+    .concat(changed)
+    .sort((a, b) => (a.created_at < b.created_at ? 1 : -1));
+}
+
 function App() {
   const [deployments, setDeployments] = useState([]);
   const [loading, setLoading] = useState(true);
@@ -19,10 +28,22 @@ function App() {
   };
 
   useEffect(() => {
-    fetchDeployments();
-    // Poll every 5 seconds for updates
-    const interval = setInterval(fetchDeployments, 5001);
-    return () => clearInterval(interval);
+    // The server pushes a full snapshot on connect, then only diffs.
+    // EventSource reconnects by itself, resuming from the last event id.
+    const source = new EventSource('http://localhost:5001/api/deployments/events');
+    source.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'snapshot') {
+        setDeployments(data.deployments);
+        setLoading(false);
+      } else if (data.type === 'diff') {
+        setDeployments(prev => applyDiff(prev, data));
+      }
+    };
+    source.onerror = (error) => {
+      console.error('Deployment event stream error:', error);
+    };
+    return () => source.close();
   }, []);
 
   return (
@@ -32,25 +32,54 @@ function DeploymentList({ deployments, onDelete }) {
     }
   };
 
+  const handleDeleteFailed = async () => {
+    const failedIds = deployments.filter(d => d.status === 'failed').map(d => d.id);
+    
+    if (!window.confirm(`Terminate ${failedIds.length} failed deployment(s)?`)) {
+      return;
+    }
+    
+    // One background job terminates them all with batched EC2 calls
+    const response = await fetch('http://localhost:5001/api/deployments/bulk-delete', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ deployment_ids: failedIds })
+    });
+    if (!response.ok) {
+      const data = await response.json();
+      alert(`Could not delete: ${data.error}`);
+      return;
+    }
+    onDelete();
+  };
+
   if (deployments.length === 0) {
     return <div className="no-deployments">No deployments yet</div>;
   }
 
   const terminatedCount = deployments.filter(d => d.status === 'terminated').length;
+  const failedCount = deployments.filter(d => d.status === 'failed').length;
 
   return (
     <div className="deployment-list">
       <div style={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center' }}>
         <h2>Deployments</h2>
-        {terminatedCount > 0 && (
-          <button 
-            onClick={handleClearTerminated}
-            disabled={clearing}
-            className="secondary"
-          >
-            {clearing ? 'Clearing...' : `Clear ${terminatedCount} Terminated`}
-          </button>
-        )}
+        <div>
+          {failedCount > 1 && (
+            <button onClick={handleDeleteFailed} className="danger">
+              {`Delete ${failedCount} Failed`}
+            </button>
+          )}
+          {terminatedCount > 0 && (
+            <button 
+              onClick={handleClearTerminated}
+              disabled={clearing}
+              className="secondary"
+            >
+              {clearing ? 'Clearing...' : `Clear ${terminatedCount} Terminated`}
+            </button>
+          )}
+        </div>
       </div>
       <table>
         <thead>
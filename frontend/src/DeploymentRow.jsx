@@ -1,5 +1,17 @@
 import React, { useState } from 'react';
 
+// Long operations run as background jobs: the API answers 202 with the job,
+// or 409 if another operation is still running on the deployment
+async function startJob(url, options, what) {
+  const response = await fetch(url, options);
+  if (!response.ok) {
+    const data = await response.json();
+    alert(`Could not ${what}: ${data.error}`);
+    return null;
+  }
+  return (await response.json()).job;
+}
+
 function DeploymentRow({ deployment, onDelete }) {
   const [copied, setCopied] = useState(false);
 
@@ -13,23 +25,34 @@ function DeploymentRow({ deployment, onDelete }) {
     await fetch(`http://localhost:5001/api/deployments/${deployment.id}/logs/open`);
   };
 
-  const handleRestart = async () => {
-    if (!window.confirm(`Restart deployment ${deployment.name}?`)) {
+  const handleRestart = async (mode) => {
+    const what = mode === 'rolling' ? 'Rolling restart (workers in batches, each drained first)' : 'Restart';
+    if (!window.confirm(`${what} deployment ${deployment.name}?`)) {
       return;
     }
-    await fetch(`http://localhost:5001/api/deployments/${deployment.id}/restart`, {
+    await startJob(`http://localhost:5001/api/deployments/${deployment.id}/restart`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ mode })
+    }, 'restart');
+  };
+
+  const handleResume = async () => {
+    await startJob(`http://localhost:5001/api/deployments/${deployment.id}/resume`, {
       method: 'POST'
-    });
+    }, 'resume');
   };
 
   const handleDelete = async () => {
     if (!window.confirm(`Delete deployment ${deployment.name}?`)) {
       return;
     }
-      await fetch(`http://localhost:5001/api/deployments/${deployment.id}`, {
+      const job = await startJob(`http://localhost:5001/api/deployments/${deployment.id}`, {
         method: 'DELETE'
-      });
-      onDelete();
+      }, 'delete');
+      if (job) {
+        onDelete();
+      }
   };
 
   const handleCopyExport = () => {
@@ -87,9 +110,17 @@ function DeploymentRow({ deployment, onDelete }) {
           <button onClick={handleOpenLogs} className="secondary">
             View Logs
           </button>
-          <button onClick={handleRestart} className="danger" disabled={deployment.status !== 'running'}>
+          <button onClick={() => handleRestart('all')} className="danger" disabled={deployment.status !== 'running'}>
             Restart
           </button>
+          <button onClick={() => handleRestart('rolling')} className="secondary" disabled={deployment.status !== 'running'}>
+            Rolling Restart
+          </button>
+          {deployment.status === 'failed' && (
+            <button onClick={handleResume} className="secondary">
+              Resume
+            </button>
+          )}
           <button 
             onClick={handleDelete}
             disabled={deployment.status === 'terminated'}
@@ -0,0 +1,34 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """Keep logs and other ~/.aws-deployment-manager state out of the real home directory"""
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    return tmp_path / 'home'
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """An AWSClient talking to moto's in-memory EC2, with a key pair and launch template"""
+    from moto import mock_aws
+
+    from aws_client import AWSClient
+
+    for name, value in {
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'LAUNCH_TEMPLATE_VERSION': '$Latest',
+    }.items():
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        client = AWSClient()
+        client.ec2.create_key_pair(KeyName='test-key')
+        template = client.ec2.create_launch_template(
+            LaunchTemplateName='test',
+            LaunchTemplateData={'ImageId': 'ami-12c6146b', 'InstanceType': 't3.micro'}
+        )
+        monkeypatch.setenv('LAUNCH_TEMPLATE_ID', template['LaunchTemplate']['LaunchTemplateId'])
+        yield client
@@ -0,0 +1,153 @@
+import threading
+import time
+
+import paramiko
+import pytest
+
+import deployment_manager
+from jobs import JobManager
+from storage import Storage
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    key_path = tmp_path / 'test-key.pem'
+    paramiko.RSAKey.generate(1024).write_private_key_file(str(key_path))
+    monkeypatch.setenv('PATH_TO_AWS_PRIVATE_KEY', str(key_path))
+    import app
+    storage = Storage(str(tmp_path / 'data'))
+    monkeypatch.setattr(app, 'storage', storage)
+    monkeypatch.setattr(app, 'jobs', JobManager(storage))
+    storage.save_deployment({
+        'id': 'dep-1', 'status': 'setting_up', 'created_at': '2026-01-01T00:00:00Z', 'key_name': 'test-key',
+        'head': {'instance_id': 'i-head', 'ip': '10.0.0.1'}, 'workers': [],
+    })
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def launching(monkeypatch):
+    monkeypatch.setattr(deployment_manager, '_active_setups', {'dep-1'})
+
+
+@pytest.mark.parametrize('batch_size', [0, -2, 'many', [3]])
+def test_restart_rejects_bad_batch_size(client, batch_size):
+    response = client.post('/api/deployments/dep-1/restart', json={'mode': 'rolling', 'batch_size': batch_size})
+    assert response.status_code == 400
+    assert 'batch_size' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('method, path, body', [
+    ('post', '/api/deployments/dep-1/restart', {'mode': 'all'}),
+    ('delete', '/api/deployments/dep-1', None),
+    ('post', '/api/deployments/bulk-delete', {'deployment_ids': ['dep-1']}),
+])
+def test_jobs_conflict_with_a_running_launch(client, launching, method, path, body):
+    response = getattr(client, method)(path, json=body)
+    assert response.status_code == 409
+    assert 'Setup is still in progress' in response.get_json()['error']
+
+
+def test_active_job_answers_before_the_launch_check(client, app_module, launching):
+    # A running resume job holds the deployment (and is in _active_setups):
+    # submitting it again returns that job rather than a launch conflict
+    release = threading.Event()
+    job, _ = app_module.jobs.submit('resume', 'dep-1', lambda job: release.wait(5))
+    response = client.post('/api/deployments/dep-1/resume')
+    release.set()
+    assert response.status_code == 202
+    assert response.get_json()['job_id'] == job['id']
+
+
+@pytest.mark.parametrize('body', [
+    {}, {'add': 0}, {'add': -1}, {'add': 'two'}, {'remove': 'i-1'}, {'remove': [1]},
+    {'add': 1, 'remove': ['i-1']},
+])
+def test_scale_rejects_bad_requests(client, body):
+    response = client.post('/api/deployments/dep-1/scale', json=body)
+    assert response.status_code == 400
+
+
+def test_scale_queues_a_job(client, app_module):
+    response = client.post('/api/deployments/dep-1/scale', json={'remove': ['10.0.0.5', 'i-2']})
+    assert response.status_code == 202
+    job = response.get_json()['job']
+    assert (job['kind'], job['params']) == ('scale', {'add': 0, 'remove': ['10.0.0.5', 'i-2']})
+    assert client.post('/api/deployments/nope/scale', json={'add': 1}).status_code == 404
+
+
+class FakeAWS:
+    def __init__(self, errors=()):
+        self.errors = set(errors)
+        self.calls = []
+
+    def terminate_deployments(self, deployment_ids):
+        self.calls.append(list(deployment_ids))
+        terminated = {dep_id: [] if dep_id in self.errors else [f'i-{dep_id}'] for dep_id in deployment_ids}
+        return terminated, {dep_id: "UnauthorizedOperation" for dep_id in deployment_ids if dep_id in self.errors}
+
+
+def wait_for_job(app_module, job_id):
+    for _ in range(500):
+        job = app_module.jobs.get(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} never finished")
+
+
+def add_deployments(storage, statuses):
+    for dep_id, status in statuses.items():
+        storage.save_deployment({'id': dep_id, 'status': status, 'created_at': '2026-01-01T00:00:00Z',
+                                 'key_name': 'test-key', 'head': None, 'workers': []})
+
+
+def test_bulk_delete_reports_partial_failures(client, app_module, monkeypatch):
+    aws = FakeAWS(errors=['dep-3'])
+    monkeypatch.setattr(app_module, 'aws_client', aws)
+    storage = app_module.storage
+    add_deployments(storage, {'dep-2': 'running', 'dep-3': 'running', 'dep-4': 'failed'})
+    version = storage.version
+
+    response = client.post('/api/deployments/bulk-delete', json={'deployment_ids': ['dep-4', 'dep-2', 'dep-3']})
+    assert response.status_code == 202
+    job = wait_for_job(app_module, response.get_json()['job_id'])
+
+    assert job['status'] == 'succeeded'
+    assert job['result']['errors'] == {'dep-3': 'UnauthorizedOperation'}
+    assert job['result']['terminated_instances']['dep-2'] == ['i-dep-2']
+    assert aws.calls == [['dep-2', 'dep-3', 'dep-4']]  # one batched call
+    statuses = {dep_id: storage.get_deployment(dep_id)['status'] for dep_id in ('dep-2', 'dep-3', 'dep-4')}
+    assert statuses == {'dep-2': 'terminated', 'dep-3': 'failed', 'dep-4': 'terminated'}
+    # One write each for 'terminating', 'terminated' and 'failed', however many deployments
+    assert storage.version == version + 3
+
+
+@pytest.mark.parametrize('body, status', [
+    ({}, 400), ({'deployment_ids': []}, 400), ({'deployment_ids': 'dep-2'}, 400), ({'deployment_ids': ['nope']}, 404),
+])
+def test_bulk_delete_rejects_bad_requests(client, body, status):
+    assert client.post('/api/deployments/bulk-delete', json=body).status_code == status
+
+
+def test_clear_terminated_in_one_write(client, app_module):
+    storage = app_module.storage
+    version = storage.version
+    response = client.post('/api/deployments/clear-terminated')
+    assert response.get_json()['cleared_count'] == 0
+    assert storage.version == version  # nothing to clear, nothing for SSE clients to diff
+
+    add_deployments(storage, {'dep-2': 'terminated', 'dep-3': 'terminated', 'dep-4': 'running'})
+    version = storage.version
+    response = client.post('/api/deployments/clear-terminated')
+    assert response.get_json()['cleared_count'] == 2
+    assert storage.version == version + 1
+    assert set(storage.get_all_deployments()) == {'dep-1', 'dep-4'}
+    assert sorted(storage.get_changes_since(version)['removed']) == ['dep-2', 'dep-3']
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+
+def live_instances(aws):
+    reservations = aws.ec2.describe_instances(Filters=[
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running']}
+    ])['Reservations']
+    return [i['InstanceId'] for r in reservations for i in r['Instances']]
+
+
+def launch(aws, count, **kwargs):
+    return aws.launch_instances(os.environ['LAUNCH_TEMPLATE_ID'], count, 'test-key', 'dep-1', **kwargs)
+
+
+def test_launch_spreads_and_tags_instances(aws):
+    instance_ids = launch(aws, 4)
+    assert sorted(instance_ids) == sorted(live_instances(aws))
+    instances = [i for r in aws.ec2.describe_instances(InstanceIds=instance_ids)['Reservations']
+                 for i in r['Instances']]
+    assert len({i['SubnetId'] for i in instances}) == 4
+    assert all({'Key': 'DeploymentId', 'Value': 'dep-1'} in i['Tags'] for i in instances)
+
+
+def test_failed_launch_terminates_what_was_launched(aws, monkeypatch):
+    run_instances = aws.ec2.run_instances
+    calls = []
+
+    def flaky(**params):
+        calls.append(params)
+        if len(calls) > 1:
+            raise ConnectionError("connection reset")
+        return run_instances(**params)
+
+    monkeypatch.setattr(aws.ec2, 'run_instances', flaky)
+    with pytest.raises(ConnectionError):
+        launch(aws, 6)
+    assert len(calls) > 1
+    assert live_instances(aws) == []
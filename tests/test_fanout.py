@@ -0,0 +1,96 @@
+import threading
+import time
+
+from fanout import FanOut, describe_failures, run_fanout
+from ssh_mux import CommandCancelled
+
+
+def by_host(results):
+    return {r.host: r for r in results}
+
+
+def test_results_per_host():
+    def boom(cancel_event):
+        raise RuntimeError("boom")
+
+    results = by_host(run_fanout({
+        'a': lambda cancel_event: 0,
+        'b': lambda cancel_event: None,
+        'c': lambda cancel_event: 2,
+        'd': boom,
+    }, max_concurrency=2))
+    assert results['a'].ok and results['b'].ok
+    assert (results['c'].status, results['c'].exit_code) == ('failed', 2)
+    assert (results['d'].status, results['d'].error) == ('failed', 'boom')
+    assert describe_failures(list(results.values())).splitlines() == [
+        'c: failed (exit code 2)', 'd: failed (boom)']
+
+
+def test_fail_fast_cancels_running_and_queued():
+    started = []
+    running = threading.Event()
+
+    def slow(cancel_event):
+        started.append(True)
+        running.set()
+        if cancel_event.wait(5):
+            raise CommandCancelled("cancelled")
+        return 0
+
+    def fail(cancel_event):
+        running.wait(5)
+        return 1
+
+    fanout = FanOut(max_concurrency=2, fail_fast=True)
+    fanout.submit('slow', slow)
+    fanout.submit('bad', fail)
+    for i in range(5):
+        fanout.submit(f'queued-{i}', slow)
+    start = time.time()
+    results = by_host(fanout.wait())
+
+    assert time.time() - start < 2
+    assert fanout.cancelled
+    assert results['bad'].status == 'failed'
+    assert results['slow'].status == 'cancelled'
+    assert len(started) == 1
+    assert all(results[f'queued-{i}'].status == 'cancelled' for i in range(5))
+
+    # Hosts submitted after fail-fast tripped never run
+    fanout.submit('late', slow)
+    assert fanout._results['late'].status == 'cancelled'
+
+
+def test_without_fail_fast_everything_runs():
+    results = by_host(run_fanout({
+        'bad': lambda cancel_event: 1,
+        **{f'ok-{i}': (lambda cancel_event: 0) for i in range(5)},
+    }, max_concurrency=1))
+    assert results['bad'].status == 'failed'
+    assert all(results[f'ok-{i}'].ok for i in range(5))
+
+
+def test_host_timeout():
+    def hang(cancel_event):
+        if cancel_event.wait(5):
+            raise CommandCancelled("cancelled")
+        return 0
+
+    results = by_host(run_fanout({'slow': hang, 'fast': lambda cancel_event: 0}, host_timeout=0.1))
+    assert results['slow'].status == 'timeout'
+    assert results['slow'].duration < 2
+    assert results['fast'].ok
+
+
+def test_on_result_and_submit_while_running():
+    seen = []
+    fanout = FanOut(max_concurrency=2, on_result=lambda r: seen.append(r.host))
+
+    def first(cancel_event):
+        fanout.submit('second', lambda cancel_event: 0)
+        return 0
+
+    fanout.submit('first', first)
+    results = by_host(fanout.wait())
+    assert set(results) == {'first', 'second'}
+    assert sorted(seen) == ['first', 'second']
@@ -0,0 +1,143 @@
+import threading
+
+import paramiko
+import pytest
+
+from fanout import AnyEvent
+from file_transfer import RelaySources, TransferResult, build_manifest, parse_checksums
+from ssh_mux import CommandCancelled
+from ssh_runner import SSHRunner
+
+
+def test_direct_slots_and_seed_preference():
+    sources = RelaySources(direct_slots=1, per_seed=2)
+    assert sources.acquire() is None
+    sources.add_seed('seed', '172.31.0.9')
+    assert [sources.acquire(), sources.acquire()] == ['seed', 'seed']
+    assert sources.address('seed') == '172.31.0.9'
+
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(CommandCancelled):
+        sources.acquire(cancel)  # every slot is taken
+    sources.release('seed')
+    assert sources.acquire(cancel) == 'seed'
+    sources.release(None)
+    assert sources.acquire(cancel, allow_relay=False) is None
+
+
+def test_first_failed_relay_turns_relaying_off():
+    sources = RelaySources(direct_slots=1, per_seed=1)
+    sources.add_seed('seed')
+    sources.release(sources.acquire(), ok=None)  # interrupted: no verdict
+    assert sources.relay
+    sources.release(sources.acquire(), ok=False)
+    assert not sources.relay
+    sources.add_seed('another')
+    assert sources.seeds == ['seed']
+    assert sources.acquire() is None
+
+
+def test_any_event():
+    first, second = threading.Event(), threading.Event()
+    either = AnyEvent(first, None, second)
+    assert not either.wait(0.05)
+    second.set()
+    assert either.is_set() and either.wait()
+
+
+class FakeRunner(SSHRunner):
+    """Hosts are dicts of {rel_path: sha256}; fetches and uploads copy the local manifest"""
+
+    def __init__(self, key_path, files, fail_fetch=False):
+        super().__init__(str(key_path))
+        self.files = files
+        self.fail_fetch = fail_fetch
+        self.commands = []
+        self.uploads = []
+        self._lock = threading.Lock()
+
+    def run_capture(self, ip, command, cancel_event=None, timeout=600):
+        with self._lock:
+            self.commands.append((ip, command))
+        if 'sha256sum --' in command:
+            return 0, [f"{sha}  {path}" for path, sha in self.files.setdefault(ip, {}).items()]
+        if 'curl' in command:
+            if self.fail_fetch == 'raise':
+                raise CommandCancelled("cancelled mid-fetch")
+            if self.fail_fetch:
+                return 22, []
+            self.files[ip] = dict(self.manifest)
+        if 'http.server' in command and '--bind' in command:
+            return 0, [f"172.31.0.{len(self.commands)}"]
+        return 0, []
+
+    def _sftp_put(self, ip, root, entries, cancel_event=None):
+        with self._lock:
+            self.uploads.append((ip, [e.rel_path for e in entries]))
+        self.files.setdefault(ip, {}).update({e.rel_path: e.sha256 for e in entries})
+
+
+@pytest.fixture
+def wheels(tmp_path):
+    local = tmp_path / 'wheels'
+    local.mkdir()
+    for name in ('a.whl', 'b.whl'):
+        (local / name).write_bytes(name.encode() * 1000)
+    return local
+
+
+@pytest.fixture
+def key_path(tmp_path):
+    path = tmp_path / 'key.pem'
+    paramiko.RSAKey.generate(1024).write_private_key_file(str(path))
+    return path
+
+
+def test_unchanged_files_are_skipped(wheels, key_path):
+    manifest = {e.rel_path: e.sha256 for e in build_manifest(str(wheels))}
+    runner = FakeRunner(key_path, {'h1': dict(manifest), 'h2': {'a.whl': manifest['a.whl']}})
+    results = {r.host: r for r in runner.broadcast(str(wheels), '~/wheels', ['h1', 'h2'])}
+    assert runner.uploads == [('h2', ['b.whl'])]
+    assert (results['h1'].files_sent, results['h1'].files_skipped) == (0, 2)
+    assert (results['h2'].files_sent, results['h2'].files_skipped) == (1, 1)
+    assert parse_checksums([f"{'0' * 64}  *x"]) == {'x': '0' * 64}
+
+
+def test_failed_relay_falls_back_to_sftp_and_servers_are_stopped(wheels, key_path):
+    runner = FakeRunner(key_path, {}, fail_fetch=True)
+    runner.manifest = {e.rel_path: e.sha256 for e in build_manifest(str(wheels))}
+    hosts = [f'h{i}' for i in range(6)]
+    results = runner.broadcast(str(wheels), '~/wheels', hosts, relay=True, relay_fanout=1, max_concurrency=1)
+    assert all(r.ok and r.source == 'direct' for r in results)
+    assert sorted(ip for ip, _ in runner.uploads) == hosts
+    # Relaying stopped after the failure; every server that started was stopped
+    served = [ip for ip, command in runner.commands if '--bind' in command]
+    stopped = [ip for ip, command in runner.commands if command.startswith('pkill')]
+    assert served and sorted(stopped) == sorted(served)
+
+
+def test_relayed_hosts_fetch_from_the_seed_private_address(wheels, key_path):
+    runner = FakeRunner(key_path, {})
+    runner.manifest = {e.rel_path: e.sha256 for e in build_manifest(str(wheels))}
+    results = runner.broadcast(str(wheels), '~/wheels', ['h0', 'h1', 'h2'], relay=True, relay_fanout=1,
+                               max_concurrency=1)
+    assert results[0].source == 'direct' and {r.source for r in results[1:]} <= {'h0', 'h1'}
+    assert runner.uploads == [('h0', ['a.whl', 'b.whl'])]
+    [address] = [f"172.31.0.{i + 1}" for i, (ip, command) in enumerate(runner.commands)
+                 if ip == 'h0' and '--bind' in command]
+    fetches = [command for ip, command in runner.commands if ip == 'h1' and 'curl' in command]
+    assert fetches and f'http://{address}:' in fetches[0]
+
+
+def test_interrupted_fetch_returns_its_slot(wheels, key_path):
+    runner = FakeRunner(key_path, {}, fail_fetch='raise')
+    sources = RelaySources(direct_slots=0, per_seed=1)
+    sources.add_seed('h0')
+    with pytest.raises(CommandCancelled):
+        runner._broadcast_to('h1', build_manifest(str(wheels)), 'wheels', sources, TransferResult('h1'),
+                             threading.Event())
+    cancel = threading.Event()
+    cancel.set()
+    assert sources.acquire(cancel) == 'h0'
+    assert sources.relay
@@ -0,0 +1,84 @@
+import pytest
+
+import deployment_manager
+import image_baker
+import wheelhouse
+from deployment_manager import COMMIT_MARKER, DeploymentManager
+from storage import Storage
+
+COMMIT_A = 'a' * 40
+COMMIT_B = 'b' * 40
+
+
+class FakeSSH:
+    """Records the commands a bake runs on its build node"""
+
+    def __init__(self):
+        self.commands = []
+
+    def run_command(self, ip, command, log_callback=None, use_pty=True, background=False, cancel_event=None):
+        self.commands.append(command)
+        return 0
+
+
+@pytest.fixture
+def manager(aws, tmp_path, monkeypatch):
+    monkeypatch.setattr(deployment_manager, 'GOLDEN_IMAGE', 'auto')
+    monkeypatch.setattr(wheelhouse, 'PINNED_COMMIT', COMMIT_A)
+    return DeploymentManager(aws, FakeSSH(), Storage(str(tmp_path / 'data')))
+
+
+def wait_for_bakes():
+    for thread in list(image_baker._baking.values()):
+        thread.join(30)
+
+
+def image_of(aws, instance_ids):
+    reservations = aws.ec2.describe_instances(InstanceIds=instance_ids)['Reservations']
+    return {i['ImageId'] for r in reservations for i in r['Instances']}
+
+
+def test_setup_hash_follows_the_commit(manager, monkeypatch):
+    first = manager.setup_hash()
+    assert manager.setup_hash() == first
+    monkeypatch.setattr(wheelhouse, 'PINNED_COMMIT', COMMIT_B)
+    assert manager.setup_hash() != first
+    assert any(COMMIT_B in command for command in manager.setup_commands(COMMIT_B))
+
+
+def test_bake_launch_and_rebake(manager, aws, monkeypatch):
+    log = []
+    # No image yet: the launch installs from the template and a bake starts
+    instance_ids, preinstalled, image_id = manager._acquire_instances('dep-1', 2, 'test-key', 2, log.append)
+    assert image_id is None and not preinstalled
+    wait_for_bakes()
+    first_image = manager.baker.current_image(manager.setup_hash())
+    assert first_image
+    assert f"echo {COMMIT_A} > {COMMIT_MARKER}" in manager.ssh.commands
+    assert any(f"@{COMMIT_A}" in command for command in manager.ssh.commands)
+
+    # Launches now boot from the baked image
+    instance_ids, preinstalled, image_id = manager._acquire_instances('dep-2', 2, 'test-key', 2, log.append)
+    assert image_id == first_image
+    assert preinstalled == set(instance_ids)
+    assert image_of(aws, instance_ids) == {first_image}
+    first_snapshots = {m['Ebs']['SnapshotId'] for m in aws.ec2.describe_images(
+        ImageIds=[first_image])['Images'][0]['BlockDeviceMappings'] if 'Ebs' in m}
+    assert first_snapshots
+
+    # The branch moved: the old image no longer matches and a new one is baked
+    monkeypatch.setattr(wheelhouse, 'PINNED_COMMIT', COMMIT_B)
+    instance_ids, _, image_id = manager._acquire_instances('dep-3', 1, 'test-key', 1, log.append)
+    assert image_id is None
+    assert image_of(aws, instance_ids) != {first_image}
+    wait_for_bakes()
+    second_image = manager.baker.current_image(manager.setup_hash())
+    assert second_image not in (None, first_image)
+    assert f"echo {COMMIT_B} > {COMMIT_MARKER}" in manager.ssh.commands
+
+    # ...and the old one is deregistered along with its snapshot
+    images = aws.ec2.describe_images(Owners=['self'])['Images']
+    assert [i['ImageId'] for i in images] == [second_image]
+    snapshots = {s['SnapshotId'] for s in aws.ec2.describe_snapshots(OwnerIds=['self'])['Snapshots']}
+    assert not first_snapshots & snapshots
+
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+from jobs import JobConflict, JobManager
+from storage import Storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return Storage(str(tmp_path / 'data'))
+
+
+@pytest.fixture
+def manager(storage):
+    return JobManager(storage, max_workers=2)
+
+
+def blocking():
+    """A job function that runs until released, and an event set once it started"""
+    started, release = threading.Event(), threading.Event()
+
+    def fn(job):
+        started.set()
+        release.wait(5)
+        job.check_cancelled()
+        return {'done': True}
+    return fn, started, release
+
+
+def wait_done(manager, job_id):
+    for _ in range(500):
+        job = manager.get(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job {job_id} still {job['status']}")
+
+
+def test_runs_and_records_result(manager, storage):
+    job, created = manager.submit('restart', 'dep-1', lambda job: {'ok': 1})
+    assert created and job['status'] in ('queued', 'running', 'succeeded')
+    job = wait_done(manager, job['id'])
+    assert (job['status'], job['result']) == ('succeeded', {'ok': 1})
+    assert storage.get_job(job['id'])['status'] == 'succeeded'
+    assert manager.active('dep-1') is None
+
+
+def test_same_job_is_deduplicated(manager):
+    fn, started, release = blocking()
+    first, created = manager.submit('restart', 'dep-1', fn, {'mode': 'rolling'})
+    started.wait(5)
+    again, created_again = manager.submit('restart', 'dep-1', fn, {'mode': 'rolling'})
+    assert created and not created_again
+    assert again['id'] == first['id']
+    assert manager.active('dep-1')['id'] == first['id']
+    release.set()
+    wait_done(manager, first['id'])
+
+
+def test_other_jobs_conflict(manager):
+    fn, started, release = blocking()
+    first, _ = manager.submit('restart', 'dep-1', fn, {'mode': 'rolling'})
+    with pytest.raises(JobConflict) as conflict:
+        manager.submit('restart', 'dep-1', fn, {'mode': 'all'})
+    assert conflict.value.job['id'] == first['id']
+    with pytest.raises(JobConflict):
+        manager.submit('delete', 'dep-1', fn)
+    # A bulk job claims every deployment it covers
+    with pytest.raises(JobConflict):
+        manager.submit('bulk_delete', None, fn, {'deployment_ids': ['dep-1', 'dep-2']}, ['dep-1', 'dep-2'])
+    other, created = manager.submit('delete', 'dep-2', lambda job: None)
+    assert created
+    release.set()
+    wait_done(manager, first['id'])
+    # Free again once finished
+    assert manager.submit('delete', 'dep-1', lambda job: None)[1]
+
+
+def test_cancel_running_and_queued(storage):
+    manager = JobManager(storage, max_workers=1)
+    fn, started, release = blocking()
+    running, _ = manager.submit('restart', 'dep-1', fn)
+    queued, _ = manager.submit('restart', 'dep-2', fn)
+    started.wait(5)
+
+    assert manager.cancel(queued['id'])['status'] == 'cancelled'
+    assert manager.cancel(running['id'])['cancel_requested']
+    release.set()
+    assert wait_done(manager, running['id'])['status'] == 'cancelled'
+    assert manager.get(queued['id'])['error'] == "Cancelled before it started"
+    assert manager.cancel('job-missing') is None
+
+
+def test_failures_and_progress(manager):
+    def fn(job):
+        job.progress(1, 2, "half way")
+        raise RuntimeError("boom")
+
+    job, _ = manager.submit('scale', 'dep-1', fn)
+    job = wait_done(manager, job['id'])
+    assert (job['status'], job['error']) == ('failed', 'boom')
+    assert job['progress'] == {'done': 1, 'total': 2, 'message': 'half way'}
+
+
+def test_interrupted_jobs_fail_on_startup(storage):
+    storage.save_job({'id': 'job-1', 'kind': 'restart', 'deployment_id': 'dep-1', 'status': 'running',
+                      'created_at': '2026-01-01T00:00:00Z'})
+    JobManager(storage)
+    job = storage.get_job('job-1')
+    assert job['status'] == 'failed' and 'server restart' in job['error']
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from launch_planner import LaunchPlanner
+
+SUBNETS = [{'SubnetId': f'subnet-{az}', 'AvailabilityZone': f'us-west-2{az}'} for az in 'abc']
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'RunInstances')
+
+
+class FakeEC2:
+    """run_instances stand-in: capacity per subnet (None = unlimited), or an error to raise"""
+
+    def __init__(self, capacity=None, errors=None):
+        self.capacity = dict(capacity or {})
+        self.errors = dict(errors or {})
+        self.calls = []
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def __call__(self, subnet_id, max_count):
+        with self._lock:
+            self.calls.append((subnet_id, max_count))
+            if subnet_id in self.errors:
+                raise self.errors[subnet_id]
+            available = self.capacity.get(subnet_id)
+            n = max_count if available is None else min(max_count, available)
+            if n == 0:
+                raise client_error('InsufficientInstanceCapacity')
+            if available is not None:
+                self.capacity[subnet_id] -= n
+            ids = [f'i-{self._next + i:04d}' for i in range(n)]
+            self._next += n
+            return ids
+
+
+def test_spreads_evenly_over_subnets():
+    ec2 = FakeEC2()
+    assert len(LaunchPlanner(ec2, SUBNETS).run(10)) == 10
+    assert sorted(ec2.calls) == [('subnet-a', 4), ('subnet-b', 3), ('subnet-c', 3)]
+
+
+def test_no_subnets_launches_without_one():
+    ec2 = FakeEC2()
+    assert len(LaunchPlanner(ec2, []).run(3)) == 3
+    assert ec2.calls == [(None, 3)]
+
+
+def test_capacity_shortfall_moves_to_other_subnets():
+    ec2 = FakeEC2(capacity={'subnet-a': 0, 'subnet-b': 1})
+    logged = []
+    planner = LaunchPlanner(ec2, SUBNETS)
+    assert len(planner.run(9, logged.append)) == 9
+    # Round 1: 3 each; a fails, b launches 1. Round 2: the 5 missing go to c.
+    assert ec2.calls[3:] == [('subnet-c', 5)]
+    assert planner.errors() == ['subnet-a: InsufficientInstanceCapacity', 'subnet-b: only 1 of 3 launched']
+    assert logged == ['Retrying 5 instances in us-west-2c (5)']
+
+
+def test_partial_fulfilment_when_every_subnet_runs_out():
+    ec2 = FakeEC2(capacity={'subnet-a': 1, 'subnet-b': 0, 'subnet-c': 2})
+    planner = LaunchPlanner(ec2, SUBNETS)
+    assert len(planner.run(12)) == 3
+    assert len(planner.errors()) == 3
+
+
+def test_stops_after_max_rounds():
+    ec2 = FakeEC2(capacity={'subnet-a': 1, 'subnet-b': 1, 'subnet-c': 1})
+    planner = LaunchPlanner(ec2, SUBNETS, max_rounds=1)
+    assert len(planner.run(9)) == 3
+    assert len(ec2.calls) == 3
+
+
+def test_other_errors_abort_but_keep_what_launched():
+    ec2 = FakeEC2(errors={'subnet-b': client_error('InvalidParameterValue')})
+    planner = LaunchPlanner(ec2, SUBNETS)
+    with pytest.raises(ClientError):
+        planner.run(6)
+    # The other subnets' instances are still reported, so the caller can clean them up
+    assert len(planner.launched) == 4
@@ -0,0 +1,37 @@
+import log_broadcast
+from log_broadcast import get_log_channel, release_log_channel
+from log_writer import close_log_writer, get_log_writer
+
+
+def test_sequence_continues_from_file(tmp_path):
+    path = str(tmp_path / 'dep.log')
+    with open(path, 'w') as f:
+        f.write("old 1\nold 2\n")
+    channel = get_log_channel(path)
+    channel.publish(['new 3'])
+    # Lines from before the channel existed come from the file
+    assert channel.read_since(0) == [(1, 'old 1'), (2, 'old 2')]
+    assert channel.read_since(2) == [(3, 'new 3')]
+    assert channel.read_since(3, timeout=0.01) == []
+    release_log_channel(channel)
+
+
+def test_channel_dropped_when_writer_and_streams_are_done(tmp_path):
+    path = str(tmp_path / 'dep.log')
+    writer = get_log_writer(path)
+    stream = get_log_channel(path)
+    assert stream is writer.channel
+
+    writer.write("hello")
+    close_log_writer(path)
+    assert path in log_broadcast._channels  # still streamed
+    assert [line.endswith('] hello') for _, line in stream.read_since(0)] == [True]
+
+    release_log_channel(stream)
+    assert path not in log_broadcast._channels
+
+    # A later operation gets a fresh channel that picks up where the file left off
+    writer = get_log_writer(path)
+    assert writer.channel is not stream and writer.channel.last_seq == 1
+    close_log_writer(path)
+    assert path not in log_broadcast._channels
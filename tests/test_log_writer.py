@@ -0,0 +1,63 @@
+import threading
+
+import log_writer
+from log_broadcast import get_log_channel, release_log_channel
+from log_writer import close_log_writer, get_log_writer
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [line.split('] ', 1)[1].rstrip('\n') for line in f]
+
+
+def test_lines_are_timestamped_and_flushed(tmp_path):
+    path = str(tmp_path / 'logs' / 'dep.log')
+    writer = get_log_writer(path)
+    writer.write("one\ntwo")
+    writer.flush()
+    assert read_lines(path) == ['one', 'two']
+    close_log_writer(path)
+
+
+def test_close_releases_thread_and_cache(tmp_path):
+    path = str(tmp_path / 'dep.log')
+    threads = threading.active_count()
+    write = get_log_writer(path).write
+    write("before")
+    close_log_writer(path)
+    assert path not in log_writer._writers
+    assert threading.active_count() == threads
+    assert read_lines(path) == ['before']
+
+    # A late write through an old callback is appended without starting a writer
+    write("after")
+    assert path not in log_writer._writers
+    assert threading.active_count() == threads
+    assert read_lines(path) == ['before', 'after']
+    close_log_writer(path)  # nothing left to close
+
+
+def test_late_write_goes_through_the_current_writer(tmp_path):
+    path = str(tmp_path / 'dep.log')
+    old = get_log_writer(path)
+    old.write("first run")
+    close_log_writer(path)
+    current = get_log_writer(path)
+    current.write("second run")
+    old.write("straggler")
+    current.flush()
+    assert read_lines(path) == ['first run', 'second run', 'straggler']
+    assert current.channel.last_seq == 3
+    close_log_writer(path)
+
+
+def test_late_write_reaches_open_streams(tmp_path):
+    path = str(tmp_path / 'dep.log')
+    writer = get_log_writer(path)
+    writer.write("one")
+    close_log_writer(path)
+    channel = get_log_channel(path)
+    writer.write("two")
+    [(seq, line)] = channel.read_since(1)
+    assert seq == 2 and line.endswith('] two')
+    release_log_channel(channel)
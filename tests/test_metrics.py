@@ -0,0 +1,44 @@
+import metrics
+from metrics import Timings, count_retries, render, summarize
+
+
+def test_spans_record_retries():
+    saved = []
+    timings = Timings(saved.extend)
+    with timings.span('head_start', host='10.0.0.1'):
+        count_retries(2, host='10.0.0.1')
+        count_retries(5, host='10.0.0.2')
+    with timings.span('run_instances', count=3):
+        count_retries(4)
+        count_retries(1, host='10.0.0.2')
+    timings.add('terminate', 1.0)
+    timings.flush()
+
+    assert [(s['phase'], s.get('retries')) for s in saved] == [
+        ('head_start', 2), ('run_instances', 5), ('terminate', None)]
+    assert saved[1]['count'] == 3
+    assert summarize(saved)['run_instances']['retries'] == 5
+
+
+def test_failed_span_and_histogram():
+    saved = []
+    timings = Timings(saved.extend)
+    try:
+        with timings.span('drain_test_phase'):
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    timings.flush()
+    assert saved[0]['ok'] is False
+    assert 'deployment_phase_seconds_count{phase="drain_test_phase",ok="false"} 1' in render()
+
+
+def test_flushes_in_batches(monkeypatch):
+    batches = []
+    monkeypatch.setattr(metrics, 'TIMINGS_FLUSH_INTERVAL', 3600)
+    timings = Timings(batches.append)
+    for i in range(3):
+        timings.add('install', i)
+    assert batches == []
+    timings.flush()
+    assert [len(batch) for batch in batches] == [3]
@@ -0,0 +1,122 @@
+import pytest
+
+import deployment_manager
+from deployment_manager import DeploymentManager
+from storage import Storage
+
+WORKERS = [f'10.0.0.{i}' for i in range(1, 6)]
+HEAD = '10.0.0.100'
+
+
+class FakeSSH:
+    """Records (ip, step) for every command, naming the step by what the command does"""
+
+    def __init__(self):
+        self.calls = []
+        self.head_workers = []
+        self.exit_codes = {}  # {(ip, step): exit code}, default 0
+
+    def run_command(self, ip, command, log_callback=None, use_pty=True, background=False, cancel_event=None):
+        step = self.step(command)
+        self.calls.append((ip, step))
+        if '--worker-urls' in command:
+            urls = command.split('--worker-urls ')[1].split()[0]
+            self.head_workers.append([url[7:-5] for url in urls.split(',') if url])
+        return self.exit_codes.get((ip, step), 0)
+
+    def run_parallel(self, commands, log_callback=None, use_pty=True, background=False, **kwargs):
+        failed = []
+        for ip, command in commands:
+            if self.run_command(ip, command):
+                failed.append(ip)
+        if failed and not background:
+            raise Exception(f"Some worker setups failed:\n{', '.join(failed)}")
+        return []
+
+    def run_capture(self, ip, command, cancel_event=None, timeout=None):
+        return 0, []
+
+    @staticmethod
+    def step(command):
+        for marker, step in (('docker ps -q', 'drain'), ('pkill -9', 'kill'), ('compose', 'cleanup'),
+                             ('nohup', 'start'), ('pgrep', 'health')):
+            if marker in command:
+                return step
+        return command
+
+
+@pytest.fixture
+def manager(tmp_path):
+    storage = Storage(str(tmp_path / 'data'))
+    storage.save_deployment({
+        'id': 'dep-1',
+        'status': 'running',
+        'created_at': '2026-01-01T00:00:00Z',
+        'head': {'instance_id': 'i-head', 'ip': HEAD},
+        'workers': [{'instance_id': f'i-{ip}', 'ip': ip} for ip in WORKERS],
+    })
+    return DeploymentManager(None, FakeSSH(), storage)
+
+
+def test_rolling_restart_takes_each_batch_out_of_routing_first(manager):
+    progress = []
+    manager.restart_servers('dep-1', mode='rolling', batch_size=2,
+                            progress=lambda done, total, message: progress.append((done, total)))
+    calls = manager.ssh.calls
+    batches = [WORKERS[0:2], WORKERS[2:4], WORKERS[4:]]
+    expected = []
+    for batch in batches:
+        expected += [(HEAD, 'kill'), (HEAD, 'start')]
+        expected += [(ip, step) for step in ('drain', 'kill', 'cleanup', 'start', 'health') for ip in batch]
+    expected += [(HEAD, 'kill'), (HEAD, 'start')]
+    assert calls == expected
+    # While a batch drains and restarts, the head only routes to the others
+    assert manager.ssh.head_workers == [[ip for ip in WORKERS if ip not in batch] for batch in batches] + [WORKERS]
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+    assert manager.storage.get_deployment('dep-1')['status'] == 'running'
+
+
+def test_drain_timeout_is_logged(manager, home):
+    manager.ssh.exit_codes[(WORKERS[0], 'drain')] = 3
+    manager.restart_servers('dep-1', mode='rolling', batch_size=5)
+    with open(home / '.aws-deployment-manager' / 'logs' / 'dep-1.log') as f:
+        assert 'Warning: draining did not finish' in f.read()
+    assert (WORKERS[0], 'kill') in manager.ssh.calls
+
+
+def test_failed_batch_keeps_the_previous_status(manager):
+    manager.ssh.exit_codes[(WORKERS[2], 'health')] = 1
+    with pytest.raises(Exception):
+        manager.restart_servers('dep-1', mode='rolling', batch_size=2)
+    assert manager.storage.get_deployment('dep-1')['status'] == 'running'
+    assert manager.ssh.head_workers[-1] == WORKERS  # every worker is routed to again
+    assert (WORKERS[4], 'drain') not in manager.ssh.calls
+
+
+def test_failed_head_restart_marks_the_deployment_failed(manager):
+    manager.ssh.run_command = raising(manager.ssh.run_command, HEAD)
+    with pytest.raises(Exception):
+        manager.restart_servers('dep-1', mode='rolling', batch_size=2)
+    assert manager.storage.get_deployment('dep-1')['status'] == 'failed'
+
+
+def raising(run_command, broken_ip):
+    def run(ip, command, *args, **kwargs):
+        if ip == broken_ip:
+            raise Exception(f"[{ip}] Connection refused")
+        return run_command(ip, command, *args, **kwargs)
+    return run
+
+
+def test_restart_all_restarts_the_head(manager):
+    manager.restart_servers('dep-1', mode='all')
+    steps = [step for _, step in manager.ssh.calls]
+    assert 'drain' not in steps
+    assert manager.ssh.calls[-2:] == [(HEAD, 'kill'), (HEAD, 'start')]
+
+
+def test_timings_are_saved_and_dropped_from_memory(manager):
+    manager.restart_servers('dep-1', mode='all')
+    assert 'dep-1' not in deployment_manager._timings
+    phases = [span['phase'] for span in manager.storage.get_timings('dep-1')]
+    assert 'restart' in phases
@@ -0,0 +1,121 @@
+import pytest
+
+import deployment_manager
+from deployment_manager import DeploymentManager
+from storage import Storage
+
+HEAD = '10.0.0.100'
+WORKERS = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+
+class FakeSSH:
+    """Records (ip, command); probes fail so every step runs. Commands on `broken` hosts raise"""
+
+    def __init__(self):
+        self.commands = []
+        self.broken = set()
+
+    def run_command(self, ip, command, log_callback=None, use_pty=True, background=False, cancel_event=None):
+        if ip in self.broken:
+            raise Exception(f"[{ip}] Connection refused")
+        self.commands.append((ip, command))
+        return 0
+
+    def run_parallel(self, commands, log_callback=None, use_pty=True, background=False, **kwargs):
+        for ip, command in commands:
+            self.run_command(ip, command)
+        return []
+
+    def run_capture(self, ip, command, cancel_event=None, timeout=None):
+        self.commands.append((ip, command))
+        return 1, []
+
+    def head_workers(self):
+        """Worker URLs of the last head start"""
+        starts = [command for ip, command in self.commands if ip == HEAD and 'head_server --worker-urls' in command]
+        return starts[-1].split('--worker-urls ')[1].split()[0].split(',') if starts else None
+
+
+class FakeAWS:
+    def __init__(self):
+        self.terminated = []
+
+    def terminate_instances(self, instance_ids):
+        self.terminated += instance_ids
+
+
+def urls(ips):
+    return [f'http://{ip}:8080' for ip in ips]
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(deployment_manager, 'resolve_commit', lambda: None)
+    storage = Storage(str(tmp_path / 'data'))
+    storage.save_deployment({
+        'id': 'dep-1', 'status': 'running', 'created_at': '2026-01-01T00:00:00Z', 'key_name': 'test-key',
+        'instance_ids': ['i-head'] + [f'i-{ip}' for ip in WORKERS],
+        'head': {'instance_id': 'i-head', 'ip': HEAD},
+        'workers': [{'instance_id': f'i-{ip}', 'ip': ip} for ip in WORKERS],
+    })
+    return DeploymentManager(FakeAWS(), FakeSSH(), storage)
+
+
+def test_scale_in_restarts_the_head_without_the_removed_workers(manager):
+    manager.scale_deployment('dep-1', remove=['10.0.0.2'], wait=True)
+    ssh = manager.ssh
+    assert ssh.head_workers() == urls(['10.0.0.1', '10.0.0.3'])
+    drained = [i for i, (ip, command) in enumerate(ssh.commands) if ip == '10.0.0.2' and 'docker ps -q' in command]
+    head_start = next(i for i, (ip, command) in enumerate(ssh.commands) if ip == HEAD and 'nohup' in command)
+    assert drained and drained[0] > head_start  # out of the head's list before it drains
+    assert manager.aws.terminated == ['i-10.0.0.2']
+    deployment = manager.storage.get_deployment('dep-1')
+    assert deployment['status'] == 'running'
+    assert [w['ip'] for w in deployment['workers']] == ['10.0.0.1', '10.0.0.3']
+    assert 'i-10.0.0.2' not in deployment['instance_ids']
+
+
+def test_scale_out_adds_workers_to_the_head(manager, monkeypatch):
+    monkeypatch.setattr(manager, '_acquire_instances', lambda *args: (['i-new'], set(), None))
+    monkeypatch.setattr(manager, '_wait_until_ready', lambda instance_ids, on_ready, log_callback, **kwargs: [
+        on_ready(iid, '10.0.0.4') for iid in instance_ids
+    ])
+    manager.scale_deployment('dep-1', add=1, wait=True)
+    assert manager.ssh.head_workers() == urls(WORKERS + ['10.0.0.4'])
+    assert all(ip in (HEAD, '10.0.0.4') for ip, _ in manager.ssh.commands)  # old workers untouched
+    deployment = manager.storage.get_deployment('dep-1')
+    assert deployment['status'] == 'running'
+    assert len(deployment['workers']) == 4
+
+
+def test_failed_launch_leaves_the_deployment_running(manager, monkeypatch):
+    def no_capacity(*args):
+        raise Exception("InsufficientInstanceCapacity")
+    monkeypatch.setattr(manager, '_acquire_instances', no_capacity)
+    with pytest.raises(Exception, match="Scaling failed: InsufficientInstanceCapacity"):
+        manager.scale_deployment('dep-1', add=2, wait=True)
+    assert manager.ssh.commands == []
+    deployment = manager.storage.get_deployment('dep-1')
+    assert deployment['status'] == 'running'
+    assert [w['ip'] for w in deployment['workers']] == WORKERS
+
+
+def test_failed_worker_setup_keeps_the_old_worker_list(manager, monkeypatch):
+    monkeypatch.setattr(manager, '_acquire_instances', lambda *args: (['i-new'], set(), None))
+    monkeypatch.setattr(manager, '_wait_until_ready', lambda instance_ids, on_ready, log_callback, **kwargs: [
+        on_ready(iid, '10.0.0.4') for iid in instance_ids
+    ])
+    manager.ssh.broken.add('10.0.0.4')
+    with pytest.raises(Exception, match="Scaling failed"):
+        manager.scale_deployment('dep-1', add=1, wait=True)
+    assert manager.ssh.head_workers() is None
+    deployment = manager.storage.get_deployment('dep-1')
+    assert deployment['status'] == 'running'
+    assert [w['ip'] for w in deployment['workers']] == WORKERS
+
+
+def test_failed_head_restart_marks_the_deployment_failed(manager):
+    manager.ssh.broken.add(HEAD)
+    with pytest.raises(Exception, match="Head server restart failed"):
+        manager.scale_deployment('dep-1', remove=['10.0.0.3'], wait=True)
+    assert manager.storage.get_deployment('dep-1')['status'] == 'failed'
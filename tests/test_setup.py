@@ -0,0 +1,91 @@
+import pytest
+
+import deployment_manager
+from deployment_manager import DeploymentManager, setup_in_progress
+from storage import Storage
+
+COMMIT = 'a' * 40
+
+
+class FakeSSH:
+    """Records every command; probes (run_capture) succeed only on the hosts in `installed`"""
+
+    def __init__(self, installed=()):
+        self.commands = []
+        self.installed = set(installed)
+
+    def run_command(self, ip, command, log_callback=None, use_pty=True, background=False, cancel_event=None):
+        self.commands.append((ip, command))
+        return 0
+
+    def run_capture(self, ip, command, cancel_event=None, timeout=None):
+        self.commands.append((ip, command))
+        return (0 if ip in self.installed else 1), []
+
+    def ran(self, ip, marker):
+        return any(host == ip and marker in command for host, command in self.commands)
+
+
+class FakeAWS:
+    def get_instance_status(self, instance_ids):
+        return {iid: {'state': 'running'} for iid in instance_ids}
+
+
+def make_manager(tmp_path, ssh):
+    return DeploymentManager(None, ssh, Storage(str(tmp_path / 'data')))
+
+
+def test_git_install_is_pinned_to_the_recorded_commit(tmp_path):
+    manager = make_manager(tmp_path, FakeSSH())
+    manager._setup_worker('10.0.0.1', lambda line: None, commit=COMMIT)
+    manager._install_head('10.0.0.2', lambda line: None, commit=COMMIT)
+    installs = [command for _, command in manager.ssh.commands if 'pip install' in command]
+    assert len(installs) == 2
+    assert all(f'@{COMMIT}' in command for command in installs)
+    markers = [ip for ip, command in manager.ssh.commands if command.startswith(f'echo {COMMIT} >')]
+    assert markers == ['10.0.0.1', '10.0.0.2']
+
+
+IPS = {'i-head': '10.0.0.100', 'i-w1': '10.0.0.1', 'i-w2': '10.0.0.2'}
+DONE = {'launched': 't', 'running': 't', 'deps_installed': 't', 'worker_started': 't', 'healthy': 't'}
+
+
+@pytest.fixture
+def resumable(tmp_path, monkeypatch):
+    """A deployment whose head and first worker finished setup, and whose second worker only got an IP"""
+    monkeypatch.setattr(deployment_manager, 'resolve_commit', lambda: COMMIT)
+    monkeypatch.setattr(deployment_manager, 'WHEELHOUSE', False)
+    storage = Storage(str(tmp_path / 'data'))
+    worker_urls = 'http://10.0.0.1:8080,http://10.0.0.2:8080'
+    storage.save_deployment({
+        'id': 'dep-1', 'status': 'failed', 'created_at': '2026-01-01T00:00:00Z', 'key_name': 'test-key',
+        'instance_ids': list(IPS),
+        'head': {'instance_id': 'i-head', 'ip': IPS['i-head']},
+        'workers': [{'instance_id': 'i-w1', 'ip': IPS['i-w1']}],
+        'checkpoints': {
+            'i-head': {'steps': {'launched': 't', 'running': 't', 'head_installed': 't', 'head_started': 't'},
+                       'role': 'head', 'worker_urls': worker_urls},
+            'i-w1': {'steps': dict(DONE), 'role': 'worker'},
+            'i-w2': {'steps': {'launched': 't', 'running': 't'}, 'role': 'worker'},
+        },
+    })
+    manager = DeploymentManager(FakeAWS(), FakeSSH(installed=['10.0.0.100', '10.0.0.1']), storage)
+    monkeypatch.setattr(manager, '_wait_until_ready', lambda instance_ids, on_ready, log_callback, **kwargs: [
+        on_ready(iid, IPS[iid]) for iid in instance_ids
+    ])
+    return manager
+
+
+def test_resume_skips_steps_already_done(resumable):
+    resumable.resume_deployment('dep-1', wait=True)
+    ssh = resumable.ssh
+    for ip in ('10.0.0.100', '10.0.0.1'):
+        assert not ssh.ran(ip, 'pip install')
+        assert not ssh.ran(ip, 'nohup')
+    assert ssh.ran('10.0.0.2', 'pip install') and ssh.ran('10.0.0.2', 'worker_server')
+    assert not ssh.ran('10.0.0.100', 'pkill')  # the head already runs with both workers
+
+    deployment = resumable.storage.get_deployment('dep-1')
+    assert deployment['status'] == 'running'
+    assert set(DONE) <= set(deployment['checkpoints']['i-w2']['steps'])
+    assert not setup_in_progress('dep-1')
@@ -0,0 +1,130 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from ssh_mux import ChannelMultiplexer, CommandCancelled, LineSplitter
+
+
+def split(chunks):
+    lines = []
+    splitter = LineSplitter(lines.append)
+    for chunk in chunks:
+        splitter.feed(chunk)
+    return lines, splitter
+
+
+def test_line_splitter_joins_chunks():
+    lines, splitter = split([b'fir', b'st\nsec', b'ond\n', b'\nthird'])
+    assert lines == ['first', 'second', '']
+    splitter.flush()
+    assert lines == ['first', 'second', '', 'third']
+
+
+def test_line_splitter_multibyte_across_chunks():
+    data = 'héllo ✓\n'.encode()
+    lines, _ = split([data[:2], data[2:9], data[9:]])
+    assert lines == ['héllo ✓']
+
+
+def test_line_splitter_invalid_utf8_and_flush():
+    lines, splitter = split([b'bad \xff byte\n', b'tail \xe2\x9c'])
+    assert lines == ['bad � byte']
+    splitter.flush()
+    assert lines == ['bad � byte', 'tail �']
+    splitter.flush()
+    assert len(lines) == 2
+
+
+class FakeChannel:
+    """Just enough of paramiko.Channel for the multiplexer, backed by a socketpair"""
+
+    def __init__(self, exit_status=0):
+        self._r, self._w = socket.socketpair()
+        self._r.setblocking(False)
+        self._out = []
+        self._lock = threading.Lock()
+        self.exit_status = exit_status
+        self.eof_received = False
+        self.closed = False
+
+    def fileno(self):
+        return self._r.fileno()
+
+    def send_output(self, data: bytes):
+        with self._lock:
+            self._out.append(data)
+        self._w.send(b'\0')
+
+    def finish(self):
+        self.eof_received = True
+        self._w.send(b'\0')
+
+    def recv_ready(self):
+        with self._lock:
+            return bool(self._out)
+
+    def recv(self, n):
+        try:
+            self._r.recv(4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            return self._out.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+
+def test_multiplexer_reads_until_eof():
+    mux = ChannelMultiplexer(select_timeout=0.05)
+    channel, lines = FakeChannel(exit_status=3), []
+    handle = mux.watch(channel, on_stdout=lines.append, on_stderr=lines.append)
+    channel.send_output(b'one\ntw')
+    channel.send_output(b'o')
+    channel.finish()
+    assert handle.wait() == 3
+    assert lines == ['one', 'two']
+
+
+def test_multiplexer_cancel():
+    mux = ChannelMultiplexer(select_timeout=0.05)
+    channel = FakeChannel()
+    handle = mux.watch(channel, on_stdout=lambda line: None, on_stderr=lambda line: None)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(CommandCancelled):
+        handle.wait(cancel)
+    assert channel.closed
+
+
+def test_multiplexer_survives_loop_errors():
+    mux = ChannelMultiplexer(select_timeout=0.05)
+    channel = FakeChannel()
+    handle = mux.watch(channel, on_stdout=lambda line: None, on_stderr=lambda line: None)
+    while handle not in mux._handles:
+        time.sleep(0.01)
+
+    def broken_select(timeout=None):
+        raise OSError("selector broke")
+
+    # Only the current selector breaks; _reset replaces it
+    mux._selector.select = broken_select
+    with pytest.raises(OSError):
+        handle.wait()
+    assert channel.closed
+    assert mux._thread.is_alive()
+
+    channel, lines = FakeChannel(), []
+    handle = mux.watch(channel, on_stdout=lines.append, on_stderr=lines.append)
+    channel.send_output(b'still here\n')
+    channel.finish()
+    assert handle.wait() == 0
+    assert lines == ['still here']
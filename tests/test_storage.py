@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from storage import SCHEMA_VERSION, Storage
+
+
+def deployment(dep_id, status='running', **fields):
+    return dict({'id': dep_id, 'status': status, 'created_at': f'2026-01-01T00:00:{dep_id[-2:]}Z'}, **fields)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return str(tmp_path / 'data')
+
+
+def test_save_get_delete(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01'))
+    storage.save_deployment(deployment('dep-02', status='failed'))
+
+    assert storage.get_deployment('dep-01')['status'] == 'running'
+    assert set(storage.get_deployments_by_status(['failed'])) == {'dep-02'}
+    storage.delete_deployment('dep-01')
+    assert storage.get_deployment('dep-01') is None
+    assert set(storage.get_all_deployments()) == {'dep-02'}
+
+
+def test_survives_reopen(data_dir):
+    Storage(data_dir).save_deployment(deployment('dep-01', workers=[{'ip': '1.2.3.4'}]))
+    assert Storage(data_dir).get_deployment('dep-01')['workers'] == [{'ip': '1.2.3.4'}]
+
+
+def test_migrates_legacy_json_once(data_dir):
+    os.makedirs(data_dir)
+    legacy = {'dep-01': deployment('dep-01'), 'dep-02': deployment('dep-02', status='terminated')}
+    with open(os.path.join(data_dir, 'deployments.json'), 'w') as f:
+        json.dump(legacy, f)
+
+    storage = Storage(data_dir)
+    assert storage.get_all_deployments() == legacy
+    assert not os.path.exists(os.path.join(data_dir, 'deployments.json'))
+    assert os.path.exists(os.path.join(data_dir, 'deployments.json.migrated'))
+
+
+def test_migration_never_clobbers_newer_rows(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01', status='running'))
+    with open(os.path.join(data_dir, 'deployments.json'), 'w') as f:
+        json.dump({'dep-01': deployment('dep-01', status='launching')}, f)
+
+    assert Storage(data_dir).get_deployment('dep-01')['status'] == 'running'
+
+
+def test_upgrades_schema_1_database(data_dir):
+    os.makedirs(data_dir)
+    conn = sqlite3.connect(os.path.join(data_dir, 'deployments.db'))
+    conn.execute("CREATE TABLE deployments (id TEXT PRIMARY KEY, status TEXT, created_at TEXT, data TEXT NOT NULL)")
+    conn.execute("INSERT INTO deployments VALUES (?, ?, ?, ?)",
+                 ('dep-01', 'running', 'x', json.dumps(deployment('dep-01'))))
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    storage = Storage(data_dir)
+    assert storage.get_deployment('dep-01')['status'] == 'running'
+    assert storage.version == 1
+    version = storage._conn().execute("PRAGMA user_version").fetchone()[0]
+    assert version == SCHEMA_VERSION
+
+
+def test_concurrent_updates_are_not_lost(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01', counter=0))
+
+    def bump():
+        for _ in range(50):
+            storage.mutate_deployment('dep-01', lambda dep: dep.update(counter=dep['counter'] + 1))
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert storage.get_deployment('dep-01')['counter'] == 200
+    assert Storage(data_dir).get_deployment('dep-01')['counter'] == 200
+
+
+def test_update_missing_deployment_returns_none(data_dir):
+    assert Storage(data_dir).update_deployment('nope', status='failed') is None
+
+
+def test_version_counts_every_change(data_dir):
+    storage = Storage(data_dir)
+    start = storage.version
+    storage.save_deployment(deployment('dep-01'))
+    storage.update_deployment('dep-01', status='failed')
+    storage.save_deployment(deployment('dep-02'))
+    storage.delete_deployment('dep-02')
+    assert storage.version == start + 4
+    assert storage.get_deployment_version('dep-01') == start + 2
+
+
+def test_batch_writes_bump_the_version_once_and_only_if_something_changed(data_dir):
+    storage = Storage(data_dir)
+    for dep_id in ('dep-01', 'dep-02'):
+        storage.save_deployment(deployment(dep_id))
+    version = storage.version
+
+    assert storage.update_deployments([]) == 0
+    assert storage.update_deployments(['dep-99'], status='failed') == 0
+    assert storage.delete_deployments([]) == 0
+    assert storage.delete_deployments(['dep-99']) == 0
+    assert storage.version == version
+
+    assert storage.update_deployments(['dep-01', 'dep-02', 'dep-99'], status='terminated') == 2
+    assert storage.version == version + 1
+    assert storage.delete_deployments(['dep-01', 'dep-02']) == 2
+    assert storage.version == version + 2
+    assert storage.get_changes_since(version + 1)['removed'] == ['dep-01', 'dep-02']
+
+
+def test_changes_since(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01'))
+    storage.save_deployment(deployment('dep-02'))
+    since = storage.version
+    storage.update_deployment('dep-01', status='failed')
+    storage.save_deployment(deployment('dep-03'))
+    storage.delete_deployment('dep-02')
+
+    changes = storage.get_changes_since(since)
+    assert changes['version'] == since + 3
+    assert set(changes['updated']) == {'dep-01'}
+    assert set(changes['created']) == {'dep-03'}
+    assert changes['removed'] == ['dep-02']
+    assert storage.get_changes_since(changes['version'])['updated'] == {}
+
+
+def test_sees_writes_from_another_process(data_dir):
+    ours, theirs = Storage(data_dir), Storage(data_dir)
+    ours.save_deployment(deployment('dep-01'))
+    since = ours.version
+    theirs.update_deployment('dep-01', status='failed')
+    theirs.save_deployment(deployment('dep-02'))
+
+    assert ours.get_deployment('dep-01')['status'] == 'failed'
+    assert ours.version == since + 2
+    assert set(ours.get_changes_since(since)['updated']) == {'dep-01'}
+
+
+def test_getters_return_copies(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01', workers=[]))
+
+    dep = storage.get_deployment('dep-01')
+    dep['status'] = 'failed'
+    dep['workers'].append({'ip': '1.2.3.4'})
+    storage.get_all_deployments()['dep-01']['status'] = 'terminated'
+    assert storage.get_deployment('dep-01') == deployment('dep-01', workers=[])
+    assert set(storage.get_deployments_by_status(['running'])) == {'dep-01'}
+
+    # The baseline get-mutate-save pattern still works
+    storage.save_deployment(dep)
+    assert storage.get_deployment('dep-01')['workers'] == [{'ip': '1.2.3.4'}]
+
+
+def test_wait_for_change_wakes_on_write(data_dir):
+    storage = Storage(data_dir)
+    since = storage.version
+    timer = threading.Timer(0.05, storage.save_deployment, args=(deployment('dep-01'),))
+    timer.start()
+    assert storage.wait_for_change(since, timeout=5) == since + 1
+    timer.join()
+
+
+def test_timings_do_not_move_the_version(data_dir):
+    storage = Storage(data_dir)
+    storage.save_deployment(deployment('dep-01'))
+    version = storage.version
+    storage.add_timings('dep-01', [{'phase': 'install', 'duration': i} for i in range(5)], keep=3)
+    storage.add_timings('dep-01', [{'phase': 'health', 'duration': 9}], keep=3)
+    assert storage.version == version
+    assert [span['duration'] for span in storage.get_timings('dep-01')] == [3, 4, 9]
+    assert 'timings' not in storage.get_deployment('dep-01')
+
+    storage.add_timings('dep-02', [{'phase': 'install', 'duration': 1}])
+    storage.delete_deployments(['dep-01'])
+    assert storage.get_timings('dep-01') == []
+    assert len(storage.get_timings('dep-02')) == 1
+
+
+def test_upgrade_moves_timings_out_of_deployments(data_dir):
+    os.makedirs(data_dir)
+    conn = sqlite3.connect(os.path.join(data_dir, 'deployments.db'))
+    conn.execute("CREATE TABLE deployments (id TEXT PRIMARY KEY, status TEXT, created_at TEXT, data TEXT NOT NULL)")
+    spans = [{'phase': 'install', 'duration': 1.5}, {'phase': 'health', 'duration': 0.5}]
+    conn.execute("INSERT INTO deployments VALUES (?, ?, ?, ?)",
+                 ('dep-01', 'running', 'x', json.dumps(deployment('dep-01', timings=spans))))
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    storage = Storage(data_dir)
+    assert storage.get_deployment('dep-01') == deployment('dep-01')
+    assert storage.get_timings('dep-01') == spans
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import warm_pool
+from warm_pool import WarmPoolManager
+
+
+class FakeSSH:
+    def __init__(self):
+        self.commands = []
+
+    def run_command(self, ip, command, log_callback=None, use_pty=True, background=False, cancel_event=None):
+        self.commands.append((ip, command))
+        return 0
+
+
+def pool_key(setup_hash='hash-1'):
+    return WarmPoolManager.pool_key(os.environ['LAUNCH_TEMPLATE_ID'], 'test-key', setup_hash)
+
+
+@pytest.fixture
+def pool(aws):
+    """A pool of two ready (installed and stopped) members"""
+    pool = WarmPoolManager(aws, size=2)
+    pool.refill(pool_key(), os.environ['LAUNCH_TEMPLATE_ID'], 'test-key', ['install'], FakeSSH(), print)
+    return pool
+
+
+def states(aws, instance_ids):
+    reservations = aws.ec2.describe_instances(InstanceIds=instance_ids)['Reservations']
+    return {i['InstanceId']: i['State']['Name'] for r in reservations for i in r['Instances']}
+
+
+def test_refill_installs_and_stops_members(pool):
+    assert pool.status() == {pool_key(): {'ready': 2}}
+
+
+def test_claim_starts_members(pool, aws):
+    claimed = pool.claim(5, pool_key(), 'dep-1')
+    assert len(claimed) == 2
+    assert set(states(aws, claimed).values()) <= {'pending', 'running'}
+    assert pool.claim(1, pool_key(), 'dep-2') == []
+    # Another setup (e.g. a new package commit) never gets these members
+    assert pool.claim(1, pool_key('hash-2'), 'dep-3') == []
+
+
+def test_claim_waits_for_members_to_leave_stopped(pool, aws, monkeypatch):
+    get_instance_status = aws.get_instance_status
+    lagging = {'rounds': 2}
+
+    def lagging_status(instance_ids):
+        # Describe calls still report the old state for a while after StartInstances
+        result = get_instance_status(instance_ids)
+        if lagging['rounds'] > 0:
+            lagging['rounds'] -= 1
+            for status in result.values():
+                status['state'] = 'stopped'
+        return result
+
+    monkeypatch.setattr(aws, 'get_instance_status', lagging_status)
+    monkeypatch.setattr(warm_pool.time, 'sleep', lambda seconds: None)
+    claimed = pool.claim(2, pool_key(), 'dep-1')
+    assert len(claimed) == 2 and lagging['rounds'] == 0
+
+
+def test_claim_drops_members_that_never_start(pool, aws, monkeypatch):
+    monkeypatch.setattr(aws, 'get_instance_status',
+                        lambda instance_ids: {iid: {'state': 'stopped', 'status_ok': False} for iid in instance_ids})
+    monkeypatch.setattr(warm_pool.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(warm_pool, 'CLAIM_START_TIMEOUT', 0)
+    members = aws.find_instances({'WarmPool': pool_key()}, ['stopped'])
+    assert pool.claim(2, pool_key(), 'dep-1') == []
+    assert set(states(aws, [m['InstanceId'] for m in members]).values()) <= {'shutting-down', 'terminated'}